@@ -0,0 +1,24 @@
+import importlib
+from collections.abc import Callable
+
+
+# Module implementing each command. It is only imported when the command is run so that starting the program
+# (eg: for '--help') or running a command that doesn't need S3 (eg: 'show') doesn't import 'boto3', 'rich' and 'Cryptodome'.
+COMMAND_MODULES = {
+    'backup': '.backup',
+    'resume': '.backup',
+    'show': '.show',
+    'find': '.show',
+    'plan': '.plan',
+    'retrieve': '.retrieve',
+    'decrypt': '.decrypt',
+    'sync': '.sync',
+    'verify': '.verify',
+    'delete': '.delete',
+    'merge': '.merge',
+    'watch': '.watch',
+}
+
+
+def get_command_func(command: str) -> Callable:
+    return getattr(importlib.import_module(COMMAND_MODULES[command], __name__), command)
@@ -0,0 +1,688 @@
+import io
+import os
+import math
+import heapq
+import random
+import queue
+import logging
+import logging.config
+import multiprocessing
+from time import perf_counter, thread_time
+from array import array
+from contextlib import suppress, nullcontext
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from collections.abc import Iterable
+
+from rich import print
+from rich.table import Table
+from Cryptodome.Cipher import ChaCha20
+
+import settings
+from utils import *
+from consts import TAR_COMPRESSION_TYPES, COMPRESSOR_MEM_SIZES
+from libs import TaskType,\
+                UploadTaskStatus,\
+                WorkerPool,\
+                SplitTarFiles,\
+                ReadAheadFiles,\
+                BloomFilter,\
+                Metrics,\
+                CompressFileObj,\
+                BufferPool,\
+                StagingDirs,\
+                LocalityOrder,\
+                ShardUploadQueue,\
+                ChangeJournal,\
+                Profiler,\
+                StateDB,\
+                s3_bucket_exists
+
+
+def backup(src_dirs: list[str],
+           output_filename_template: str,
+           split_size: int,
+           bucket: str,
+           num_upload_workers: int,
+           compression: str,
+           encrypt: bool,
+           autoclean: bool,
+           drop_page_cache: bool,
+           metrics_textfile: str | None,
+           metrics_port: int | None,
+           memory_budget: int,
+           staging_dirs: list[str] | None,
+           locality_order: bool,
+           num_shard_processes: int,
+           transfer_engine: str,
+           plan_only: bool,
+           test_run: bool):
+    if plan_only:
+        _plan_backup(src_dirs, split_size, num_upload_workers, compression, encrypt, autoclean, test_run)
+        return
+
+    # CAUTION: For testing, we interpret 'split_size' as MB splits for ease
+    min_memory_budget = _get_min_memory_budget(compression,
+                                               _get_upload_mem_size(MB_to_bytes(split_size) if test_run else GB_to_bytes(split_size), transfer_engine))
+    if memory_budget < min_memory_budget:
+        logging.error(f"Memory budget must be at least {min_memory_budget} MB with '{compression or 'no'}' compression!")
+        exit(1)
+
+    # NOTE: Memory budget is shared by main backup process (i.e. its uploads) and each shard process
+    if num_shard_processes and memory_budget // (num_shard_processes + 1) < min_memory_budget:
+        logging.error(f"Memory budget must be at least {(num_shard_processes + 1) * min_memory_budget} MB "\
+                      f"with {num_shard_processes} shard processes and '{compression or 'no'}' compression!")
+        exit(1)
+
+    if not s3_bucket_exists(bucket):
+        logging.error(f"The bucket with name '{bucket}' doesn't exist in S3 server!")
+        exit(1)
+
+    db_filename = abspath(datetime.now().strftime(settings.STATE_DB_FILENAME_TEMPLATE))
+    logging.info(f"Recording backup state in '{db_filename}'...")
+    _backup_or_resume(**{name: value for name, value in locals().items() if name not in ['plan_only', 'min_memory_budget']})
+
+
+def resume(db_filename: str):
+    logging.info("Trying to resume from last failed backup point...")
+    with StateDB(db_filename) as state_db:
+        cmd_args : dict = state_db.get_last_cmd_args()
+        cmd_args['db_filename'] = abspath(db_filename)
+
+    # CAUTION: Following needs to be called after 'with' block so that we don't
+    # try to open state DB twice, which will fail
+    _backup_or_resume(**cmd_args)
+
+
+def _backup_or_resume(db_filename: str,
+                      src_dirs: list[str],
+                      output_filename_template: str,
+                      split_size: int,
+                      bucket: str,
+                      num_upload_workers: int,
+                      compression: str,
+                      encrypt: bool,
+                      autoclean: bool,
+                      test_run: bool,
+                      drop_page_cache: bool=False,    # NOTE: Defaults for arguments not recorded by older state DBs
+                      metrics_textfile: str | None=None,
+                      metrics_port: int | None=None,
+                      memory_budget: int=settings.DEFAULT_MEMORY_BUDGET_MEGABYTES,
+                      staging_dirs: list[str] | None=None,
+                      locality_order: bool=False,
+                      num_shard_processes: int=0,
+                      transfer_engine: str=settings.DEFAULT_TRANSFER_ENGINE,
+                      files_only_dirs: list[str] | None=None,     # NOTE: Folders whose files, but not subfolders, are backed up (eg: by a shard)
+                      upload_queue=None):   # NOTE: Given when backing up a shard so its TAR files are uploaded by main backup process
+    # CAUTION: Call 'locals()' immediately before any variable assignment
+    # so that only this function's arguments are captured
+    cmd_args = {name: value for name, value in locals().items() if name != 'upload_queue'}
+    if num_shard_processes:
+        _backup_shards(cmd_args)
+        return
+
+    metrics_summary_file = datetime.now().strftime(settings.METRICS_SUMMARY_FILENAME_TEMPLATE)
+    if upload_queue is not None:
+        # NOTE: Shards started at the same time would otherwise save their summaries to the same file
+        metrics_summary_file = f"{os.path.splitext(os.path.basename(db_filename))[0]}_{metrics_summary_file}"
+
+    # NOTE: If 'watch' journals changes in source folders, only folders in which files changed since last backup are walked
+    journal_filename = get_journal_filename(db_filename)
+    with StateDB(db_filename, cmd_args) as state_db,\
+         Metrics(metrics_textfile,
+                 metrics_port,
+                 os.path.join(settings.LOG_DIR, metrics_summary_file)) as metrics,\
+         BufferPool(MB_to_bytes(memory_budget)) as buffer_pool,\
+         (ChangeJournal(journal_filename) if os.path.exists(journal_filename) else nullcontext()) as change_journal:
+        page_cache_usage = PageCacheUsage()
+        metrics.add_stage_latencies(state_db.get_latency_stats())
+
+        # Files read ahead are only freed once they are packed so they get what's left of memory budget after the packer
+        # (i.e. its encryption buffer and compressor) and upload streams. Otherwise, they could take memory that uploads
+        # need to finish while the packer waits for uploads to finish before packing them. Shards don't upload themselves.
+        # CAUTION: For testing, we interpret 'split_size' as MB splits for ease
+        split_size = MB_to_bytes(split_size) if test_run else GB_to_bytes(split_size)
+        read_ahead_mem_size = buffer_pool.budget_size - (buffer_pool.buffer_size + COMPRESSOR_MEM_SIZES.get(compression, 0)) -\
+                                                        (num_upload_workers * _get_upload_mem_size(split_size, transfer_engine) if upload_queue is None else 0)
+        read_ahead_mem_size = max(min(read_ahead_mem_size, settings.READ_AHEAD_MEM_SIZE_BYTES), 0)
+
+        with (WorkerPool(num_upload_workers,
+                         TaskType.UPLOAD,
+                         autoclean,
+                         state_db,
+                         s3_bucket_name=bucket,
+                         test_run=test_run,
+                         drop_page_cache=drop_page_cache,
+                         metrics=metrics,
+                         buffer_pool=buffer_pool,
+                         transfer_engine=transfer_engine) if upload_queue is None else\
+              ShardUploadQueue(upload_queue, db_filename, num_upload_workers, state_db)) as upload_worker_pool:
+            # NOTE: This worker pool context will block (i.e. will not exit) until all tasks are done
+
+            # NOTE: Parts are made large enough for TAR files of up to twice the split size to fit in the most parts S3 allows,
+            # otherwise 'boto3' would upload them in larger parts than their checksums were worked out for. Checksums of
+            # larger TAR files (eg: with a file larger than split size) are worked out again for larger parts once packed.
+            upload_part_size = get_upload_part_size(2 * split_size)
+
+            # Create destination folder and prepare output filename (i.e. add compression type extension
+            # postfix, if compression was requested, and encrypted file extension, if encryption was requested)
+            os.makedirs(os.path.dirname(output_filename_template), exist_ok=True)
+            output_filename_template = get_tar_filename_template(output_filename_template, compression, encrypt)
+
+            # TAR files are packed in the output folder unless staging folders (eg: on several disks) were given
+            staging_dirs = StagingDirs(staging_dirs or [os.path.dirname(output_filename_template)], state_db, split_size)
+
+            # Similary, if encryption is enabled, create/get encryption key from state DB (or generate and save if not exists)
+            encrypt_key = state_db.get_encryption_key() if encrypt else None
+
+            # If the TAR file being packed when backup was interrupted was checkpointed, continue packing it from its
+            # last checkpoint. Files added to it after the checkpoint are forgotten so that they are packed again.
+            checkpoint = state_db.get_checkpoint()
+            if checkpoint:
+                checkpoint_tar_file, checkpoint_temp_file, checkpoint_size, _, checkpoint_last_work_id = checkpoint
+                checkpoint_temp_filename = staging_dirs.find(checkpoint_temp_file)
+                if checkpoint_temp_filename and os.path.getsize(checkpoint_temp_filename) >= checkpoint_size:
+                    logging.info(f"Found '{checkpoint_tar_file}' checkpointed at {prettyFilesize(checkpoint_size)}. Will continue packing it from there.")
+                    state_db.rollback_to_checkpoint(checkpoint_tar_file, checkpoint_last_work_id)
+                else:
+                    logging.warning(f"The TAR file '{checkpoint_tar_file}' was checkpointed but its incomplete file is missing or truncated! "\
+                                    "Its files will be repackaged later.")
+                    state_db.delete_checkpoint(checkpoint_tar_file)
+                    checkpoint = None
+
+            # At this point, tasks in state DB can only be in PACKAGED, FAILED or UPLOADED state
+            # If there are any task in other states, the state DB is in an invalid state and
+            # we will correct it by marking all such tasks as FAILED
+            state_db.correct_db_init_state()
+
+            # CAUTION: New TAR files must be numbered after all TAR files recorded in state DB (and not only the
+            # packaged ones) otherwise they might overwrite already uploaded TAR files of the same name
+            output_filename_idx = _get_next_tar_file_idx(state_db)
+
+            # Check if there are some packaged TAR files that haven't been uploaded yet and, if so, upload them first
+            # If we find entry for a tar file to have been packaged but the file is missing, we delete its DB record
+            already_packaged_tar_files = state_db.get_already_packaged_tar_files()
+            for already_packaged_tar_file in already_packaged_tar_files:
+                already_packaged_tar_filename = staging_dirs.find(already_packaged_tar_file)
+                if already_packaged_tar_filename:
+                    # The TAR file is still on disk so put it on upload queue
+                    logging.info(f"Found packaged '{already_packaged_tar_file}' TAR file. Putting on upload queue.")
+                    upload_worker_pool.put_on_tasks_queue(already_packaged_tar_filename)
+                else:
+                    # Delete the DB record for the TAR file
+                    logging.warning(f"The TAR file '{already_packaged_tar_file}' is marked '{UploadTaskStatus.PACKAGED}' "\
+                                    "but was deleted! Deleting its records in DB. Its files will be repackaged later.")
+                    state_db.delete_work_record(already_packaged_tar_file)
+            upload_worker_pool.wait_on_all_tasks()      # Wait until all packaged TARs have been uploaded
+
+            # CAUTION: Changed folders are read after records of files to be backed up again were corrected above
+            changed_dirs = change_journal.get_changed_dirs(state_db) if change_journal else None
+
+            with SplitTarFiles(state_db,
+                            output_filename_template,
+                            output_filename_idx,
+                            encrypt_key,
+                            compression,
+                            buffer_pool,
+                            upload_worker_pool.put_on_tasks_queue,
+                            drop_page_cache,
+                            checkpoint,
+                            metrics,
+                            upload_part_size,
+                            staging_dirs) as split_tarfiles:
+                if checkpoint:
+                    logging.info(f"Continuing TAR file '{split_tarfiles.get_tarfile_name()}' from its last checkpoint for backup...")
+                else:
+                    logging.info(f"Starting a new TAR file '{split_tarfiles.get_tarfile_name()}' for backup...")
+
+                # For each directory, enumerate files in it and add them to a tar file
+                # NOTE: Next few files are read ahead in background threads while the current one is compressed and encrypted
+                # NOTE: With locality order, folders are walked once before any file is listed to work out their sizes
+                files_locality_order = LocalityOrder(src_dirs, split_size, split_tarfiles.tell()) if locality_order else None
+                with ReadAheadFiles(_iter_files_to_backup(src_dirs, state_db, metrics, files_locality_order, files_only_dirs, changed_dirs),
+                                    settings.READ_AHEAD_NUM_FILES,
+                                    settings.READ_AHEAD_NUM_THREADS,
+                                    read_ahead_mem_size,
+                                    settings.READ_AHEAD_MAX_FILE_SIZE_BYTES,
+                                    drop_page_cache,
+                                    metrics,
+                                    buffer_pool) as read_ahead_files:
+                    for src_filename, src_data in read_ahead_files:
+                        # If the total bytes written is larger than split_size, queue it for upload and start a new tar file
+                        # With locality order, a nearly full TAR file is also ended if the file starts a new top-level folder
+                        min_split_size = files_locality_order.min_split_size if files_locality_order and files_locality_order.is_folder_start(src_filename) else split_size
+                        if split_tarfiles.tell() >= min_split_size:
+                            if state_db.count_already_packaged_tar_files() >= upload_worker_pool.num_workers + settings.NUM_WORKS_PRODUCE_AHEAD:
+                                # Wait for any upload task to complete so that we don't end up with
+                                # too many TAR files waiting to be uploaded and consuming excessive disk space
+                                logging.info("Waiting for any upload task to complete as there are already "\
+                                            f"{upload_worker_pool.get_num_tasks_running()} upload tasks running...")
+                                upload_worker_pool.wait_on_any_task()
+
+                            split_tarfiles.create_new_tarfile_part()
+                            logging.info(f"Starting a new TAR file '{split_tarfiles.get_tarfile_name()}' for backup...")
+                            page_cache_usage.log()
+
+                        logging.info(f"Processing '{src_filename}'...")
+                        state_db.record_changed_work_state(UploadTaskStatus.SCHEDULED,
+                                                        filename=src_filename,
+                                                        tar_file=split_tarfiles.get_tarfile_name())
+                        split_tarfiles.add(src_filename, src_data)
+                        del src_data    # NOTE: So that file read ahead is freed before its memory is given back to read-ahead budget
+
+        logging.info("All files have been processed and queued for upload. Waiting for all uploads to complete...")
+        page_cache_usage.log()
+
+        # NOTE: Changes journaled before walk started are only forgotten once files walked have been backed up
+        if change_journal:
+            change_journal.record_walk(state_db)
+
+        # NOTE: Source folders of a shard aren't top-level folders of the backup so main backup process reports this
+        if upload_queue is None:
+            _log_num_tar_files_per_folder(state_db, src_dirs, metrics)
+
+    logging.info("Backup done")
+
+
+def _backup_shards(cmd_args: dict) -> None:
+    # Source folders are split into shards, each backed up by a shard process with its own walker, packer and state DB
+    # (i.e. '<state DB>_shard<idx>'). TAR files packed by shards are put on a queue for upload workers of this process,
+    # which record upload states in the shard's state DB, so that all shards share its bandwidth limit. Once all shards
+    # are done, shard state DBs are merged into this state DB. Resuming it resumes all shards that aren't done.
+    db_filename, num_shard_processes = cmd_args['db_filename'], cmd_args['num_shard_processes']
+    process_memory_budget = cmd_args['memory_budget'] // (num_shard_processes + 1)
+    with StateDB(db_filename, cmd_args) as state_db,\
+         Metrics(cmd_args['metrics_textfile'],
+                 cmd_args['metrics_port'],
+                 os.path.join(settings.LOG_DIR, datetime.now().strftime(settings.METRICS_SUMMARY_FILENAME_TEMPLATE))) as metrics,\
+         BufferPool(MB_to_bytes(process_memory_budget)) as buffer_pool:
+        shard_db_filenames = get_shard_db_filenames(db_filename)
+        if shard_db_filenames:
+            logging.info(f"Found {len(shard_db_filenames)} shard state DB(s). Will resume shards that aren't done.")
+        else:
+            # CAUTION: For testing, we interpret shard split size as MB like 'split_size'
+            shard_split_size = MB_to_bytes(settings.SHARD_SPLIT_SIZE_GIGABYTES) if cmd_args['test_run'] else GB_to_bytes(settings.SHARD_SPLIT_SIZE_GIGABYTES)
+            shards = _get_shards(cmd_args['src_dirs'], shard_split_size)
+            logging.info(f"Splitting backup into {len(shards)} shard(s) to be backed up by {num_shard_processes} shard processes...")
+
+            # CAUTION: Shard state DBs are only moved in place once all are created so that resuming
+            # after being interrupted here doesn't find only some of them
+            output_dirname, output_file = os.path.split(cmd_args['output_filename_template'])
+            for shard_idx, (shard_src_dirs, shard_files_only_dirs) in enumerate(shards):
+                shard_db_filename = get_shard_db_filename(db_filename, shard_idx)
+                remove_file_ignore_errors(shard_db_filename + '.tmp')
+                shard_cmd_args = cmd_args | {'db_filename': shard_db_filename,
+                                             'src_dirs': shard_src_dirs,
+                                             'files_only_dirs': shard_files_only_dirs,
+                                             'output_filename_template': os.path.join(output_dirname, f"shard{shard_idx:03}_{output_file}"),
+                                             'metrics_textfile': None,
+                                             'metrics_port': None,
+                                             'memory_budget': process_memory_budget,
+                                             'num_shard_processes': 0}
+                with StateDB(shard_db_filename + '.tmp', shard_cmd_args) as shard_state_db:
+                    if cmd_args['encrypt']:
+                        shard_state_db.record_encryption_key(state_db.get_encryption_key())     # NOTE: All shards use the same key
+                shard_db_filenames.append(shard_db_filename)
+
+            for shard_db_filename in shard_db_filenames:
+                os.replace(shard_db_filename + '.tmp', shard_db_filename)
+
+        shard_state_dbs = {shard_db_filename: StateDB(shard_db_filename) for shard_db_filename in shard_db_filenames}
+        try:
+            # NOTE: Files of TAR files that were marked failed or deleted in this state DB after being merged are backed up again
+            state_db.record_changes_in_merged_state_dbs(list(shard_state_dbs.values()))
+
+            # Only shards whose shard process didn't walk all their files or with files that aren't uploaded yet are resumed
+            walked_shards = state_db.get_walked_shards()
+            unfinished_shard_db_filenames = [shard_db_filename for shard_db_filename in shard_db_filenames
+                                             if os.path.basename(shard_db_filename) not in walked_shards or shard_state_dbs[shard_db_filename].has_unfinished_works()]
+            if len(unfinished_shard_db_filenames) < len(shard_db_filenames):
+                logging.info(f"{len(shard_db_filenames) - len(unfinished_shard_db_filenames)} of {len(shard_db_filenames)} shard(s) are already done.")
+
+            with WorkerPool(cmd_args['num_upload_workers'],
+                            TaskType.UPLOAD,
+                            cmd_args['autoclean'],
+                            state_db,
+                            s3_bucket_name=cmd_args['bucket'],
+                            test_run=cmd_args['test_run'],
+                            drop_page_cache=cmd_args['drop_page_cache'],
+                            metrics=metrics,
+                            buffer_pool=buffer_pool,
+                            transfer_engine=cmd_args['transfer_engine']) as upload_worker_pool:
+                # NOTE: Shard processes are spawned rather than forked as this process already runs threads
+                mp_context = multiprocessing.get_context('spawn')
+                with mp_context.Manager() as manager,\
+                     ProcessPoolExecutor(num_shard_processes, mp_context=mp_context) as process_pool:
+                    upload_queue = manager.Queue()
+                    # NOTE: If this process is profiled, each shard process is profiled the same way to its own file
+                    profiler = Profiler.get_active()
+                    shard_futures = {process_pool.submit(_backup_shard,
+                                                         shard_db_filename,
+                                                         upload_queue,
+                                                         (profiler.mode, f"{profiler.output_filename_prefix}_{_get_shard_name(shard_db_filename)}") if profiler else None): shard_db_filename
+                                     for shard_db_filename in unfinished_shard_db_filenames}
+
+                    while True:
+                        # CAUTION: Shards must be checked for being done before the queue is found empty
+                        # otherwise TAR files queued by a shard just before it is done could be missed
+                        all_shards_done = all(shard_future.done() for shard_future in shard_futures)
+                        try:
+                            shard_db_filename, tar_filename = upload_queue.get(timeout=settings.SHARD_UPLOAD_POLL_INTERVAL_SECS)
+                            upload_worker_pool.put_on_tasks_queue(tar_filename, shard_state_dbs[shard_db_filename])
+                        except queue.Empty:
+                            if all_shards_done:
+                                break
+
+                    failed_shard_db_filenames = []
+                    for shard_future, shard_db_filename in shard_futures.items():
+                        if shard_future.exception():
+                            logging.error(f"Shard with state DB '{shard_db_filename}' failed with '{repr(shard_future.exception())}'!")
+                            failed_shard_db_filenames.append(shard_db_filename)
+                        else:
+                            state_db.record_walked_shard(shard_db_filename)
+
+                logging.info("All shards are done. Waiting for all uploads to complete...")
+
+            # NOTE: Shards that failed are merged too so that what they backed up can be found in this state DB
+            logging.info(f"Merging {len(shard_state_dbs)} shard state DB(s) into '{db_filename}'...")
+            state_db.record_merged_state_dbs(list(shard_state_dbs.values()))
+
+        finally:
+            for shard_state_db in shard_state_dbs.values():
+                shard_state_db.close()
+
+        _log_num_tar_files_per_folder(state_db, cmd_args['src_dirs'], metrics)
+
+    if failed_shard_db_filenames:
+        logging.error(f"{len(failed_shard_db_filenames)} shard(s) failed! Resume with '{db_filename}' to back up the rest of them.")
+        exit(1)
+
+    logging.info("Backup done")
+
+def _backup_shard(shard_db_filename: str, upload_queue, profile: tuple[str, str] | None=None) -> None:     # CAUTION: Runs in shard process
+    os.makedirs(settings.LOG_DIR, exist_ok=True)
+    logging.config.dictConfig(settings.LOGGING_CONFIG_DICT)
+
+    with StateDB(shard_db_filename) as shard_state_db:
+        cmd_args : dict = shard_state_db.get_last_cmd_args()
+        cmd_args['db_filename'] = shard_db_filename
+
+    # CAUTION: Following needs to be called after 'with' block so that we don't
+    # try to open state DB twice, which will fail
+    with Profiler(*profile) if profile else nullcontext():
+        _backup_or_resume(**cmd_args, upload_queue=upload_queue)
+
+def _get_shard_name(shard_db_filename: str) -> str:
+    # Given, for example, "/root/20240101-000000_backup_statedb_shard001.sqlite3", return "shard001"
+    return os.path.splitext(shard_db_filename)[0].rpartition('_')[2]
+
+def _get_shards(src_dirs: list[str], shard_split_size: int) -> list[tuple[list[str], list[str]]]:
+    # Returns source folders and files only folders of each shard, largest shard first so that it isn't left for last.
+    # Each source folder is a shard unless it is larger than 'shard_split_size', in which case it is split into its
+    # subfolders (split further if also too large) and the files directly in it. Consecutive ones of these that fit
+    # together in 'shard_split_size' are then put in the same shard.
+    # NOTE: Files of a shard are only ever in one source folder so that shards never back up the same file
+    folder_sizes = LocalityOrder(src_dirs, shard_split_size, 0)
+    shards: list[tuple[list[int], list[str], list[str]]] = []     # NOTE: Size of each shard is in a list so that it can be added to
+    for src_dir in src_dirs:
+        folder_sizes.add_folder_sizes(src_dir)
+
+        num_shards = len(shards)
+        dirs = [src_dir]
+        while dirs:
+            dir = dirs.pop()
+            if folder_sizes.subtree_sizes[dir] > shard_split_size and folder_sizes.subdirs[dir]:
+                dirs.extend(reversed(folder_sizes.subdirs[dir]))
+                dir_size, files_only = folder_sizes.files_sizes[dir], True
+                if dir_size == 0:
+                    continue    # NOTE: No files directly in folder
+            else:
+                dir_size, files_only = folder_sizes.subtree_sizes[dir], False
+
+            if len(shards) == num_shards or shards[-1][0][0] + dir_size > shard_split_size:
+                shards.append(([0], [], []))
+            shard_size, shard_src_dirs, shard_files_only_dirs = shards[-1]
+            shard_size[0] += dir_size
+            (shard_files_only_dirs if files_only else shard_src_dirs).append(dir)
+
+    return [(shard_src_dirs, shard_files_only_dirs)
+            for _, shard_src_dirs, shard_files_only_dirs in sorted(shards, key=lambda x: x[0][0], reverse=True)]
+
+def _log_num_tar_files_per_folder(state_db: StateDB, src_dirs: list[str], metrics: Metrics) -> None:
+    # Report how many TAR files would have to be restored to get back each top-level folder
+    num_tar_files_per_folder = state_db.get_num_tar_files_per_top_level_folder(src_dirs)
+    metrics.record_folder_tar_files(num_tar_files_per_folder)
+    if num_tar_files_per_folder:
+        most_tar_files_folder = max(num_tar_files_per_folder, key=num_tar_files_per_folder.get)
+        logging.info(f"Files of each of {len(num_tar_files_per_folder)} top-level folder(s) are in "\
+                     f"{sum(num_tar_files_per_folder.values()) / len(num_tar_files_per_folder):.1f} TAR file(s) on average "\
+                     f"and at most {num_tar_files_per_folder[most_tar_files_folder]} for '{most_tar_files_folder}'.")
+
+
+def _get_min_memory_budget(compression: str, upload_mem_size: int) -> int:
+    # NOTE: Packing needs an encryption buffer and a compressor and at least one upload must be able to run alongside
+    return math.ceil((settings.BUFFER_SIZE_BYTES + COMPRESSOR_MEM_SIZES.get(compression, 0) + upload_mem_size) / MB_to_bytes(1))
+
+def _get_upload_mem_size(split_size: int, transfer_engine: str) -> int:
+    # Returns memory an upload worker reserves for TAR files of 'split_size' (see 'WorkerPool._work()')
+    return settings.BUFFER_SIZE_BYTES if transfer_engine == 'asyncio' else get_upload_part_size(2 * split_size)
+
+def _get_next_tar_file_idx(state_db: StateDB) -> int:
+    tar_file_idxs = [int(tar_file_idx) for tar_file_idx, _, _ in map(lambda x: x.partition('_'), state_db.get_all_tar_files())
+                     if tar_file_idx.isdigit()]
+    return max(tar_file_idxs, default=-1) + 1
+
+def _iter_files_to_backup(src_dirs: list[str],
+                          state_db: StateDB,
+                          metrics: Metrics,
+                          locality_order: LocalityOrder | None=None,
+                          files_only_dirs: list[str] | None=None,
+                          changed_dirs: list[tuple[str, bool]] | None=None) -> Generator[str]:
+    # We skip files that were already processed (i.e. uploaded or packed before last checkpoint). Instead of
+    # loading every processed filename in memory, they are added to a Bloom filter which rules out most
+    # files that weren't processed and the files it might contain are then looked up in state DB.
+    # NOTE: Building the filter and looking files up in state DB are timed separately from walking source folders
+    with metrics.time('resume_filter'):
+        already_processed_files = BloomFilter(state_db.count_already_processed_files(), settings.RESUME_FILTER_FALSE_POSITIVE_RATE)
+        for already_processed_file in state_db.iter_already_processed_files():
+            already_processed_files.add(already_processed_file)
+
+    # Files are listed in order of their folders' locality, if requested, or else in the order they are found
+    # NOTE: Sizes for locality order leave out files that the Bloom filter says might have been processed
+    # NOTE: With a change journal, only folders in which files changed (and, if new, their subfolders) are walked
+    if changed_dirs is not None:
+        logging.info(f"Walking {len(changed_dirs)} folder(s) in which files changed since last backup according to change journal...")
+        src_filenames = (src_filename for changed_dir, recursive in changed_dirs
+                         for src_filename in (list_files_recursive_iter(changed_dir) if recursive else list_files_iter(changed_dir)))
+    elif locality_order:
+        src_filenames = locality_order.iter_files(lambda x: is_in_ignore_list(x) or x in already_processed_files)
+    else:
+        src_filenames = (src_filename for src_dir in src_dirs for src_filename in list_files_recursive_iter(src_dir))
+    src_filenames = chain(src_filenames, (src_filename for files_only_dir in files_only_dirs or [] for src_filename in list_files_iter(files_only_dir)))
+
+    # NOTE: Folders are counted once even if their files aren't listed one after another (eg: with locality order)
+    seen_dirnames: set[str] = set()
+    for src_filename in metrics.time_iter('walk', src_filenames):
+        metrics.increment('files')
+        if os.path.dirname(src_filename) not in seen_dirnames:
+            seen_dirnames.add(os.path.dirname(src_filename))
+            metrics.increment('dirs')
+
+        # Check if the file or its parent directory is in the ignore list, if so, skip it
+        if is_in_ignore_list(src_filename):
+            logging.info(f"Skipping '{src_filename}' as it is in the ignore list from IGNORE_DIRS or IGNORE_FILES in settings.py!")
+            continue
+
+        # Check if the file has already been processed in a previous backup attempt and, if so, skip it
+        if src_filename in already_processed_files:
+            with metrics.time('db_probe'):
+                is_already_processed = state_db.is_file_already_processed(src_filename)
+            if is_already_processed:
+                logging.info(f"Skipping '{src_filename}' as it is already backed up according to state DB!")
+                metrics.increment('already_processed_files')
+                continue
+
+        yield src_filename
+
+def _plan_backup(src_dirs: list[str],
+                 split_size: int,
+                 num_upload_workers: int,
+                 compression: str,
+                 encrypt: bool,
+                 autoclean: bool,
+                 test_run: bool):
+    # Estimates TAR files that backup would produce and how long it would take without packing anything.
+    # Only metadata of files is read except for a bounded sample of their contents which is read and
+    # compressed with each compression type to time them and find compression ratios.
+    split_size = MB_to_bytes(split_size) if test_run else GB_to_bytes(split_size)
+
+    logging.info("Walking source folders to plan backup...")
+    start_time, start_cpu_time = perf_counter(), thread_time()
+    member_sizes = array('q')   # NOTE: Kept compactly as there can be millions of files
+    sample_heap: list[tuple[float, str]] = []
+    num_files = num_dirs = src_size = data_size = 0
+    last_dirname = None
+    for src_dir in src_dirs:
+        for src_filename, stat in list_files_stat_recursive_iter(src_dir):
+            if is_in_ignore_list(src_filename):
+                continue
+
+            num_files += 1
+            if os.path.dirname(src_filename) != last_dirname:
+                last_dirname = os.path.dirname(src_filename)
+                num_dirs += 1
+
+            # NOTE: Holes of sparse files aren't packed so only their allocated blocks are counted
+            file_data_size = stat.st_size
+            if settings.PACK_SPARSE_FILES and stat.st_blocks * 512 < min(stat.st_size, settings.MAX_SPARSE_MEMBER_DATA_SIZE_BYTES):
+                file_data_size = stat.st_blocks * 512
+            src_size += stat.st_size
+            data_size += file_data_size
+            member_sizes.append(_estimate_tar_member_size(src_filename, file_data_size))
+
+            # Sample files with larger files being more likely to be picked so that the sample represents bytes
+            # to be packed rather than files (i.e. Efraimidis-Spirakis weighted reservoir sampling)
+            if file_data_size > 0:
+                key = math.log(1.0 - random.random()) / file_data_size
+                if len(sample_heap) < settings.PLAN_SAMPLE_NUM_FILES:
+                    heapq.heappush(sample_heap, (key, src_filename))
+                elif key > sample_heap[0][0]:
+                    heapq.heapreplace(sample_heap, (key, src_filename))
+    walk_secs, walk_cpu_secs = perf_counter() - start_time, thread_time() - start_cpu_time
+
+    if num_files == 0:
+        logging.warning("No files to backup were found!")
+        return
+
+    logging.info(f"Found {num_files} file(s) in {num_dirs} folder(s). Reading and compressing {len(sample_heap)} sampled file(s)...")
+    start_time, start_cpu_time = perf_counter(), thread_time()
+    samples = _read_plan_samples([filename for _, filename in sample_heap])
+    read_secs, read_cpu_secs = perf_counter() - start_time, thread_time() - start_cpu_time
+    sample_size = sum(map(len, samples))
+
+    # Time per byte and ratio of each compression type and encryption for the sample
+    compression_estimates: dict[str, tuple[float, float, float]] = {'': (1.0, 0.0, 0.0)}
+    for compression_type in TAR_COMPRESSION_TYPES:
+        compressed_file = io.BytesIO()
+        compress_fileobj = CompressFileObj(compressed_file, compression_type)
+        start_time, start_cpu_time = perf_counter(), thread_time()
+        for sample in samples:
+            compress_fileobj.write(sample)
+        compress_fileobj.close()
+        compression_estimates[compression_type] = (compressed_file.tell() / sample_size if sample_size else 1.0,
+                                                   (perf_counter() - start_time) / sample_size if sample_size else 0.0,
+                                                   (thread_time() - start_cpu_time) / sample_size if sample_size else 0.0)
+
+    chacha20 = ChaCha20.new(key=os.urandom(settings.ENCRYPT_KEY_LENGTH), nonce=os.urandom(settings.ENCRYPT_NONCE_LENGTH))
+    start_time, start_cpu_time = perf_counter(), thread_time()
+    for sample in samples:
+        chacha20.encrypt(sample)
+    encrypt_secs_per_byte = (perf_counter() - start_time) / sample_size if sample_size else 0.0
+    encrypt_cpu_secs_per_byte = (thread_time() - start_cpu_time) / sample_size if sample_size else 0.0
+
+    # Work out TAR files and duration of each stage (as wall and CPU time) for each compression type
+    tar_size = sum(member_sizes)
+    num_staged_tar_files = num_upload_workers + settings.NUM_WORKS_PRODUCE_AHEAD + 1   # NOTE: Packaged TAR files waiting for upload and the one being packed
+    table = Table(title="Backup Plan")
+    for header in ['compression', 'ratio', 'size', 'tar_files', 'largest', 'staging_disk', 'cpu_time', 'duration']:
+        table.add_column(header, justify='center')
+    for compression_type, (ratio, compress_secs_per_byte, compress_cpu_secs_per_byte) in compression_estimates.items():
+        backup_size = round(tar_size * ratio)
+        tar_file_sizes = _estimate_tar_file_sizes(member_sizes, ratio, split_size)
+        staging_size = sum(sorted(tar_file_sizes)[-num_staged_tar_files:]) if autoclean else backup_size
+        upload_secs = backup_size / settings.TOTAL_MAX_BANDWIDTH_BYTES_PER_SEC if settings.TOTAL_MAX_BANDWIDTH_BYTES_PER_SEC > 0 else None
+        stages = {'walk': (None, walk_cpu_secs, walk_secs),
+                  'read': (data_size, data_size * read_cpu_secs / sample_size, data_size * read_secs / sample_size) if sample_size else (data_size, 0.0, 0.0),
+                  'compress': (tar_size, tar_size * compress_cpu_secs_per_byte, tar_size * compress_secs_per_byte) if compression_type else None,
+                  'encrypt': (backup_size, backup_size * encrypt_cpu_secs_per_byte, backup_size * encrypt_secs_per_byte) if encrypt else None,
+                  'upload': (backup_size, None, upload_secs)}
+        stages = {stage: stage_estimate for stage, stage_estimate in stages.items() if stage_estimate}
+
+        # NOTE: TAR files are uploaded while next ones are packed so only the slower of packing and
+        # uploading adds up except for packing the first TAR file or uploading the last one
+        pack_secs = sum(secs for stage, (_, _, secs) in stages.items() if stage != 'upload')
+        duration_secs = max(pack_secs, upload_secs or 0.0) + min(pack_secs, upload_secs or 0.0) / len(tar_file_sizes)
+        cpu_secs = sum(cpu_secs or 0.0 for _, cpu_secs, _ in stages.values())
+        table.add_row(compression_type or 'none',
+                      f'{ratio:.2f}',
+                      prettyFilesize(backup_size),
+                      str(len(tar_file_sizes)),
+                      prettyFilesize(max(tar_file_sizes)),
+                      prettyFilesize(staging_size),
+                      str(timedelta(seconds=round(cpu_secs))),
+                      str(timedelta(seconds=round(duration_secs))),
+                      style='bold' if compression_type == compression else None)
+        if compression_type == compression:
+            selected_stages, selected_tar_file_sizes = stages, tar_file_sizes
+
+    stages_table = Table(title=f"Estimated Backup Stages With '{compression or 'no'}' Compression")
+    for header in ['stage', 'size', 'cpu_time', 'wall_time']:
+        stages_table.add_column(header, justify='center')
+    for stage, (size, cpu_secs, secs) in selected_stages.items():
+        stages_table.add_row(stage,
+                             prettyFilesize(size) if size is not None else '-',
+                             str(timedelta(seconds=round(cpu_secs))) if cpu_secs is not None else '-',
+                             str(timedelta(seconds=round(secs))) if secs is not None else 'unlimited')
+
+    print()
+    print(table)
+    print(stages_table)
+    print(f"{num_files} file(s) in {num_dirs} folder(s) of {prettyFilesize(src_size)} ({prettyFilesize(data_size)} without holes of sparse files) "\
+          f"would be backed up as {len(selected_tar_file_sizes)} TAR file(s) with '{compression or 'no'}' compression (in bold above).")
+    print(f"Estimates are based on {len(samples)} sampled file(s) ({prettyFilesize(sample_size)}). Reading files already in page cache "\
+          "makes 'read' look faster. 'upload' is limited by 'TOTAL_MAX_BANDWIDTH_BYTES_PER_SEC' in 'settings.py'. "\
+          "Files already backed up by other backups aren't known so all files are counted.")
+    print()
+
+def _estimate_tar_member_size(filename: str, data_size: int) -> int:
+    # A file in TAR file is a header followed by its data padded to 512 byte blocks. In PAX format, an extended
+    # header (of its own header and records) comes first as 'mtime' is fractional and also holds long or non-ASCII paths.
+    pax_records_size = 30
+    name = filename.lstrip('/').encode('utf-8', 'surrogateescape')
+    if len(name) > 100 or not name.isascii():
+        pax_records_size += len(name) + 12
+    return 512 + math.ceil(pax_records_size / 512) * 512 + 512 + math.ceil(data_size / 512) * 512
+
+def _estimate_tar_file_sizes(member_sizes: Iterable[int], ratio: float, split_size: int) -> list[int]:
+    # NOTE: Like backup, a new TAR file is started before adding a file if the current one has reached 'split_size'
+    tar_file_sizes = [0.0]
+    for member_size in member_sizes:
+        if tar_file_sizes[-1] >= split_size:
+            tar_file_sizes.append(0.0)
+        tar_file_sizes[-1] += member_size * ratio
+    return [round(tar_file_size) for tar_file_size in tar_file_sizes]
+
+def _read_plan_samples(filenames: list[str]) -> list[bytes]:
+    samples = []
+    for filename in filenames:
+        try:
+            with open(filename, mode='rb') as file:
+                with suppress(OSError):
+                    file.seek(os.lseek(file.fileno(), 0, os.SEEK_DATA))     # NOTE: Skip leading hole of sparse files
+                samples.append(file.read(settings.PLAN_SAMPLE_MAX_BYTES_PER_FILE))
+
+        except OSError as ex:
+            logging.warning(f"Failed to read '{filename}' with '{repr(ex)}'! It won't be sampled.")
+
+    return samples
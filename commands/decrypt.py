@@ -0,0 +1,23 @@
+import logging
+
+import settings
+from utils import *
+from libs import TaskType, WorkerPool, BufferPool, StateDB
+
+
+def decrypt(autoclean: bool,
+            memory_budget: int,
+            db_filename: str,
+            tar_files_folder: str):
+    with StateDB(db_filename) as state_db,\
+         BufferPool(MB_to_bytes(memory_budget)) as buffer_pool,\
+         WorkerPool(settings.DEFAULT_NUM_UPLOAD_WORKERS,
+                    TaskType.DECRYPT,
+                    autoclean,
+                    state_db,
+                    buffer_pool=buffer_pool) as decrypt_worker_pool:
+        for encrypted_tar_filename in list_files_recursive_iter(tar_files_folder,
+                                                                file_extension=settings.ENCRYPTED_FILE_EXTENSION):
+            decrypt_worker_pool.put_on_tasks_queue(encrypted_tar_filename)
+
+    logging.info("Decryption done")
@@ -0,0 +1,88 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import settings
+from libs import StateDB, get_s3_client, s3_bucket_exists
+
+
+def delete(all: bool,
+           bucket: str,
+           files: list[str],
+           dry_run: bool,
+           db_filename: str):
+    # NOTE: Nothing is sent to S3 in dry run
+    if not dry_run and not s3_bucket_exists(bucket):
+        logging.error(f"The bucket with name '{bucket}' doesn't exist in S3 server!")
+        exit(1)
+
+    with StateDB(db_filename) as state_db:
+        match all:
+            case True:
+                if dry_run:
+                    result = 'Y'    # NOTE: Nothing will be deleted so no need to confirm
+                else:
+                    result = input("Are you sure you want to delete all backed up files? "\
+                                   "(NOTE: Bucket itself must be delete using AWS Console) (Y/n) ")
+                match result:
+                    case 'Y':
+                        _delete(state_db,
+                                bucket,
+                                state_db.get_already_uploaded_tar_files(),
+                                dry_run)
+
+                    case _:
+                        logging.info("Aborted as 'Y' input was not received!")
+
+            case False:
+                _delete(state_db, bucket, set(files), dry_run)
+
+
+def _delete(state_db: StateDB, bucket: str, tar_files: set[str], dry_run: bool=False):
+    # Delete TAR files using 'DeleteObjects' requests of up to 1000 keys with several requests in flight
+    sorted_tar_files = sorted(tar_files)
+    batches = [sorted_tar_files[i:(i + settings.MAX_KEYS_PER_DELETE_REQUEST)]
+               for i in range(0, len(sorted_tar_files), settings.MAX_KEYS_PER_DELETE_REQUEST)]
+
+    if dry_run:
+        for tar_file in sorted_tar_files:
+            logging.info(f"Would delete '{tar_file}'.")
+        logging.info(f"Would delete {len(sorted_tar_files)} file(s) from bucket '{bucket}' "\
+                     f"using {len(batches)} 'DeleteObjects' request(s) and delete their records in state DB.")
+        return
+
+    s3_client = get_s3_client()
+
+    num_deleted_tar_files = 0
+    with ThreadPoolExecutor(max_workers=settings.NUM_S3_REQUEST_WORKERS,
+                            thread_name_prefix='s3-glacier-backup-delete') as thread_pool:
+        batch_futures = {thread_pool.submit(_delete_batch, s3_client, bucket, batch): batch for batch in batches}
+        for batch_future in as_completed(batch_futures):
+            batch = batch_futures[batch_future]
+            try:
+                batch_deleted_tar_files, batch_errors = batch_future.result()
+
+            except Exception as ex:
+                # NOTE: Other batches are still deleted and recorded
+                logging.error(f"Failed to delete {len(batch)} file(s) from '{batch[0]}' to '{batch[-1]}' with '{repr(ex)}'!")
+                continue
+
+            # CAUTION: Deletions of each batch are recorded in state DB as soon as it's done so that they aren't
+            #          lost if this process is stopped while other batches are still being deleted
+            state_db.delete_work_records(batch_deleted_tar_files)
+            num_deleted_tar_files += len(batch_deleted_tar_files)
+            for tar_file in batch_deleted_tar_files:
+                logging.info(f"'{tar_file}' deleted!")
+            for error in batch_errors:
+                logging.error(f"Failed to delete file '{error['Key']}' with '{error.get('Code')}: {error.get('Message')}'! "\
+                              "Please check that such a file and containing bucket exists.")
+
+    logging.info(f"Deletion done with {num_deleted_tar_files} of {len(sorted_tar_files)} file(s) deleted")
+
+def _delete_batch(s3_client, bucket: str, tar_files: list[str]) -> tuple[list[str], list[dict]]:   # CAUTION: Runs in worker thread
+    logging.info(f"Trying to delete {len(tar_files)} file(s) from '{tar_files[0]}' to '{tar_files[-1]}'...")
+    response = s3_client.delete_objects(Bucket=bucket,
+                                        Delete={'Objects': [{'Key': tar_file} for tar_file in tar_files],
+                                                'Quiet': True})     # NOTE: Only keys that failed to be deleted are reported
+    errors = response.get('Errors', [])
+    failed_tar_files = {error['Key'] for error in errors}
+    return [tar_file for tar_file in tar_files if tar_file not in failed_tar_files], errors
@@ -0,0 +1,21 @@
+import logging
+from contextlib import ExitStack
+
+from utils import *
+from libs import StateDB
+
+
+def merge(db_filename: str):
+    # NOTE: Sharded backups merge their shard state DBs when all shards are done so this is only needed
+    # to see what shards have backed up so far (eg: while backup is running or after a shard failed)
+    shard_db_filenames = get_shard_db_filenames(db_filename)
+    if not shard_db_filenames:
+        logging.error(f"No shard state DBs of '{db_filename}' were found!")
+        exit(1)
+
+    with StateDB(db_filename) as state_db, ExitStack() as shard_state_dbs_stack:
+        shard_state_dbs = [shard_state_dbs_stack.enter_context(StateDB(shard_db_filename)) for shard_db_filename in shard_db_filenames]
+        logging.info(f"Merging {len(shard_state_dbs)} shard state DB(s) into '{db_filename}'...")
+        state_db.record_merged_state_dbs(shard_state_dbs)
+
+    logging.info("Merge done")
@@ -0,0 +1,105 @@
+import json
+import math
+import logging
+from datetime import datetime
+from collections import defaultdict
+
+from rich import print
+from rich.table import Table
+
+import settings
+from utils import *
+from consts import S3_RESTORE_TIER_HOURS
+from libs import StateDB
+
+
+def plan(paths: list[str] | None,
+         modified_after: datetime | None,
+         modified_before: datetime | None,
+         tier: str,
+         db_filename: str,
+         plan_filename: str):
+    with StateDB(db_filename) as state_db:
+        file_records = state_db.get_uploaded_file_records(paths,
+                                                          modified_after.timestamp() if modified_after else None,
+                                                          modified_before.timestamp() if modified_before else None)
+        tar_file_sizes = state_db.get_tar_file_sizes()
+        # NOTE: State DBs from older versions don't record TAR file sizes so estimate them from sizes of their files
+        tar_file_sizes = state_db.get_tar_file_contents_sizes() | tar_file_sizes
+
+    if not file_records:
+        logging.warning("No uploaded files match the given paths and dates!")
+        return
+
+    # CAUTION: Glacier restores whole TAR files as byte ranges within archived objects can't be restored,
+    # so the cheapest plan is the smallest total size of TAR files that together hold all needed files
+    needed_tar_files = _get_min_size_tar_files(file_records, tar_file_sizes)
+    needed_files = defaultdict(list)
+    for filename, tar_file, _ in file_records:
+        if tar_file in needed_tar_files:
+            needed_files[tar_file].append(filename)
+
+    num_needed_files = len({filename for filename, _, _ in file_records})
+    needed_files_size = sum(size for _, tar_file, size in file_records if tar_file in needed_tar_files)
+    retrieval_size = sum(tar_file_sizes[tar_file] for tar_file in needed_tar_files)
+    num_restore_requests = len(needed_tar_files)
+    num_get_requests = sum(max(math.ceil(tar_file_sizes[tar_file] / settings.DOWNLOAD_CHUNK_SIZE_BYTES), 1) for tar_file in needed_tar_files)
+    price_per_GB, price_per_1000_requests = settings.RESTORE_PRICES_USD[tier]
+    retrieval_GBs = retrieval_size / GB_to_bytes(1)
+    cost_usd = retrieval_GBs * (price_per_GB + settings.DOWNLOAD_PRICE_USD_PER_GB) + num_restore_requests / 1000 * price_per_1000_requests
+    download_hours = retrieval_size / settings.ESTIMATED_DOWNLOAD_BYTES_PER_SEC / 3600
+
+    with open(plan_filename, mode='w') as plan_file:
+        json.dump({'db_filename': db_filename,
+                   'datetime': str(datetime.now().astimezone()),
+                   'tier': tier,
+                   'retrieval_size': retrieval_size,
+                   'num_restore_requests': num_restore_requests,
+                   'num_get_requests': num_get_requests,
+                   'restore_hours': S3_RESTORE_TIER_HOURS[tier],
+                   'download_hours': round(download_hours, 1),
+                   'cost_usd': round(cost_usd, 2),
+                   'tar_files': [{'tar_file': tar_file,
+                                  'size': tar_file_sizes[tar_file],
+                                  'files': needed_files[tar_file]} for tar_file in needed_tar_files]},
+                  plan_file,
+                  indent=2)
+
+    table = Table(title="Retrieval Plan")
+    for header in ['tar_file', 'size', 'needed_files']:
+        table.add_column(header, justify='center')
+    for tar_file in needed_tar_files:
+        table.add_row(tar_file, prettyFilesize(tar_file_sizes[tar_file]), str(len(needed_files[tar_file])))
+
+    print()
+    print(table)
+    print(f"{num_needed_files} file(s) ({prettyFilesize(needed_files_size)}) need {len(needed_tar_files)} TAR file(s) "\
+          f"({prettyFilesize(retrieval_size)}) to be retrieved using {num_restore_requests} restore and about {num_get_requests} GET requests.")
+    print(f"'{tier}' restore should take up to {S3_RESTORE_TIER_HOURS[tier]} hours and downloading about {download_hours:.1f} hours "\
+          f"costing about ${cost_usd:.2f} USD (see 'RESTORE_PRICES_USD' in 'settings.py').")
+    print(f"Plan saved to '{plan_filename}'. Use 'retrieve --plan' to carry it out.")
+    print()
+
+
+def _get_min_size_tar_files(file_records: list[tuple[str, str, int]], tar_file_sizes: dict[str, int]) -> list[str]:
+    # Returns TAR files with the least total size that hold all files in 'file_records'.
+    # NOTE: A file is usually in only one TAR file but can be in several if it was backed up again
+    # (eg: after 'sync' marked its TAR file failed), in which case TAR files are greedily chosen.
+    filename_tar_files = defaultdict(set)
+    for filename, tar_file, _ in file_records:
+        filename_tar_files[filename].add(tar_file)
+
+    needed_tar_files = {next(iter(tar_files)) for tar_files in filename_tar_files.values() if len(tar_files) == 1}
+    remaining_filenames = {filename for filename, tar_files in filename_tar_files.items() if not (tar_files & needed_tar_files)}
+    while remaining_filenames:
+        num_remaining_files_in_tar_file = defaultdict(int)
+        for filename in remaining_filenames:
+            for tar_file in filename_tar_files[filename]:
+                num_remaining_files_in_tar_file[tar_file] += 1
+
+        tar_file = max(num_remaining_files_in_tar_file,
+                       key=lambda x: num_remaining_files_in_tar_file[x] / max(tar_file_sizes.get(x, 0), 1))
+        needed_tar_files.add(tar_file)
+        remaining_filenames = {filename for filename in remaining_filenames if tar_file not in filename_tar_files[filename]}
+
+    return sorted(needed_tar_files)
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import logging
+from time import sleep
+from http import HTTPStatus
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore.exceptions
+
+import settings
+from utils import *
+from consts import S3_ARCHIVE_STORAGE_CLASSES
+from libs import TaskType,\
+                RetrieveTaskStatus,\
+                WorkerPool,\
+                BufferPool,\
+                StateDB,\
+                get_s3_client,\
+                s3_bucket_exists
+
+
+def retrieve(bucket: str,
+             tier: str | None,
+             restore_days: int,
+             num_download_workers: int,
+             files: list[str] | None,
+             plan: str | None,
+             memory_budget: int,
+             transfer_engine: str,
+             db_filename: str,
+             tar_files_folder: str):
+    if not s3_bucket_exists(bucket):
+        logging.error(f"The bucket with name '{bucket}' doesn't exist in S3 server!")
+        exit(1)
+
+    if plan:
+        with open(plan, mode='r') as plan_file:
+            retrieval_plan = json.load(plan_file)
+        files = [plan_tar_file['tar_file'] for plan_tar_file in retrieval_plan['tar_files']]
+        tier = tier or retrieval_plan['tier']
+    tier = tier or settings.DEFAULT_RESTORE_TIER
+
+    with StateDB(db_filename) as state_db,\
+         BufferPool(MB_to_bytes(memory_budget)) as buffer_pool:
+        # Work out TAR files that still need to be retrieved. Progress is recorded in state DB
+        # so running this command again resumes from where it was left.
+        tar_files = sorted(set(files) if files else state_db.get_already_uploaded_tar_files())
+        retrieval_states = state_db.get_retrieval_states()
+        pending_tar_files: list[str] = []
+        for tar_file in tar_files:
+            tar_filename = os.path.join(tar_files_folder, tar_file)
+            if retrieval_states.get(tar_file) == RetrieveTaskStatus.DOWNLOADED and\
+                (os.path.isfile(tar_filename) or os.path.isfile(tar_filename.removesuffix(settings.ENCRYPTED_FILE_EXTENSION))):
+                logging.info(f"Skipping '{tar_file}' as it has already been downloaded.")
+            else:
+                pending_tar_files.append(tar_file)
+
+        s3_client = get_s3_client()
+
+        with WorkerPool(num_download_workers,
+                        TaskType.DOWNLOAD,
+                        False,
+                        state_db,
+                        s3_bucket_name=bucket,
+                        buffer_pool=buffer_pool,
+                        transfer_engine=transfer_engine) as download_worker_pool,\
+             ThreadPoolExecutor(max_workers=settings.NUM_S3_REQUEST_WORKERS,
+                                thread_name_prefix='s3-glacier-backup-restore') as thread_pool:
+            num_missing_tar_files = 0
+            for i in range(sys.maxsize):     # Basically infinite loop
+                if not pending_tar_files:
+                    break
+
+                if i > 0:
+                    # Wait for logarithmically longer minutes as restores from Glacier take hours
+                    wait_mins = logrithmic_scale_value(i - 1, *settings.RESTORE_CHECK_WAIT_TIME_RANGE_MINS)
+                    logging.info(f"{len(pending_tar_files)} TAR file(s) are still being restored. Will be checking again in {wait_mins} minutes.")
+                    sleep(mins_to_secs(wait_mins))
+
+                # Check restore status of all pending TAR files and request restore of those that need it
+                restore_states = list(thread_pool.map(partial(_get_restore_state, s3_client, bucket), pending_tar_files))
+                tar_files_to_request = [tar_file for tar_file, restore_state in zip(pending_tar_files, restore_states)
+                                        if restore_state is None]
+                restore_states = dict(zip(pending_tar_files, restore_states))
+                missing_tar_files = [tar_file for tar_file in pending_tar_files if restore_states[tar_file] == RetrieveTaskStatus.MISSING]
+                state_db.record_changed_retrieval_states(RetrieveTaskStatus.MISSING, missing_tar_files)
+                pending_tar_files = [tar_file for tar_file in pending_tar_files if restore_states[tar_file] != RetrieveTaskStatus.MISSING]
+                num_missing_tar_files += len(missing_tar_files)
+                for tar_file, restore_state in zip(tar_files_to_request,
+                                                   thread_pool.map(partial(_request_restore, s3_client, bucket, tier, restore_days),
+                                                                   tar_files_to_request)):
+                    restore_states[tar_file] = restore_state
+                state_db.record_changed_retrieval_states(RetrieveTaskStatus.REQUESTED,
+                                                         [tar_file for tar_file in tar_files_to_request
+                                                          if restore_states[tar_file] == RetrieveTaskStatus.REQUESTED])
+
+                # Download TAR files whose restored copies are ready
+                restored_tar_files = [tar_file for tar_file in pending_tar_files if restore_states[tar_file] == RetrieveTaskStatus.RESTORED]
+                state_db.record_changed_retrieval_states(RetrieveTaskStatus.RESTORED, restored_tar_files)
+                for restored_tar_file in restored_tar_files:
+                    download_worker_pool.put_on_tasks_queue(os.path.join(tar_files_folder, restored_tar_file))
+                pending_tar_files = [tar_file for tar_file in pending_tar_files if restore_states[tar_file] != RetrieveTaskStatus.RESTORED]
+
+            logging.info("All TAR files have been restored. Waiting for all downloads to complete...")
+
+    if num_missing_tar_files > 0:
+        logging.error(f"Retrieval done but {num_missing_tar_files} TAR file(s) were '{RetrieveTaskStatus.MISSING}' in S3 and couldn't be retrieved!")
+        exit(1)
+    logging.info("Retrieval done")
+
+
+def _get_restore_state(s3_client, bucket: str, tar_file: str) -> RetrieveTaskStatus | None:     # CAUTION: Runs in worker thread
+    # Returns None if restore needs to be requested (i.e. never requested or restored copy has expired)
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=tar_file)
+
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] in (str(HTTPStatus.NOT_FOUND.value), 'NoSuchKey'):
+            logging.error(f"'{tar_file}' was not found in S3 so it can't be retrieved!")
+            return RetrieveTaskStatus.MISSING
+        raise ex
+
+    if response.get('StorageClass') not in S3_ARCHIVE_STORAGE_CLASSES:
+        return RetrieveTaskStatus.RESTORED  # NOTE: Not archived (eg: '--test-run' backup) so can be downloaded right away
+
+    restore = response.get('Restore')
+    if not restore:
+        return None
+    return RetrieveTaskStatus.REQUESTED if 'ongoing-request="true"' in restore else RetrieveTaskStatus.RESTORED
+
+def _request_restore(s3_client, bucket: str, tier: str, restore_days: int, tar_file: str) -> RetrieveTaskStatus:    # CAUTION: Runs in worker thread
+    logging.info(f"Requesting '{tier}' restore of '{tar_file}' for {restore_days} days...")
+    try:
+        s3_client.restore_object(Bucket=bucket,
+                                 Key=tar_file,
+                                 RestoreRequest={'Days': restore_days, 'GlacierJobParameters': {'Tier': tier}})
+
+    except botocore.exceptions.ClientError as ex:
+        match ex.response['Error']['Code']:
+            case 'RestoreAlreadyInProgress':
+                pass
+            case 'InvalidObjectState':
+                return RetrieveTaskStatus.RESTORED  # NOTE: Object isn't archived so can be downloaded right away
+            case _:
+                raise ex
+
+    return RetrieveTaskStatus.REQUESTED
@@ -0,0 +1,93 @@
+import sys
+import csv
+import json
+import logging
+from typing import Any
+from datetime import datetime
+from collections.abc import Callable, Iterable, Sequence
+
+from rich import print
+from rich.table import Table
+
+from libs import UploadTaskStatus, StateDB
+
+
+def show(collate: int,
+         status: str | None,
+         limit: int | None,
+         offset: int,
+         output_format: str,
+         db_filename: str):
+    try:
+        with StateDB(db_filename) as state_db:
+            record_headers, work_records = state_db.get_work_records_with_headers(collate,
+                                                                                  UploadTaskStatus(status) if status else None,
+                                                                                  limit,
+                                                                                  offset)
+            _print_work_records("Backup Records",
+                                record_headers,
+                                work_records,
+                                output_format,
+                                state_db.process_collated_work_record if collate else state_db.process_work_record)
+
+    except ValueError:
+        logging.error(f"Corrupted state DB '{db_filename}'!")
+        exit(1)
+
+
+def find(query: str,
+         glob: bool,
+         min_size: int | None,
+         max_size: int | None,
+         modified_after: datetime | None,
+         modified_before: datetime | None,
+         limit: int | None,
+         output_format: str,
+         db_filename: str):
+    try:
+        with StateDB(db_filename) as state_db:
+            work_records = state_db.iter_found_work_records(query,
+                                                            glob,
+                                                            min_size,
+                                                            max_size,
+                                                            modified_after.timestamp() if modified_after else None,
+                                                            modified_before.timestamp() if modified_before else None,
+                                                            limit)
+            _print_work_records("Found Files",
+                                state_db.get_work_record_headers(),
+                                work_records,
+                                output_format,
+                                state_db.process_work_record)
+
+    except ValueError:
+        logging.error(f"Corrupted state DB '{db_filename}'!")
+        exit(1)
+
+
+def _print_work_records(title: str,
+                        record_headers: list[str],
+                        work_records: Iterable[Sequence[Any]],
+                        output_format: str,
+                        process_work_record: Callable[[Sequence[Any]], list[Any]]):
+    # NOTE: Records are written out as they are read for 'jsonl' and 'csv' formats so that they can be piped
+    match output_format:
+        case 'jsonl':
+            for record in work_records:
+                sys.stdout.write(json.dumps(dict(zip(record_headers, record))) + '\n')
+
+        case 'csv':
+            csv_writer = csv.writer(sys.stdout)
+            csv_writer.writerow(record_headers)
+            csv_writer.writerows(work_records)
+
+        case _:
+            table = Table(title=title)
+            for header in record_headers:
+                table.add_column(header, justify='center')
+
+            for record in work_records:
+                table.add_row(*[str(cell) for cell in process_work_record(record)])
+
+            print()
+            print(table)
+            print()
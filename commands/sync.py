@@ -0,0 +1,57 @@
+import os
+import re
+import logging
+
+from utils import *
+from libs import UploadTaskStatus, StateDB, s3_bucket_exists, list_objects_in_s3
+
+
+def sync(bucket: str, inventory_manifest: str | None, db_filename: str):
+    if not inventory_manifest and not s3_bucket_exists(bucket):
+        logging.error(f"The bucket with name '{bucket}' doesn't exist in S3 server!")
+        exit(1)
+
+    with StateDB(db_filename) as state_db:
+        cmd_args = state_db.get_last_cmd_args()
+        tar_filename_template = get_tar_filename_template(cmd_args['output_filename_template'], cmd_args['compression'], cmd_args['encrypt'])
+        tar_file_pattern = re.compile(rf"^\d{{3,}}_{re.escape(os.path.basename(tar_filename_template))}$")
+        expected_storage_class = 'STANDARD' if cmd_args['test_run'] else 'DEEP_ARCHIVE'
+
+        # NOTE: Whole bucket is listed (1000 objects per request) instead of checking each TAR file one by one
+        if inventory_manifest:
+            logging.info(f"Reading objects from S3 Inventory report '{inventory_manifest}'...")
+            s3_objects = listObjectsInS3Inventory(inventory_manifest)
+        else:
+            logging.info(f"Listing objects in S3 bucket '{bucket}'...")
+            s3_objects = list_objects_in_s3(bucket)
+
+        tar_file_sizes = state_db.get_tar_file_sizes()
+        failed_tar_files: list[str] = []
+        num_storage_class_mismatches = 0
+        for tar_file in sorted(state_db.get_already_uploaded_tar_files()):
+            if tar_file not in s3_objects:
+                logging.error(f"'{tar_file}' was not found in S3 so its state changed to '{UploadTaskStatus.FAILED}'!")
+                failed_tar_files.append(tar_file)
+                continue
+
+            size, storage_class = s3_objects[tar_file]
+            if tar_file in tar_file_sizes and size != tar_file_sizes[tar_file]:
+                logging.error(f"'{tar_file}' is {size} bytes in S3 but {tar_file_sizes[tar_file]} bytes were packaged "\
+                              f"so its state changed to '{UploadTaskStatus.FAILED}'!")
+                failed_tar_files.append(tar_file)
+                continue
+
+            if storage_class != expected_storage_class:
+                logging.warning(f"'{tar_file}' has storage class '{storage_class}' in S3 instead of '{expected_storage_class}'!")
+                num_storage_class_mismatches += 1
+
+        state_db.record_changed_work_states(UploadTaskStatus.FAILED, failed_tar_files)
+
+        # Look for TAR files of this backup in S3 that state DB doesn't know about
+        known_tar_files = state_db.get_all_tar_files()
+        orphaned_tar_files = sorted(key for key in s3_objects if tar_file_pattern.match(key) and key not in known_tar_files)
+        for orphaned_tar_file in orphaned_tar_files:
+            logging.warning(f"'{orphaned_tar_file}' was found in S3 but has no record in state DB!")
+
+    logging.info(f"Sync done with {len(failed_tar_files)} TAR file(s) marked '{UploadTaskStatus.FAILED}', "\
+                 f"{num_storage_class_mismatches} storage class mismatch(es) and {len(orphaned_tar_files)} orphaned TAR file(s)")
@@ -0,0 +1,101 @@
+import logging
+from http import HTTPStatus
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore.exceptions
+
+import settings
+from utils import *
+from libs import UploadTaskStatus,\
+                VerifyTaskStatus,\
+                StateDB,\
+                get_s3_client,\
+                s3_bucket_exists
+
+
+def verify(bucket: str, files: list[str] | None, db_filename: str):
+    if not s3_bucket_exists(bucket):
+        logging.error(f"The bucket with name '{bucket}' doesn't exist in S3 server!")
+        exit(1)
+
+    with StateDB(db_filename) as state_db:
+        tar_files = sorted(set(files) if files else state_db.get_already_uploaded_tar_files())
+        tar_file_sizes = state_db.get_tar_file_sizes()
+        part_checksums = state_db.get_all_part_checksums()
+
+        # NOTE: Only metadata of TAR files is requested so nothing needs to be restored or downloaded
+        logging.info(f"Verifying {len(tar_files)} TAR file(s) in S3 bucket '{bucket}'...")
+        s3_client = get_s3_client()
+        with ThreadPoolExecutor(max_workers=settings.NUM_S3_REQUEST_WORKERS,
+                                thread_name_prefix='s3-glacier-backup-verify') as thread_pool:
+            verify_states = dict(zip(tar_files, thread_pool.map(partial(_verify_tar_file, s3_client, bucket, tar_file_sizes, part_checksums),
+                                                                tar_files)))
+
+        for verify_state in VerifyTaskStatus:
+            state_db.record_changed_verification_states(verify_state,
+                                                        [tar_file for tar_file in tar_files if verify_states[tar_file] == verify_state])
+
+        # Files of TAR files that failed verification are backed up again by next 'resume'
+        failed_tar_files = [tar_file for tar_file in tar_files if verify_states[tar_file] == VerifyTaskStatus.FAILED]
+        state_db.record_changed_work_states(UploadTaskStatus.FAILED, failed_tar_files)
+
+    num_verified_tar_files = sum(1 for verify_state in verify_states.values() if verify_state == VerifyTaskStatus.VERIFIED)
+    logging.info(f"Verification done with {num_verified_tar_files} TAR file(s) '{VerifyTaskStatus.VERIFIED}', "\
+                 f"{len(failed_tar_files)} '{VerifyTaskStatus.FAILED}' and {len(tar_files) - num_verified_tar_files - len(failed_tar_files)} "\
+                 f"'{VerifyTaskStatus.UNVERIFIED}'")
+    if failed_tar_files:
+        logging.info(f"Use 'resume' to backup files of '{VerifyTaskStatus.FAILED}' TAR files again.")
+
+
+def _verify_tar_file(s3_client,
+                     bucket: str,
+                     tar_file_sizes: dict[str, int],
+                     part_checksums: dict[str, tuple[int, bytes]],
+                     tar_file: str) -> VerifyTaskStatus:    # CAUTION: Runs in worker thread
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=tar_file, ChecksumMode='ENABLED')
+
+    except botocore.exceptions.ClientError as ex:
+        # NOTE: Error code of 'HEAD' requests is their HTTP status code (as they have no body) but S3 compatible servers may return others
+        if ex.response['Error']['Code'] in (str(HTTPStatus.NOT_FOUND.value), 'NoSuchKey'):
+            logging.error(f"'{tar_file}' was not found in S3 so its state changed to '{UploadTaskStatus.FAILED}'!")
+            return VerifyTaskStatus.FAILED
+
+        # CAUTION: Other errors (eg: access denied or throttling) don't mean TAR file is bad so it's left unverified
+        logging.error(f"Failed to verify '{tar_file}' with '{repr(ex)}'!")
+        return VerifyTaskStatus.UNVERIFIED
+
+    except botocore.exceptions.BotoCoreError as ex:
+        logging.error(f"Failed to verify '{tar_file}' with '{repr(ex)}'!")
+        return VerifyTaskStatus.UNVERIFIED
+
+    size = tar_file_sizes.get(tar_file)
+    if size is not None and response['ContentLength'] != size:
+        logging.error(f"'{tar_file}' is {response['ContentLength']} bytes in S3 but {size} bytes were packaged "\
+                      f"so its state changed to '{UploadTaskStatus.FAILED}'!")
+        return VerifyTaskStatus.FAILED
+
+    if size is None or tar_file not in part_checksums:
+        logging.warning(f"'{tar_file}' has no checksum recorded in state DB (i.e. it was packed by an older version) so it can't be verified!")
+        return VerifyTaskStatus.UNVERIFIED
+
+    s3_checksum = response.get('ChecksumSHA256')
+    if not s3_checksum:
+        logging.warning(f"'{tar_file}' has no SHA-256 checksum in S3 so it can't be verified!")
+        return VerifyTaskStatus.UNVERIFIED
+
+    # NOTE: Checksum of TAR files uploaded in parts is followed by number of parts (eg: '...=-4') in S3 but
+    # not in some S3 compatible servers. It is only comparable if it was uploaded in the expected parts.
+    checksum, _, num_parts = get_s3_checksum(size, *part_checksums[tar_file]).partition('-')
+    s3_checksum, _, s3_num_parts = s3_checksum.partition('-')
+    if s3_num_parts and s3_num_parts != num_parts:
+        logging.warning(f"'{tar_file}' was uploaded in {s3_num_parts} parts instead of {num_parts or 1} so its checksum can't be verified!")
+        return VerifyTaskStatus.UNVERIFIED
+
+    if s3_checksum != checksum:
+        logging.error(f"'{tar_file}' has checksum '{s3_checksum}' in S3 but '{checksum}' was packaged "\
+                      f"so its state changed to '{UploadTaskStatus.FAILED}'!")
+        return VerifyTaskStatus.FAILED
+
+    return VerifyTaskStatus.VERIFIED
@@ -0,0 +1,42 @@
+import logging
+
+import settings
+from utils import *
+from libs import StateDB, ChangeJournal, InotifyWatcher
+
+
+def watch(db_filename: str):
+    # Runs until stopped (eg: as a service), journaling folders in which files changed so that 'resume' only walks those
+    with StateDB(db_filename) as state_db:
+        cmd_args = state_db.get_last_cmd_args()
+
+    # NOTE: Backing up with these always walks source folders fully
+    if cmd_args.get('num_shard_processes') or cmd_args.get('locality_order'):
+        logging.error("Changes in source folders of sharded backups or backups with locality order can't be journaled!")
+        exit(1)
+
+    journal_filename = get_journal_filename(db_filename)
+    with ChangeJournal(journal_filename) as change_journal:
+        if not change_journal.lock():
+            logging.error(f"Source folders of '{db_filename}' are already being watched!")
+            exit(1)
+
+        try:
+            with InotifyWatcher(cmd_args['src_dirs']) as inotify_watcher:
+                # CAUTION: Session is only started once all folders are watched as changes before then might be missed
+                change_journal.start_session('started')
+                logging.info(f"Watching {inotify_watcher.get_num_watched_dirs()} folder(s) and journaling changes in '{journal_filename}'...")
+
+                for changed_dirs, overflowed in inotify_watcher.iter_changes(settings.WATCH_COMMIT_INTERVAL_SECS):
+                    if changed_dirs:
+                        change_journal.record_changed_dirs(changed_dirs)
+                    if overflowed:
+                        logging.warning("Some changes were lost as too many happened at once (see '/proc/sys/fs/inotify/max_queued_events') "\
+                                        "so source folders will be walked fully by next resume!")
+                        change_journal.start_session('overflowed')
+
+        except OSError as ex:
+            # NOTE: Source folders will be walked fully by next resume as 'watch' is no longer running
+            logging.error(f"Failed to watch source folders with '{repr(ex)}'! If there are too many folders to watch, "\
+                          "raise 'fs.inotify.max_user_watches' with 'sysctl'.")
+            exit(1)
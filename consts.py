@@ -1,3 +1,11 @@
 TAR_COMPRESSION_TYPES = ('gz', 'bz2', 'xz')
+S3_RESTORE_TIERS = ('Standard', 'Bulk')     # NOTE: 'Expedited' isn't supported by Glacier Deep Archive
+S3_ARCHIVE_STORAGE_CLASSES = ('GLACIER', 'DEEP_ARCHIVE')
+S3_RESTORE_TIER_HOURS = {'Standard': 12, 'Bulk': 48}     # NOTE: Restores from Glacier Deep Archive complete within these many hours
+S3_MAX_UPLOAD_PARTS = 10000     # NOTE: Most parts S3 allows an object to be uploaded in
+COMPRESSOR_MEM_SIZES = {'gz': 256 * 1024, 'bz2': 7600 * 1024, 'xz': 94 * 1024 * 1024}     # NOTE: Memory used by compressors at levels used (i.e. 9, 9 and 6)
+OUTPUT_FORMATS = ('table', 'jsonl', 'csv')
+PROFILE_MODES = ('sample', 'cprofile')
+TRANSFER_ENGINES = ('thread', 'asyncio')
 MAX_LINUX_PATH_LENGTH = 4096
 MAX_LINUX_FILENAME_LENGTH = 255
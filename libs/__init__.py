@@ -1,5 +1,33 @@
+import importlib
+
 from .common import *
-from .fileobjs import DecryptFileObj
-from .worker_pool import WorkerPool
-from .state_db import StateDB
-from .split_tarfiles import SplitTarFiles
+
+# NOTE: Everything else is imported on first use so that commands only import what they use
+# (eg: 'show' doesn't import 'boto3' and 'rich.progress' needed by 'WorkerPool')
+LAZY_IMPORTS = {
+    'DecryptFileObj': '.fileobjs',
+    'CompressFileObj': '.fileobjs',
+    'WorkerPool': '.worker_pool',
+    'AsyncTransfers': '.async_transfers',
+    'StateDB': '.state_db',
+    'SplitTarFiles': '.split_tarfiles',
+    'ReadAheadFiles': '.read_ahead',
+    'BloomFilter': '.bloom_filter',
+    'Metrics': '.metrics',
+    'Profiler': '.profiler',
+    'BufferPool': '.buffer_pool',
+    'StagingDirs': '.staging_dirs',
+    'LocalityOrder': '.locality_order',
+    'ShardUploadQueue': '.shard_upload_queue',
+    'ChangeJournal': '.change_journal',
+    'InotifyWatcher': '.inotify_watcher',
+    'get_s3_client': '.s3',
+    's3_bucket_exists': '.s3',
+    'list_objects_in_s3': '.s3',
+}
+
+
+def __getattr__(name: str):
+    if name not in LAZY_IMPORTS:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    return getattr(importlib.import_module(LAZY_IMPORTS[name], __name__), name)
@@ -0,0 +1,422 @@
+import os
+import ssl
+import base64
+import random
+import asyncio
+import hashlib
+from http import HTTPStatus
+from threading import Thread
+from functools import partial
+from contextlib import suppress
+from urllib.parse import urlsplit, urlencode, quote
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Callable, AsyncGenerator
+
+import boto3
+import botocore.auth
+import botocore.awsrequest
+import botocore.httpsession
+
+from .s3 import get_s3_client
+
+import settings
+from utils import PartChecksums, generate_random_name
+
+
+class _S3SigV4Auth(botocore.auth.S3SigV4Auth):
+    # NOTE: Request bodies are streamed from file after they are signed so SHA-256 digest of body, if known
+    # (eg: of a part worked out while packing), is signed instead of reading the body to work it out
+    def payload(self, request):
+        return request.context.get('payload_sha256', botocore.auth.UNSIGNED_PAYLOAD)
+
+
+class S3ResponseError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class S3RedirectError(S3ResponseError):
+    # Raised once requests to a bucket are redirected (eg: as it is in another region) so that request is sent again
+    pass
+
+
+class AsyncTransfers:
+    # Uploads and downloads files to/from S3 on an asyncio event loop run in a background thread so that many parts
+    # (i.e. part uploads and ranged downloads) can be in flight at once without a thread blocked on a socket for each.
+    # Parts are sent by a small HTTP/1.1 client on non-blocking sockets with requests signed by 'botocore', while the
+    # few other requests of a transfer (eg: to start and complete a multipart upload) are sent by the shared 'boto3'
+    # client. Those and file reads and writes are done by a small thread pool so that the event loop never blocks.
+    def __init__(self, max_bandwidth_bytes_per_sec: int | None=None):
+        self.s3_client = get_s3_client()
+        self.credentials = boto3.Session().get_credentials()
+        self.ssl_context = ssl.create_default_context(cafile=botocore.httpsession.DEFAULT_CA_BUNDLE)
+        self.bucket_urls: dict[str, tuple[str, str]] = {}      # bucket -> URL of bucket and region to sign requests for
+
+        self.max_bandwidth_bytes_per_sec = max_bandwidth_bytes_per_sec     # NOTE: Shared by all uploads and downloads
+        self.bandwidth_available_time = 0.0
+        self.requests_in_flight = asyncio.Semaphore(settings.ASYNC_MAX_REQUESTS_IN_FLIGHT)
+        self.idle_connections: dict[tuple[str, str, int | None], list[tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+
+        self.io_thread_pool = ThreadPoolExecutor(max_workers=settings.ASYNC_NUM_IO_THREADS,
+                                                 thread_name_prefix='s3-glacier-backup-transfer-io')
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.io_thread_pool)
+        self.loop_thread = Thread(target=self.loop.run_forever, name='s3-glacier-backup-transfers', daemon=True)
+        self.loop_thread.start()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.io_thread_pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _close(self) -> None:
+        # Cancels transfers still running (eg: on Ctrl+C) and closes connections kept open for reuse
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for idle_connections in self.idle_connections.values():
+            for _, writer in idle_connections:
+                writer.close()
+        self.idle_connections.clear()
+
+    def upload_file(self,
+                    filename: str,
+                    bucket: str,
+                    key: str,
+                    part_size: int,
+                    part_digests: bytes | None,
+                    storage_class: str | None,
+                    callback: Callable[[int], None],
+                    max_parts_in_flight: int) -> None:
+        # Blocks until file is uploaded in parts of 'part_size' with their SHA-256 checksums
+        # NOTE: Files smaller than a part are uploaded in a single request like 'boto3' does
+        asyncio.run_coroutine_threadsafe(self._upload_file(filename, bucket, key, part_size, part_digests, storage_class,
+                                                           callback, max_parts_in_flight), self.loop).result()
+
+    def download_file(self,
+                      bucket: str,
+                      key: str,
+                      filename: str,
+                      size: int,
+                      callback: Callable[[int], None],
+                      max_parts_in_flight: int) -> None:
+        # Blocks until file is downloaded in ranged GETs of 'DOWNLOAD_CHUNK_SIZE_BYTES'
+        # NOTE: Data is downloaded to a temporary file which is renamed once complete like 'boto3' does
+        asyncio.run_coroutine_threadsafe(self._download_file(bucket, key, filename, size, callback, max_parts_in_flight),
+                                         self.loop).result()
+
+    async def _upload_file(self,
+                           filename: str,
+                           bucket: str,
+                           key: str,
+                           part_size: int,
+                           part_digests: bytes | None,
+                           storage_class: str | None,
+                           callback: Callable[[int], None],
+                           max_parts_in_flight: int) -> None:
+        size = os.path.getsize(filename)
+        if part_digests is None:
+            # NOTE: TAR files packed by older versions have no checksums recorded so they are worked out here
+            part_checksums = PartChecksums(part_size)
+            await self.loop.run_in_executor(None, part_checksums.update_from_file, filename, size)
+            part_digests = part_checksums.get_part_digests()
+        digest_size = hashlib.sha256().digest_size
+        part_digests_list = [part_digests[i:i + digest_size] for i in range(0, len(part_digests), digest_size)]
+        storage_class_args = {'StorageClass': storage_class} if storage_class else {}
+
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            if size < part_size:
+                await self._request('PUT', bucket, key, {}, {'x-amz-checksum-sha256': base64.b64encode(part_digests_list[0]).decode(),
+                                                             **({'x-amz-storage-class': storage_class} if storage_class else {})},
+                                    part_digests_list[0], fd, 0, size, callback)
+                return
+
+            num_parts = (size + part_size - 1) // part_size
+            assert len(part_digests_list) == num_parts, f"'{filename}' has {len(part_digests_list)} part checksums but {num_parts} parts!"
+            upload_id = (await self.loop.run_in_executor(None, partial(self.s3_client.create_multipart_upload,
+                                                                       Bucket=bucket,
+                                                                       Key=key,
+                                                                       ChecksumAlgorithm='SHA256',
+                                                                       **storage_class_args)))['UploadId']
+            try:
+                parts_in_flight = asyncio.Semaphore(max_parts_in_flight)
+
+                async def upload_part(part_idx: int) -> dict[str, str | int]:
+                    part_checksum = base64.b64encode(part_digests_list[part_idx]).decode()
+                    async with parts_in_flight:
+                        response_headers = await self._request('PUT', bucket, key, {'partNumber': part_idx + 1, 'uploadId': upload_id},
+                                                               {'x-amz-checksum-sha256': part_checksum}, part_digests_list[part_idx],
+                                                               fd, part_idx * part_size, min(part_size, size - part_idx * part_size), callback)
+                    return {'PartNumber': part_idx + 1, 'ETag': response_headers['etag'], 'ChecksumSHA256': part_checksum}
+
+                parts = await self._gather([upload_part(part_idx) for part_idx in range(num_parts)])
+                await self.loop.run_in_executor(None, partial(self.s3_client.complete_multipart_upload,
+                                                              Bucket=bucket,
+                                                              Key=key,
+                                                              UploadId=upload_id,
+                                                              MultipartUpload={'Parts': parts}))
+
+            except BaseException:
+                # NOTE: Parts already uploaded are stored (and charged for) until their upload is aborted
+                with suppress(Exception):
+                    await self.loop.run_in_executor(None, partial(self.s3_client.abort_multipart_upload,
+                                                                  Bucket=bucket,
+                                                                  Key=key,
+                                                                  UploadId=upload_id))
+                raise
+
+        finally:
+            os.close(fd)
+
+    async def _download_file(self,
+                             bucket: str,
+                             key: str,
+                             filename: str,
+                             size: int,
+                             callback: Callable[[int], None],
+                             max_parts_in_flight: int) -> None:
+        temp_filename = f"{filename}.{generate_random_name()}"
+        fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            parts_in_flight = asyncio.Semaphore(max_parts_in_flight)
+
+            async def download_part(offset: int) -> None:
+                length = min(settings.DOWNLOAD_CHUNK_SIZE_BYTES, size - offset)
+                async with parts_in_flight:
+                    await self._request('GET', bucket, key, {}, {'Range': f'bytes={offset}-{offset + length - 1}'},
+                                        hashlib.sha256().digest(), fd, offset, length, callback)
+
+            await self._gather([download_part(offset) for offset in range(0, size, settings.DOWNLOAD_CHUNK_SIZE_BYTES)])
+
+        except BaseException:
+            os.close(fd)
+            os.remove(temp_filename)
+            raise
+
+        os.close(fd)
+        os.replace(temp_filename, filename)
+
+    @staticmethod
+    async def _gather(coroutines: list) -> list:
+        # Unlike 'asyncio.gather()', others are cancelled as soon as one fails
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                tasks = [task_group.create_task(coroutine) for coroutine in coroutines]
+        except ExceptionGroup as ex:
+            raise ex.exceptions[0]
+        return [task.result() for task in tasks]
+
+    async def _request(self,
+                       method: str,
+                       bucket: str,
+                       key: str,
+                       query: dict[str, str | int],
+                       headers: dict[str, str],
+                       payload_digest: bytes | None,
+                       fd: int,
+                       offset: int,
+                       length: int,
+                       callback: Callable[[int], None]) -> dict[str, str]:
+        # Sends 'length' bytes of file from 'offset' (for PUT) or writes as many bytes of response there (for GET)
+        # and returns response headers. Requests that fail with a network or server error are retried.
+        for i in range(settings.MAX_RETRY_ATTEMPTS):
+            num_bytes_transferred = [0]
+
+            def count_bytes_transferred(num_bytes: int) -> None:
+                num_bytes_transferred[0] += num_bytes
+                callback(num_bytes)
+
+            try:
+                async with self.requests_in_flight:
+                    return await self._send_request(method, bucket, key, query, headers, payload_digest, fd, offset, length,
+                                                    count_bytes_transferred)
+
+            except (OSError, EOFError, S3ResponseError) as ex:
+                callback(-num_bytes_transferred[0])     # NOTE: Request is sent again from its start
+                if isinstance(ex, S3RedirectError) and i < settings.MAX_RETRY_ATTEMPTS - 1:
+                    continue
+                if (isinstance(ex, S3ResponseError) and ex.status < 500 and ex.status != 429) or i == settings.MAX_RETRY_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(random.uniform(0, min(2 ** i, settings.ASYNC_MAX_RETRY_WAIT_SECS)))     # NOTE: Exponential backoff with jitter
+
+    async def _send_request(self,
+                            method: str,
+                            bucket: str,
+                            key: str,
+                            query: dict[str, str | int],
+                            headers: dict[str, str],
+                            payload_digest: bytes | None,
+                            fd: int,
+                            offset: int,
+                            length: int,
+                            callback: Callable[[int], None]) -> dict[str, str]:
+        bucket_url, region_name = self._get_bucket_url(bucket)
+        url = f"{bucket_url}/{quote(key, safe='/~')}" + (f"?{urlencode(query, quote_via=quote)}" if query else '')
+        url_parts = urlsplit(url)
+        request = botocore.awsrequest.AWSRequest(method=method, url=url, headers={'Host': url_parts.netloc, **headers})
+        if method == 'PUT':
+            request.headers['Content-Length'] = str(length)
+        if payload_digest is not None:
+            request.context['payload_sha256'] = payload_digest.hex()
+        _S3SigV4Auth(self.credentials.get_frozen_credentials(), 's3', region_name).add_auth(request)
+
+        reader, writer = await self._get_connection(url_parts.scheme, url_parts.hostname, url_parts.port)
+        try:
+            request_head = f"{method} {url_parts.path}{'?' + url_parts.query if url_parts.query else ''} HTTP/1.1\r\n" +\
+                           ''.join(f"{name}: {value}\r\n" for name, value in request.headers.items()) + "\r\n"
+            writer.write(request_head.encode('latin-1'))
+
+            # Stream body from file in chunks so that only a chunk per request is in memory
+            num_bytes_sent = 0
+            while method == 'PUT' and num_bytes_sent < length:
+                data = await self.loop.run_in_executor(None, os.pread, fd, min(settings.ASYNC_IO_CHUNK_SIZE_BYTES, length - num_bytes_sent),
+                                                       offset + num_bytes_sent)
+                if not data:
+                    raise EOFError(f"File to upload to '{key}' is smaller than expected!")
+                await self._limit_bandwidth(len(data))
+                writer.write(data)
+                await asyncio.wait_for(writer.drain(), settings.ASYNC_SOCKET_TIMEOUT_SECS)
+                num_bytes_sent += len(data)
+                callback(len(data))
+            await asyncio.wait_for(writer.drain(), settings.ASYNC_SOCKET_TIMEOUT_SECS)
+
+            status, response_headers = await asyncio.wait_for(self._read_response_head(reader), settings.ASYNC_SOCKET_TIMEOUT_SECS)
+            if method == 'GET' and status in [200, 206]:
+                num_bytes_received = 0
+                async for data in self._iter_response_body(reader, response_headers):
+                    await self._limit_bandwidth(len(data))
+                    await self.loop.run_in_executor(None, os.pwrite, fd, data, offset + num_bytes_received)
+                    num_bytes_received += len(data)
+                    callback(len(data))
+                if num_bytes_received != length:
+                    raise EOFError(f"Only {num_bytes_received} of {length} bytes of '{key}' were received!")
+            else:
+                response_body = b''.join([data async for data in self._iter_response_body(reader, response_headers)])
+                if status != 200:
+                    message = f"S3 responded to {method} of '{key}' with status {status} and '{response_body.decode('utf-8', 'replace')}'!"
+                    if await self._redirect_bucket(bucket, key, (bucket_url, region_name), status, response_headers):
+                        raise S3RedirectError(status, message)
+                    raise S3ResponseError(status, message)
+
+        except BaseException:
+            writer.close()
+            raise
+
+        if response_headers.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            self.idle_connections[(url_parts.scheme, url_parts.hostname, url_parts.port)].append((reader, writer))
+        return response_headers
+
+    def _get_bucket_url(self, bucket: str) -> tuple[str, str]:
+        # NOTE: Like with 'boto3', virtual-hosted style URLs (i.e. 'https://<bucket>.s3.amazonaws.com') are used unless bucket
+        # name isn't a valid host name, a custom endpoint (eg: Minio) is used or path style is configured in '~/.aws'
+        if bucket not in self.bucket_urls:
+            self.bucket_urls[bucket] = (AsyncTransfers._resolve_bucket_url(self.s3_client, bucket), self.s3_client.meta.region_name)
+        return self.bucket_urls[bucket]
+
+    async def _redirect_bucket(self,
+                               bucket: str,
+                               key: str,
+                               sent_to: tuple[str, str],
+                               status: int,
+                               response_headers: dict[str, str]) -> bool:
+        # Returns if request sent to URL of bucket and signed for region in 'sent_to' is to be sent elsewhere like 'boto3'
+        # does when S3 redirects requests. S3 responds with region of bucket to requests sent to (or signed for) another
+        # region and with where to send them for a while to requests sent to a bucket just created in another region.
+        # NOTE: Other requests to bucket in flight at the time are redirected to the same place
+        bucket_url, region_name = sent_to
+        if status == HTTPStatus.TEMPORARY_REDIRECT and 'location' in response_headers:
+            location_parts = urlsplit(response_headers['location'])
+            bucket_url = f"{location_parts.scheme}://{location_parts.netloc}" +\
+                         location_parts.path.removesuffix(f"/{quote(key, safe='/~')}").rstrip('/')
+            region_name = response_headers.get('x-amz-bucket-region', region_name)
+        elif status in [HTTPStatus.MOVED_PERMANENTLY, HTTPStatus.BAD_REQUEST] and \
+             response_headers.get('x-amz-bucket-region', region_name) != region_name:
+            region_name = response_headers['x-amz-bucket-region']
+            s3_client = await self.loop.run_in_executor(None, partial(boto3.Session().client,
+                                                                      's3',
+                                                                      region_name=region_name,
+                                                                      config=self.s3_client.meta.config))
+            bucket_url = AsyncTransfers._resolve_bucket_url(s3_client, bucket)
+
+        if (bucket_url, region_name) == sent_to:
+            return False
+        self.bucket_urls[bucket] = (bucket_url, region_name)
+        return True
+
+    @staticmethod
+    def _resolve_bucket_url(s3_client, bucket: str) -> str:
+        # NOTE: 'botocore' works out URL of bucket when presigning a request to it (which doesn't send it)
+        object_url = s3_client.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': '_'})
+        return urlsplit(object_url)._replace(query='').geturl().removesuffix('/_')
+
+    async def _get_connection(self, scheme: str, host: str, port: int | None) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        # Reuses a connection to host kept open (i.e. HTTP keep-alive) unless server has closed it since
+        idle_connections = self.idle_connections.setdefault((scheme, host, port), [])
+        while idle_connections:
+            reader, writer = idle_connections.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+
+        ssl_context = self.ssl_context if scheme == 'https' else None
+        return await asyncio.wait_for(asyncio.open_connection(host, port or (443 if ssl_context else 80), ssl=ssl_context,
+                                                              limit=settings.ASYNC_IO_CHUNK_SIZE_BYTES),
+                                      settings.ASYNC_SOCKET_TIMEOUT_SECS)
+
+    async def _limit_bandwidth(self, num_bytes: int) -> None:
+        # Waits until sending or receiving 'num_bytes' more keeps all transfers within bandwidth limit
+        if self.max_bandwidth_bytes_per_sec:
+            now = self.loop.time()
+            self.bandwidth_available_time = max(self.bandwidth_available_time, now) + num_bytes / self.max_bandwidth_bytes_per_sec
+            await asyncio.sleep(self.bandwidth_available_time - now)
+
+    @staticmethod
+    async def _read_response_head(reader: asyncio.StreamReader) -> tuple[int, dict[str, str]]:
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection was closed by S3 server!")
+        status = int(status_line.split(maxsplit=2)[1])
+
+        response_headers: dict[str, str] = {}
+        while (header_line := await reader.readline()) not in [b'\r\n', b'\n', b'']:
+            name, _, value = header_line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        return status, response_headers
+
+    @staticmethod
+    async def _iter_response_body(reader: asyncio.StreamReader, response_headers: dict[str, str]) -> AsyncGenerator[bytes]:
+        # Yields body in chunks whether it is sent with its length or in chunked transfer encoding
+        async def read_chunks(size: int) -> AsyncGenerator[bytes]:
+            while size > 0:
+                data = await asyncio.wait_for(reader.read(min(size, settings.ASYNC_IO_CHUNK_SIZE_BYTES)), settings.ASYNC_SOCKET_TIMEOUT_SECS)
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', size)
+                size -= len(data)
+                yield data
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            while chunk_size := int((await asyncio.wait_for(reader.readline(), settings.ASYNC_SOCKET_TIMEOUT_SECS)).split(b';')[0], 16):
+                async for data in read_chunks(chunk_size):
+                    yield data
+                await reader.readexactly(2)     # NOTE: CRLF after chunk
+            while (await reader.readline()) not in [b'\r\n', b'\n', b'']:   # NOTE: Trailers, if any
+                pass
+        else:
+            async for data in read_chunks(int(response_headers.get('content-length', 0))):
+                yield data
@@ -0,0 +1,28 @@
+import math
+from hashlib import blake2b
+
+
+class BloomFilter:
+    # Compact set of strings that can tell for sure if a string was NOT added but
+    # might wrongly say that a string was added with probability 'false_positive_rate'
+    def __init__(self, max_num_items: int, false_positive_rate: float):
+        assert 0.0 < false_positive_rate < 1.0
+        max_num_items = max(max_num_items, 1)
+        self.num_bits = max(int(-max_num_items * math.log(false_positive_rate) / (math.log(2) ** 2)), 8)
+        self.num_hashes = max(round(self.num_bits / max_num_items * math.log(2)), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[bit_idx >> 3] & (1 << (bit_idx & 7)) for bit_idx in self._get_bit_idxs(item))
+
+    def add(self, item: str) -> None:
+        for bit_idx in self._get_bit_idxs(item):
+            self.bits[bit_idx >> 3] |= (1 << (bit_idx & 7))
+
+    def _get_bit_idxs(self, item: str) -> list[int]:
+        # NOTE: Bit indexes are derived from two halves of a single hash (i.e. double hashing)
+        # which is as good as using 'num_hashes' different hashes
+        digest = blake2b(item.encode('utf-8', errors='surrogateescape'), digest_size=16).digest()
+        hash1, hash2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return [(hash1 + i * hash2) % self.num_bits for i in range(self.num_hashes)]
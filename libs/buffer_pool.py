@@ -0,0 +1,112 @@
+import logging
+from threading import Condition
+from contextlib import contextmanager
+from collections.abc import Generator
+
+import settings
+from utils import prettyFilesize
+
+
+class BufferPool:
+    # Hands out reusable fixed-size buffers (eg: to encrypt and decrypt in) and reservations of memory for
+    # buffers allocated elsewhere (eg: by compressors, 'boto3' transfers and read-ahead) from a single memory
+    # budget. Callers wait while the budget is used up so memory used by buffers never goes over the budget
+    # no matter how many workers run.
+    def __init__(self, budget_size: int, buffer_size: int=settings.BUFFER_SIZE_BYTES):
+        self.budget_size = budget_size
+        self.buffer_size = min(buffer_size, budget_size)
+
+        self.condition = Condition()
+        self.used_size = 0          # NOTE: Includes free buffers kept for reuse
+        self.peak_used_size = 0
+        self.num_waiting = 0
+        self.free_buffers: list[bytearray] = []
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        with self.condition:
+            self.used_size -= len(self.free_buffers) * self.buffer_size
+            self.free_buffers.clear()
+        logging.info(f"Peak memory used by buffers was {prettyFilesize(self.peak_used_size)} of {prettyFilesize(self.budget_size)} budget.")
+
+    def acquire_buffer(self) -> bytearray:
+        with self.condition:
+            self.num_waiting += 1
+            try:
+                while not self.free_buffers and self.used_size + self.buffer_size > self.budget_size:
+                    self.condition.wait()
+            finally:
+                self.num_waiting -= 1
+
+            if self.free_buffers:
+                return self.free_buffers.pop()
+            self._use(self.buffer_size)
+
+        return bytearray(self.buffer_size)
+
+    def release_buffer(self, buffer: bytearray) -> None:
+        assert len(buffer) == self.buffer_size
+        with self.condition:
+            self.free_buffers.append(buffer)
+            self.condition.notify_all()
+
+    def reserve(self, size: int) -> int:
+        # Returns size actually reserved which must later be released
+        # NOTE: Reservations larger than the budget wait for all of it to be free and take all of it
+        size = min(size, self.budget_size)
+        with self.condition:
+            self.num_waiting += 1
+            try:
+                while self.used_size + size > self.budget_size:
+                    if self.free_buffers:
+                        # Free buffers kept for reuse are given up to make room
+                        self.free_buffers.pop()
+                        self.used_size -= self.buffer_size
+                    else:
+                        self.condition.wait()
+            finally:
+                self.num_waiting -= 1
+
+            self._use(size)
+        return size
+
+    def try_reserve(self, size: int) -> bool:
+        # Like 'reserve()' but gives up instead of waiting. Also gives up while anyone is waiting
+        # so that callers which can do without memory (eg: read-ahead) don't starve those who can't.
+        with self.condition:
+            if self.num_waiting > 0 or self.used_size + size > self.budget_size:
+                return False
+            self._use(size)
+        return True
+
+    def release(self, size: int) -> None:
+        with self.condition:
+            self.used_size -= size
+            self.condition.notify_all()
+
+    @contextmanager
+    def buffer(self) -> Generator[bytearray]:
+        buffer = self.acquire_buffer()
+        try:
+            yield buffer
+        finally:
+            self.release_buffer(buffer)
+
+    @contextmanager
+    def reserved(self, size: int) -> Generator[None]:
+        size = self.reserve(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def _use(self, size: int) -> None:
+        # CAUTION: Must be called with 'self.condition' held
+        self.used_size += size
+        self.peak_used_size = max(self.peak_used_size, self.used_size)
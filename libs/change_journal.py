@@ -0,0 +1,170 @@
+import os
+import fcntl
+import logging
+import sqlite3
+from datetime import datetime, timezone
+
+from utils import *
+from consts import MAX_LINUX_PATH_LENGTH
+
+from .state_db import StateDB
+
+
+class ChangeJournal:
+    # Journal kept by 'watch' next to a state DB of folders in which files changed since source folders were last walked
+    # so that resuming the backup only walks those. It can only be used if 'watch' has been running without losing any
+    # events since before the last walk. So each time 'watch' starts or the kernel drops events, a new session is started
+    # and walks (i.e. successful backups) are recorded with the session they started in. Backup walks source folders fully
+    # if the session changed since the last walk or 'watch' isn't running (i.e. it doesn't hold the lock on the journal).
+    SESSIONS_TABLE_NAME = 'sessions'
+    CHANGED_DIRS_TABLE_NAME = 'changed_dirs'
+    WALKS_TABLE_NAME = 'walks'
+
+    def __init__(self, journal_filename: str):
+        self.journal_filename = journal_filename
+        self.lock_fd: int | None = None
+        self.walk_start: tuple[int, int] | None = None      # NOTE: Session and last change recorded when walk started
+        self.last_change_id = 0
+
+        self.journal_db = sqlite3.connect(journal_filename, timeout=60, autocommit=True)
+        self.journal_db.execute("PRAGMA journal_mode=WAL;")     # NOTE: So that 'watch' and backup don't block each other
+        self.journal_db.executescript(f"CREATE TABLE IF NOT EXISTS {ChangeJournal.SESSIONS_TABLE_NAME} "\
+                                      "(id INTEGER PRIMARY KEY AUTOINCREMENT,"\
+                                      "datetime DATETIME,"\
+                                      "reason VARCHAR(16));"\
+
+                                      f"CREATE TABLE IF NOT EXISTS {ChangeJournal.CHANGED_DIRS_TABLE_NAME} "\
+                                      f"(dir NVARCHAR({MAX_LINUX_PATH_LENGTH}) PRIMARY KEY,"\
+                                      "recursive BOOLEAN,"\
+                                      "change_id INTEGER);"\
+
+                                      f"CREATE TABLE IF NOT EXISTS {ChangeJournal.WALKS_TABLE_NAME} "\
+                                      "(id INTEGER PRIMARY KEY CHECK (id=1),"\
+                                      "datetime DATETIME,"\
+                                      "session_id INTEGER,"\
+                                      "last_work_id INTEGER,"\
+                                      "num_work_records INTEGER);")
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self.journal_db:
+            self.journal_db.close()
+            self.journal_db = None
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)      # NOTE: Also releases lock
+            self.lock_fd = None
+
+    def lock(self) -> bool:
+        # Returns False if journal is already locked by another 'watch'
+        self.lock_fd = os.open(self.journal_filename, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+
+        except BlockingIOError:
+            return False
+
+    def is_watched(self) -> bool:
+        lock_fd = os.open(self.journal_filename, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False
+
+        except BlockingIOError:
+            return True
+
+        finally:
+            os.close(lock_fd)
+
+    def start_session(self, reason: str) -> None:
+        # NOTE: Changes are numbered in order over all sessions
+        self.last_change_id = self.journal_db.execute(f"SELECT MAX(change_id) FROM {ChangeJournal.CHANGED_DIRS_TABLE_NAME};").fetchone()[0] or 0
+        self.journal_db.execute(f"INSERT INTO {ChangeJournal.SESSIONS_TABLE_NAME} "\
+                                "(datetime, reason) VALUES "\
+                                f"('{datetime.now(timezone.utc)}', '{reason}');")
+
+    def record_changed_dirs(self, changed_dirs: dict[str, bool]) -> None:
+        # NOTE: Each folder is recorded once with its latest change so journal doesn't grow with number of changes
+        self.last_change_id += 1
+        self.journal_db.execute("BEGIN;")
+        for dir, recursive in changed_dirs.items():
+            self.journal_db.execute(f"INSERT INTO {ChangeJournal.CHANGED_DIRS_TABLE_NAME} "\
+                                    "(dir, recursive, change_id) VALUES "\
+                                    f"('{escape_sql_escape_chars(dir)}', {int(recursive)}, {self.last_change_id}) "\
+                                    f"ON CONFLICT (dir) DO UPDATE SET recursive=MAX(recursive, excluded.recursive), change_id=excluded.change_id;")
+        self.journal_db.execute("COMMIT;")
+
+    def get_changed_dirs(self, state_db: StateDB) -> list[tuple[str, bool]] | None:
+        # Returns folders to walk (with whether their subfolders also need to be walked) or None if source folders need to
+        # be walked fully. Folders of files that failed to be backed up (eg: marked by 'sync' or 'verify') are included.
+        self.walk_start = None
+        if not self.is_watched():
+            logging.warning("Source folders will be walked fully as 'watch' isn't running!")
+            return None
+
+        self.journal_db.execute("BEGIN;")   # NOTE: Session, walk and changed folders are read at the same point
+        try:
+            session_record = self.journal_db.execute(f"SELECT id, datetime, reason FROM {ChangeJournal.SESSIONS_TABLE_NAME} ORDER BY id DESC LIMIT 1;").fetchone()
+            walk_record = self.journal_db.execute(f"SELECT session_id, last_work_id, num_work_records FROM {ChangeJournal.WALKS_TABLE_NAME};").fetchone()
+            changed_dir_records = self.journal_db.execute(f"SELECT dir, recursive, change_id FROM {ChangeJournal.CHANGED_DIRS_TABLE_NAME};").fetchall()
+        finally:
+            self.journal_db.execute("COMMIT;")
+        if session_record is None:
+            logging.warning("Source folders will be walked fully as 'watch' is still starting!")
+            return None
+
+        session_id, session_datetime, session_reason = session_record
+        self.walk_start = (session_id, max((change_id for _, _, change_id in changed_dir_records), default=0))
+        if walk_record is None or walk_record[0] != session_id:
+            logging.warning("Source folders will be walked fully as they weren't walked since 'watch' "\
+                            f"{'lost events' if session_reason == 'overflowed' else 'was started'} "\
+                            f"at {prettyDateTimeString(datetime.fromisoformat(session_datetime).astimezone())}!")
+            return None
+
+        _, last_work_id, num_work_records = walk_record
+        if state_db.count_work_records(last_work_id) != num_work_records:
+            logging.warning("Source folders will be walked fully as records of files backed up before they were last walked were deleted from state DB!")
+            return None
+
+        # NOTE: Folders in folders whose subfolders are walked aren't walked again
+        changed_dirs = {dir: bool(recursive) for dir, recursive, _ in changed_dir_records}
+        changed_dirs.update((os.path.dirname(failed_filename), False) for failed_filename in state_db.iter_failed_files()
+                            if os.path.dirname(failed_filename) not in changed_dirs)
+        recursive_dirs = {dir for dir, recursive in changed_dirs.items() if recursive}
+        return sorted((dir, recursive) for dir, recursive in changed_dirs.items() if not ChangeJournal._is_in_any_dir(dir, recursive_dirs))
+
+    def record_walk(self, state_db: StateDB) -> None:
+        # Called once backup is done (i.e. all files walked have been backed up) so that changes journaled before
+        # walk started are removed and next backup only walks folders changed from then on
+        if self.walk_start is None:
+            return
+
+        session_id, last_change_id = self.walk_start
+        if self.journal_db.execute(f"SELECT MAX(id) FROM {ChangeJournal.SESSIONS_TABLE_NAME};").fetchone()[0] != session_id or not self.is_watched():
+            logging.warning("Source folders will be walked fully by next resume as 'watch' was restarted, "\
+                            "stopped or lost events while backing up!")
+            return
+
+        last_work_id = state_db.get_last_work_id()
+        self.journal_db.execute("BEGIN;")
+        self.journal_db.execute(f"DELETE FROM {ChangeJournal.CHANGED_DIRS_TABLE_NAME} WHERE change_id<={last_change_id};")
+        self.journal_db.execute(f"INSERT OR REPLACE INTO {ChangeJournal.WALKS_TABLE_NAME} "\
+                                "(id, datetime, session_id, last_work_id, num_work_records) VALUES "\
+                                f"(1, '{datetime.now(timezone.utc)}', {session_id}, {last_work_id}, {state_db.count_work_records(last_work_id)});")
+        self.journal_db.execute("COMMIT;")
+
+    @staticmethod
+    def _is_in_any_dir(dir: str, parent_dirs: set[str]) -> bool:
+        while True:
+            parent_dir = os.path.dirname(dir)
+            if parent_dir == dir:
+                return False
+            if parent_dir in parent_dirs:
+                return True
+            dir = parent_dir
@@ -4,6 +4,7 @@ from enum import StrEnum
 class TaskType(StrEnum):
     UPLOAD = 'upload'
     DECRYPT = 'decrypt'
+    DOWNLOAD = 'download'
 
 class UploadTaskStatus(StrEnum):
     SCHEDULED = 'scheduled' # Task is on queue and will be uploaded in its turn
@@ -11,3 +12,14 @@ class UploadTaskStatus(StrEnum):
     PACKAGED = 'packaged'   # TAR file has been packaged and is ready to be uploaded, but upload hasn't started yet
     FAILED = 'failed'       # Task failed during upload or packaging
     UPLOADED = 'uploaded'   # Task has been successfully uploaded
+
+class RetrieveTaskStatus(StrEnum):
+    REQUESTED = 'requested'     # Restore from Glacier has been requested but restored copy isn't available yet
+    RESTORED = 'restored'       # Restored copy is available and is waiting to be downloaded
+    DOWNLOADED = 'downloaded'   # TAR file has been downloaded
+    MISSING = 'missing'         # TAR file wasn't found in S3 so it can't be retrieved
+
+class VerifyTaskStatus(StrEnum):
+    VERIFIED = 'verified'       # Size and checksum of TAR file in S3 match what was packed
+    FAILED = 'failed'           # TAR file is missing in S3 or its size or checksum doesn't match what was packed
+    UNVERIFIED = 'unverified'   # Size matches but checksum couldn't be compared (eg: packed by an older version)
@@ -1,20 +1,50 @@
-import os.path
+import os
+import bz2
+import time
+import zlib
+import lzma
+import tarfile
+from collections import deque
 
 from Cryptodome.Cipher import ChaCha20
 
 import settings
-from utils import repeat_string_until_length, str_to_bytes
+from consts import COMPRESSOR_MEM_SIZES
+from utils import repeat_string_until_length, str_to_bytes, drop_from_page_cache, PartChecksums
 
 
 class EncryptSplitFileObj:
     def __init__(self,
+                 temp_filename: str,
                  output_filename: str,
-                 encrypt_key: bytes | None):
+                 encrypt_key: bytes | None,
+                 drop_page_cache: bool=False,
+                 resume_offset: int | None=None,
+                 metrics=None,
+                 buffer_pool=None,
+                 part_checksums: PartChecksums | None=None):
+        # CAUTION: Nonce is the final filename, not the temporary one being written to, as that's what decryption uses
         nonce: str = repeat_string_until_length(os.path.basename(output_filename), settings.ENCRYPT_NONCE_LENGTH)
         self.chacha20 = ChaCha20.new(key=encrypt_key, nonce=str_to_bytes(nonce)) if encrypt_key else None
-        self.output_file = open(output_filename, mode='wb')
+        if resume_offset is None:
+            self.output_file = open(temp_filename, mode='wb')
+        else:
+            # Continue writing from a checkpoint discarding anything written after it
+            self.output_file = open(temp_filename, mode='r+b')
+            self.output_file.truncate(resume_offset)
+            self.output_file.seek(resume_offset)
+            if self.chacha20 is not None:
+                self.chacha20.seek(resume_offset)     # NOTE: ChaCha20 is a stream cipher so its state only depends on offset
         if self.output_file is None:
-            raise IOError(f"Couldn't open file '{output_filename}' for writing!")
+            raise IOError(f"Couldn't open file '{temp_filename}' for writing!")
+
+        self.drop_page_cache = drop_page_cache
+        self.page_cache_dropped_offset = 0
+        self.metrics = metrics
+        self.buffer_pool = buffer_pool
+        self.part_checksums = part_checksums
+        # NOTE: Data is encrypted into a reused buffer instead of a new one on every write
+        self.buffer = buffer_pool.acquire_buffer() if buffer_pool and self.chacha20 else None
 
     def __enter__(self):
         return self
@@ -37,15 +67,179 @@ class EncryptSplitFileObj:
 
     def write(self, b, /):
         assert self.output_file is not None
+        if self.chacha20 is not None and self.buffer is not None:
+            b = memoryview(b)
+            for offset in range(0, len(b), len(self.buffer)):
+                data = b[offset:offset + len(self.buffer)]
+                encrypted_data = memoryview(self.buffer)[:len(data)]
+                start_time = time.perf_counter()
+                self.chacha20.encrypt(data, output=encrypted_data)
+                if self.metrics:
+                    self.metrics.observe('encrypt', time.perf_counter() - start_time, len(data))
+                self._write(encrypted_data)
+            return
+
         if self.chacha20 is not None:
+            start_time = time.perf_counter()
             b = self.chacha20.encrypt(b)
+            if self.metrics:
+                self.metrics.observe('encrypt', time.perf_counter() - start_time, len(b))
+        self._write(b)
 
+    def _write(self, b):
+        assert self.output_file is not None
+        if self.part_checksums is not None:
+            start_time = time.perf_counter()
+            self.part_checksums.update(b)
+            if self.metrics:
+                self.metrics.observe('checksum', time.perf_counter() - start_time, len(b))
+
+        start_time = time.perf_counter()
         self.output_file.write(b)
+        if self.metrics:
+            self.metrics.observe('write', time.perf_counter() - start_time, len(b))
+
+        if self.drop_page_cache and\
+            self.output_file.tell() - self.page_cache_dropped_offset >= 2 * settings.DROP_PAGE_CACHE_WINDOW_SIZE_BYTES:
+            # NOTE: Pages written in the last window are still dirty so they are only queued for
+            # writeback now and will be dropped on the next call along with older windows
+            self.output_file.flush()
+            drop_from_page_cache(self.output_file.fileno(), self.page_cache_dropped_offset)
+            self.page_cache_dropped_offset = self.output_file.tell() - settings.DROP_PAGE_CACHE_WINDOW_SIZE_BYTES
+
+    def sync(self):
+        # Makes sure everything written so far is on disk
+        assert self.output_file is not None
+        start_time = time.perf_counter()
+        self.output_file.flush()
+        os.fdatasync(self.output_file.fileno())
+        if self.metrics:
+            self.metrics.observe('sync', time.perf_counter() - start_time)
 
     def close(self):
         if self.output_file:
+            if self.drop_page_cache:
+                self.output_file.flush()
+                os.fdatasync(self.output_file.fileno())
+                drop_from_page_cache(self.output_file.fileno())
             self.output_file.close()
             self.output_file = None
+        if self.buffer is not None:
+            self.buffer_pool.release_buffer(self.buffer)
+            self.buffer = None
+
+
+class CompressFileObj:
+    # Compresses data written to it to 'fileobj'. Unlike compression modes of 'tarfile', compressed frame
+    # (i.e. gzip member or bzip2/xz stream) can be ended with 'end_frame()' at any point so that writing
+    # can later be continued after it with a new frame. Decompressors read concatenated frames as one.
+    def __init__(self, fileobj, compression: str, offset: int=0, metrics=None, buffer_pool=None):
+        self.fileobj = fileobj
+        self.compression = compression
+        self.offset = offset    # Uncompressed bytes written (i.e. offset in TAR file)
+        self.metrics = metrics
+        self.buffer_pool = buffer_pool
+        self.reserved_mem_size = buffer_pool.reserve(COMPRESSOR_MEM_SIZES[compression]) if buffer_pool else 0
+        self.compressor = self._new_compressor()
+
+    def _new_compressor(self):
+        # NOTE: Same compression levels as used by 'tarfile'
+        match self.compression:
+            case 'gz':
+                return zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # NOTE: 16 + MAX_WBITS writes gzip header and trailer
+            case 'bz2':
+                return bz2.BZ2Compressor(9)
+            case 'xz':
+                return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+            case _:
+                raise ValueError(f"Unsupported compression type '{self.compression}'!")
+
+    def tell(self):
+        return self.offset
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, b, /):
+        self.offset += len(b)
+        start_time = time.perf_counter()
+        compressed_data = self.compressor.compress(b)
+        if self.metrics:
+            self.metrics.observe('compress', time.perf_counter() - start_time, len(b))
+        if compressed_data:
+            self.fileobj.write(compressed_data)
+
+    def end_frame(self):
+        self.fileobj.write(self.compressor.flush())
+        self.compressor = self._new_compressor()
+
+    def close(self):
+        if self.compressor:
+            self.fileobj.write(self.compressor.flush())
+            self.compressor = None
+        if self.reserved_mem_size:
+            self.buffer_pool.release(self.reserved_mem_size)
+            self.reserved_mem_size = 0
+
+
+class DropPageCacheReadFileObj:
+    # Wraps a file opened for reading to drop the pages it has read from page cache
+    def __init__(self, file):
+        self.file = file
+        self.page_cache_dropped_offset = 0
+
+    def read(self, size=-1, /):
+        data = self.file.read(size)
+        offset = self.file.tell()
+        if offset - self.page_cache_dropped_offset >= settings.DROP_PAGE_CACHE_WINDOW_SIZE_BYTES:
+            drop_from_page_cache(self.file.fileno(), self.page_cache_dropped_offset, offset - self.page_cache_dropped_offset)
+            self.page_cache_dropped_offset = offset
+
+        return data
+
+
+class SparseReadFileObj:
+    # Reads GNU sparse format 1.0 member data i.e. the sparse map followed by only the data extents of the file
+    def __init__(self, file, real_size: int, data_extents: list[tuple[int, int]]):
+        self.file = file
+        sparse_map = list(data_extents)
+        if not sparse_map or sum(sparse_map[-1]) < real_size:
+            sparse_map.append((real_size, 0))   # NOTE: GNU tar expects file ending in a hole to end with an empty extent
+
+        sparse_map_str = f"{len(sparse_map)}\n" + ''.join(f"{offset}\n{size}\n" for offset, size in sparse_map)
+        self.sparse_map = str_to_bytes(sparse_map_str)
+        self.sparse_map += bytes(-len(self.sparse_map) % tarfile.BLOCKSIZE)   # Pad to TAR block size
+        self.data_extents = deque(data_extents)
+        self.size = len(self.sparse_map) + sum(size for _, size in data_extents)
+
+    def read(self, size=-1, /):
+        if size < 0:
+            size = self.size
+
+        chunks = []
+        if self.sparse_map:
+            chunks.append(self.sparse_map[:size])
+            self.sparse_map = self.sparse_map[size:]
+            size -= len(chunks[-1])
+
+        while size > 0 and self.data_extents:
+            offset, extent_size = self.data_extents.popleft()
+            self.file.seek(offset)
+            data = self.file.read(min(size, extent_size))
+            if not data:
+                break   # NOTE: File was truncated after its extents were listed, let 'tarfile' report it
+            chunks.append(data)
+            size -= len(data)
+            if len(data) < extent_size:
+                self.data_extents.appendleft((offset + len(data), extent_size - len(data)))
+
+        return b''.join(chunks)
 
 
 class DecryptFileObj:
@@ -61,12 +255,14 @@ class DecryptFileObj:
         if self.file:
             self.file.close()
 
-    def decrypt(self, output_filename, buffer_size):
+    def decrypt(self, output_filename, buffer: bytearray):
+        # NOTE: Data is read and decrypted in place in 'buffer' so no memory is allocated per read
         with open(output_filename, mode='wb') as output_file:
             while True:
-                data = self.file.read(buffer_size)
-                if not data:
+                size = self.file.readinto(buffer)
+                if not size:
                     break
 
-                data = self.chacha20.decrypt(data)
+                data = memoryview(buffer)[:size]
+                self.chacha20.decrypt(data, output=data)
                 output_file.write(data)
@@ -0,0 +1,151 @@
+import os
+import errno
+import ctypes
+import select
+import struct
+import logging
+from time import monotonic
+from collections.abc import Generator
+
+import settings
+
+
+class InotifyWatcher:
+    # Watches source folders and their subfolders with Linux's inotify for files being created, modified (i.e. closed after
+    # writing, instead of on every write), deleted or moved in or out. Only folders in which files changed are reported
+    # and not the files themselves, so a folder with many changes is reported once each interval. Folders created or
+    # moved in are watched as they appear and reported as changed with all their subfolders, as files can be added to
+    # them before they are watched.
+    # NOTE: Values of flags are from 'linux/inotify.h'
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = os.O_CLOEXEC
+
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+    EVENT_HEADER = struct.Struct('iIII')    # NOTE: 'struct inotify_event' (i.e. wd, mask, cookie and length of name) followed by name
+
+    def __init__(self, src_dirs: list[str]):
+        self.src_dirs = src_dirs
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.inotify_fd = self.libc.inotify_init1(InotifyWatcher.IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), f"Failed to initialize inotify: {os.strerror(ctypes.get_errno())}")
+        self.watched_dirs: dict[int, str] = {}      # watch descriptor -> folder
+
+        try:
+            for src_dir in src_dirs:
+                self._watch_tree(src_dir)
+        except:
+            self.close()
+            raise
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self.inotify_fd >= 0:
+            os.close(self.inotify_fd)   # NOTE: All watches are removed with it
+            self.inotify_fd = -1
+
+    def get_num_watched_dirs(self) -> int:
+        return len(self.watched_dirs)
+
+    def iter_changes(self, interval_secs: float) -> Generator[tuple[dict[str, bool], bool]]:
+        # Yields, every 'interval_secs' in which there were any changes, folders in which files changed (with whether their
+        # subfolders also need to be walked) and whether events were lost because the kernel's event queue overflowed
+        changed_dirs: dict[str, bool] = {}
+        overflowed = False
+        next_yield_time = monotonic() + interval_secs
+        while True:
+            readable_fds, _, _ = select.select([self.inotify_fd], [], [], max(next_yield_time - monotonic(), 0))
+            if readable_fds:
+                data = os.read(self.inotify_fd, settings.WATCH_READ_BUFFER_SIZE_BYTES)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, name_length = InotifyWatcher.EVENT_HEADER.unpack_from(data, offset)
+                    offset += InotifyWatcher.EVENT_HEADER.size
+                    name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+                    offset += name_length
+                    overflowed |= self._handle_event(wd, mask, name, changed_dirs)
+
+            if monotonic() >= next_yield_time:
+                if changed_dirs or overflowed:
+                    yield changed_dirs, overflowed
+                    changed_dirs = {}
+                    overflowed = False
+                next_yield_time = monotonic() + interval_secs
+
+    def _handle_event(self, wd: int, mask: int, name: str, changed_dirs: dict[str, bool]) -> bool:
+        # Returns if events were lost
+        if mask & InotifyWatcher.IN_Q_OVERFLOW:
+            return True
+
+        dir = self.watched_dirs.get(wd)
+        if dir is None:
+            return False    # NOTE: Event of a folder that was moved and is no longer watched under its old path
+
+        if mask & (InotifyWatcher.IN_IGNORED | InotifyWatcher.IN_MOVE_SELF):
+            # NOTE: Watches of subfolders that were deleted or moved are removed with events of their parent folder
+            if dir in self.src_dirs:
+                raise FileNotFoundError(errno.ENOENT, "Source folder was deleted or moved", dir)
+            if mask & InotifyWatcher.IN_IGNORED:
+                del self.watched_dirs[wd]
+            return False
+
+        filename = os.path.join(dir, name)
+        if mask & InotifyWatcher.IN_ISDIR:
+            if name in settings.IGNORE_DIRS:
+                return False
+            if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+                self._watch_tree(filename)
+                changed_dirs[filename] = True
+            elif mask & InotifyWatcher.IN_MOVED_FROM:
+                self._unwatch_tree(filename)
+        elif name not in settings.IGNORE_FILES:
+            changed_dirs.setdefault(dir, False)
+        return False
+
+    def _watch_tree(self, dir: str) -> None:
+        # CAUTION: Like when walking source folders, symbolic links to folders and folders in 'IGNORE_DIRS' aren't watched
+        dirs = [dir]
+        while dirs:
+            dir = dirs.pop()
+            wd = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(dir), InotifyWatcher.WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue    # NOTE: Deleted or moved before it could be watched
+                if error == errno.EACCES:
+                    logging.warning(f"Can't watch '{dir}' as it can't be read!")
+                    continue
+                raise OSError(error, os.strerror(error), dir)   # NOTE: 'ENOSPC' if 'fs.inotify.max_user_watches' was reached
+            self.watched_dirs[wd] = dir
+
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) and entry.name not in settings.IGNORE_DIRS:
+                            dirs.append(entry.path)
+
+            except OSError as ex:
+                logging.warning(f"Failed to list '{dir}' with '{repr(ex)}'!")
+
+    def _unwatch_tree(self, dir: str) -> None:
+        # NOTE: Folder moved elsewhere is watched again under its new path if it's still in a source folder
+        for wd, watched_dir in list(self.watched_dirs.items()):
+            if watched_dir == dir or watched_dir.startswith(dir + os.path.sep):
+                self.libc.inotify_rm_watch(self.inotify_fd, wd)
+                del self.watched_dirs[wd]
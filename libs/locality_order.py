@@ -0,0 +1,121 @@
+import os
+import logging
+from collections.abc import Callable, Generator
+
+import settings
+from utils import get_top_level_dirname
+
+
+class LocalityOrder:
+    # Orders files to backup so that each folder is packed in as few TAR files as possible (i.e. fewer TAR files have to be
+    # restored to get a folder back). Source folders are walked once to work out size of files directly in each folder and
+    # of each folder's whole subtree. Then, among the files directly in a folder (which are kept together) and its
+    # subfolders, the largest that fits in what is left of the TAR file being packed is listed next. If none fits, the
+    # smallest is listed so that the TAR file is likely to reach split size with its last file. Top-level folders
+    # (i.e. folders in source folders) can also start a new TAR file once the current one is nearly full.
+    # NOTE: Sizes are of files in TAR file before compression so compressed TAR files fit more than estimated
+    def __init__(self,
+                 src_dirs: list[str],
+                 split_size: int,
+                 part_size: int):
+        self.src_dirs = src_dirs
+        self.split_size = split_size
+        self.min_split_size = int(split_size * settings.LOCALITY_MIN_SPLIT_FRACTION)
+        self.part_size = part_size      # NOTE: Estimated size of the TAR file being packed
+        self.skip_file: Callable[[str], bool] = lambda x: False
+
+        # NOTE: Only sizes of folders and not of files are kept so that memory used doesn't grow with number of files
+        self.files_sizes: dict[str, int] = {}       # folder -> size of files directly in it
+        self.subtree_sizes: dict[str, int] = {}     # folder -> size of all files in it and its subfolders
+        self.subdirs: dict[str, list[str]] = {}
+        self.last_top_level_dir: str | None = None      # NOTE: Top-level folder of the last file asked about
+
+
+    def iter_files(self, skip_file: Callable[[str], bool]) -> Generator[str]:
+        # NOTE: Files for which 'skip_file' returns True (eg: ignored or might be already backed up) aren't counted in sizes
+        self.skip_file = skip_file
+        for src_dir in self.src_dirs:
+            self.add_folder_sizes(src_dir)
+        logging.info(f"Ordering files of {len(self.subtree_sizes)} folder(s) by locality...")
+
+        yield from self._iter_units([(self.subtree_sizes[src_dir], src_dir, False) for src_dir in self.src_dirs], depth=0)
+
+    def is_folder_start(self, filename: str) -> bool:
+        # Returns if 'filename' is the first file to be packed of a top-level folder (or of files directly in a source
+        # folder), in which case a TAR file that has reached 'LOCALITY_MIN_SPLIT_FRACTION' of split size should be ended
+        # before packing it
+        # CAUTION: First file listed of a folder may not be packed (eg: it's ignored or already backed up) so
+        #          top-level folder of each file packed is compared with the one before it instead
+        # NOTE: Files not in any source folder (i.e. in folders whose files only are backed up) are by their folder
+        src_dir = next((src_dir for src_dir in self.src_dirs if filename.startswith(os.path.join(src_dir, ''))), None)
+        top_level_dir = get_top_level_dirname(filename, src_dir) if src_dir else os.path.dirname(filename)
+        is_folder_start = top_level_dir != self.last_top_level_dir
+        self.last_top_level_dir = top_level_dir
+        return is_folder_start
+
+    def add_folder_sizes(self, src_dir: str) -> None:
+        dirs = [src_dir]
+        walked_dirs = []
+        while dirs:
+            dir = dirs.pop()
+            walked_dirs.append(dir)
+            self.files_sizes[dir] = 0
+            self.subdirs[dir] = []
+            for entry_path, entry_size in self._iter_dir_entries(dir):
+                if entry_size is None:
+                    self.subdirs[dir].append(entry_path)
+                    dirs.append(entry_path)
+                else:
+                    self.files_sizes[dir] += entry_size
+
+        # NOTE: Subfolders are walked after their folder so their subtree sizes are known when going in reverse
+        for dir in reversed(walked_dirs):
+            self.subtree_sizes[dir] = self.files_sizes[dir] + sum(self.subtree_sizes[subdir] for subdir in self.subdirs[dir])
+
+    def _iter_dir_entries(self, dir: str) -> Generator[tuple[str, int | None]]:
+        # Yields full path and size in TAR file of each file, or None as size for subfolders, directly in 'dir'
+        # CAUTION: Files to skip are still listed with no size as they might be wrongly skipped (eg: by a Bloom filter)
+        try:
+            with os.scandir(dir) as entries:
+                for entry in sorted(entries, key=lambda x: x.name):
+                    if entry.is_dir(follow_symlinks=False):     # CAUTION: Don't follow symbolic links
+                        if entry.name not in settings.IGNORE_DIRS:
+                            yield entry.path, None
+                    elif entry.is_file(follow_symlinks=False):
+                        if self.skip_file(entry.path):
+                            yield entry.path, 0
+                        else:
+                            # NOTE: Each file takes a 512 bytes header and its data is padded to 512 bytes in TAR file
+                            yield entry.path, 512 + (entry.stat(follow_symlinks=False).st_size + 511) // 512 * 512
+
+        except OSError as ex:
+            logging.warning(f"Failed to list '{dir}' with '{repr(ex)}'!")
+
+    def _iter_units(self, units: list[tuple[int, str, bool]], depth: int) -> Generator[str]:
+        # Lists files of each unit (i.e. a folder or, if files only, the files directly in it) in order of locality
+        units = sorted(units, key=lambda x: x[0], reverse=True)
+        while units:
+            if depth == 1 and self.part_size >= self.min_split_size:
+                self.part_size = self.split_size    # NOTE: Top-level folder will start a new TAR file
+
+            space_left = self.split_size - self.part_size if self.part_size < self.split_size else self.split_size
+            unit_idx = next((i for i, (size, _, _) in enumerate(units) if size <= space_left), None)
+            if unit_idx is None:
+                # NOTE: Units larger than split size are spread over several TAR files anyway so they are listed first
+                unit_idx = 0 if units[0][0] > self.split_size else len(units) - 1
+            _, dir, files_only = units.pop(unit_idx)
+
+            yield from self._iter_folder(dir, files_only, depth)
+
+    def _iter_folder(self, dir: str, files_only: bool, depth: int) -> Generator[str]:
+        if files_only:
+            for filename, size in self._iter_dir_entries(dir):
+                if size is not None:
+                    # NOTE: A new TAR file is started when the one being packed reaches split size
+                    self.part_size = (self.part_size if self.part_size < self.split_size else 0) + size
+                    yield filename
+            return
+
+        # Files directly in the folder are listed together as one unit and each subfolder as another
+        units = [(self.files_sizes[dir], dir, True)] + [(self.subtree_sizes[subdir], subdir, False) for subdir in self.subdirs[dir]]
+        yield from self._iter_units(units, depth + 1)
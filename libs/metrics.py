@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import logging
+from threading import Lock, Thread, Event
+from contextlib import contextmanager
+from collections import defaultdict
+from collections.abc import Iterable, Generator
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import settings
+from utils import LatencyStats, generate_random_name, remove_file_ignore_errors
+
+
+class Metrics:
+    # Time spent, number of operations and bytes processed by each stage of backup (eg: walk, read,
+    # compress, encrypt, write, upload) along with some counters. They are exported in Prometheus text
+    # format to a file (for node exporter's textfile collector) and/or a HTTP endpoint while backup
+    # runs and as a JSON summary when it ends to find what (i.e. disk, CPU, DB or network) it was bound by.
+    PROMETHEUS_PREFIX = 's3_glacier_backup'
+
+    def __init__(self,
+                 prometheus_filename: str | None=None,
+                 http_port: int | None=None,
+                 summary_filename: str | None=None):
+        self.prometheus_filename = prometheus_filename
+        self.http_port = http_port
+        self.summary_filename = summary_filename
+
+        self.mutex = Lock()
+        self.start_time = time.time()
+        self.stage_latencies: dict[str, LatencyStats] = {}
+        self.stage_bytes: defaultdict[str, int] = defaultdict(int)
+        self.counters: defaultdict[str, int] = defaultdict(int)
+        self.part_uploads: list[dict] = []
+        self.folder_tar_files: dict[str, int] = {}
+
+        self.stop_event = Event()
+        self.export_thread: Thread | None = None
+        self.http_server: ThreadingHTTPServer | None = None
+        if self.prometheus_filename:
+            self.export_thread = Thread(target=self._export_loop,
+                                        name='s3-glacier-backup-metrics',
+                                        daemon=True)
+            self.export_thread.start()
+        if self.http_port is not None:
+            self._start_http_server()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        self.stop_event.set()
+        if self.export_thread:
+            self.export_thread.join()
+            self.export_thread = None
+        if self.http_server:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+        if self.prometheus_filename:
+            self.write_prometheus_textfile(self.prometheus_filename)
+        if self.summary_filename:
+            self.write_summary(self.summary_filename)
+            logging.info(f"Saved performance summary to '{self.summary_filename}'.")
+
+    def add_stage_latencies(self, stage_latencies: dict[str, LatencyStats]) -> None:
+        # Export latencies that are measured elsewhere (eg: state DB commits) as stages too
+        with self.mutex:
+            self.stage_latencies.update(stage_latencies)
+
+    def observe(self, stage: str, secs: float, num_bytes: int=0) -> None:
+        with self.mutex:
+            if stage not in self.stage_latencies:
+                self.stage_latencies[stage] = LatencyStats(stage)
+            self.stage_latencies[stage].add(secs)
+            self.stage_bytes[stage] += num_bytes
+
+    @contextmanager
+    def time(self, stage: str, num_bytes: int=0) -> Generator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time, num_bytes)
+
+    def time_iter(self, stage: str, iterable: Iterable[str]) -> Generator[str]:
+        # Yields items of 'iterable' timing only how long it takes to produce each one
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.observe(stage, time.perf_counter() - start_time)
+            yield item
+
+    def increment(self, counter: str, value: int=1) -> None:
+        with self.mutex:
+            self.counters[counter] += value
+
+    def record_part_upload(self, tar_file: str, size: int, secs: float, num_retries: int) -> None:
+        self.observe('upload', secs, size)
+        with self.mutex:
+            self.part_uploads.append({'tar_file': tar_file,
+                                      'size': size,
+                                      'secs': round(secs, 3),
+                                      'bytes_per_sec': round(size / secs) if secs > 0 else None,
+                                      'retries': num_retries})
+
+    def record_folder_tar_files(self, num_tar_files_per_folder: dict[str, int]) -> None:
+        # Number of TAR files (i.e. parts) that files of each top-level folder are in, which is how many TAR files need to
+        # be restored to get a folder back
+        with self.mutex:
+            self.folder_tar_files = dict(num_tar_files_per_folder)
+
+    def get_summary(self) -> dict:
+        with self.mutex:
+            end_time = time.time()
+            duration_secs = end_time - self.start_time
+            stages = {}
+            for stage, latency_stats in self.stage_latencies.items():
+                num_bytes = self.stage_bytes.get(stage, 0)
+                stages[stage] = {'secs': round(latency_stats.total_secs, 3),
+                                 'count': latency_stats.count,
+                                 'max_secs': round(latency_stats.max_secs, 6),
+                                 'bytes': num_bytes,
+                                 'bytes_per_sec': round(num_bytes / latency_stats.total_secs) if num_bytes and latency_stats.total_secs > 0 else None,
+                                 # NOTE: Can be more than 1 for stages run by several threads in parallel
+                                 'utilization': round(latency_stats.total_secs / duration_secs, 3) if duration_secs > 0 else None}
+
+            return {'start_datetime': str(datetime.fromtimestamp(self.start_time, timezone.utc)),
+                    'end_datetime': str(datetime.fromtimestamp(end_time, timezone.utc)),
+                    'duration_secs': round(duration_secs, 3),
+                    'stages': stages,
+                    'counters': dict(self.counters),
+                    'part_uploads': list(self.part_uploads),
+                    'tar_files_per_top_level_folder': dict(self.folder_tar_files)}
+
+    def write_summary(self, filename: str) -> None:
+        summary = self.get_summary()
+        walk_secs = summary['stages'].get('walk', {}).get('secs')
+        if walk_secs:
+            summary['walk_dirs_per_sec'] = round(summary['counters'].get('dirs', 0) / walk_secs, 1)
+            summary['walk_files_per_sec'] = round(summary['counters'].get('files', 0) / walk_secs, 1)
+
+        with open(filename, mode='w') as file:
+            json.dump(summary, file, indent=4)
+
+    def get_prometheus_text(self) -> str:
+        summary = self.get_summary()
+        lines = []
+        def add_metric(name: str, metric_type: str, help: str, samples: list[tuple[str, float]]) -> None:
+            lines.append(f"# HELP {Metrics.PROMETHEUS_PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {Metrics.PROMETHEUS_PREFIX}_{name} {metric_type}")
+            lines.extend(f"{Metrics.PROMETHEUS_PREFIX}_{name}{labels} {value}" for labels, value in samples)
+
+        stages = sorted(summary['stages'].items())
+        add_metric('stage_seconds_total', 'counter', "Time spent in each stage of backup.",
+                   [(f'{{stage="{stage}"}}', stage_summary['secs']) for stage, stage_summary in stages])
+        add_metric('stage_operations_total', 'counter', "Number of operations done by each stage of backup.",
+                   [(f'{{stage="{stage}"}}', stage_summary['count']) for stage, stage_summary in stages])
+        add_metric('stage_max_seconds', 'gauge', "Longest time taken by an operation of each stage of backup.",
+                   [(f'{{stage="{stage}"}}', stage_summary['max_secs']) for stage, stage_summary in stages])
+        add_metric('stage_bytes_total', 'counter', "Bytes processed by each stage of backup.",
+                   [(f'{{stage="{stage}"}}', stage_summary['bytes']) for stage, stage_summary in stages])
+        add_metric('events_total', 'counter', "Number of things (eg: files, dirs, retries) counted during backup.",
+                   [(f'{{event="{counter}"}}', value) for counter, value in sorted(summary['counters'].items())])
+        add_metric('top_level_folder_tar_files', 'gauge', "Number of TAR files that files of each top-level folder are in.",
+                   [(f'{{folder="{_escape_label_value(folder)}"}}', value) for folder, value in sorted(summary['tar_files_per_top_level_folder'].items())])
+        add_metric('start_time_seconds', 'gauge', "Unix time when backup started.",
+                   [('', round(self.start_time, 3))])
+        add_metric('duration_seconds', 'gauge', "Time since backup started.",
+                   [('', summary['duration_secs'])])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus_textfile(self, filename: str) -> None:
+        # NOTE: Written to a temporary file which is then renamed so that a collector never reads a partial file
+        temp_filename = os.path.join(os.path.dirname(filename), f'.{generate_random_name()}')
+        try:
+            with open(temp_filename, mode='w') as file:
+                file.write(self.get_prometheus_text())
+            os.replace(temp_filename, filename)
+
+        except OSError as ex:
+            remove_file_ignore_errors(temp_filename)
+            logging.warning(f"Failed to write metrics to '{filename}' with '{repr(ex)}'.")
+
+    def _export_loop(self) -> None:     # CAUTION: Runs in metrics thread
+        assert self.prometheus_filename
+        while not self.stop_event.wait(settings.METRICS_EXPORT_INTERVAL_SECS):
+            self.write_prometheus_textfile(self.prometheus_filename)
+
+    def _start_http_server(self) -> None:
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:       # CAUTION: Runs in HTTP server thread
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = metrics.get_prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                pass    # NOTE: Don't log every scrape
+
+        self.http_server = ThreadingHTTPServer((settings.METRICS_HTTP_HOST, self.http_port), MetricsRequestHandler)
+        self.http_server.daemon_threads = True
+        Thread(target=self.http_server.serve_forever, name='s3-glacier-backup-metrics-http', daemon=True).start()
+        logging.info(f"Serving metrics on 'http://{settings.METRICS_HTTP_HOST}:{self.http_port}/metrics'.")
+
+
+def _escape_label_value(value: str) -> str:
+    # NOTE: Backslashes, double quotes and newlines must be escaped in Prometheus label values
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
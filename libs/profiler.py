@@ -0,0 +1,87 @@
+import re
+import sys
+import logging
+import cProfile
+from threading import Thread, Event, get_ident, enumerate as enumerate_threads
+from collections import Counter
+
+import settings
+from consts import PROFILE_MODES
+
+
+class Profiler:
+    # Profiles everything run in all threads (eg: worker pool and read-ahead threads) while in its context.
+    # 'sample' mode records stacks of every thread every 'PROFILE_SAMPLE_INTERVAL_SECS' which costs little
+    # enough to leave on. It is wall-clock time so threads waiting (eg: on network or disk) are counted too.
+    # Samples are saved in collapsed stack format read by 'flamegraph.pl', speedscope and similar tools.
+    # 'cprofile' mode records every function call which slows down the program a lot and is saved in 'pstats' format.
+    # CAUTION: Since Python 3.12, 'cProfile' profiles all threads together so time of functions run
+    # at the same time by different threads overlap, use 'sample' mode to see time spent by each thread.
+    # NOTE: Other processes (eg: shard processes) aren't profiled by it, see 'get_active()'
+    active: 'Profiler | None' = None    # Profiler of this process whose context is entered, if any
+
+    def __init__(self, mode: str, output_filename_prefix: str):
+        assert mode in PROFILE_MODES
+        self.mode = mode
+        self.output_filename_prefix = output_filename_prefix
+
+        self.cprofile: cProfile.Profile | None = None
+        self.stack_counts: Counter[str] = Counter()
+        self.stop_event = Event()
+        self.sampler_thread: Thread | None = None
+
+
+    def __enter__(self):
+        Profiler.active = self
+        match self.mode:
+            case 'cprofile':
+                self.cprofile = cProfile.Profile()
+                self.cprofile.enable()
+            case 'sample':
+                self.sampler_thread = Thread(target=self._sample_loop, name='s3-glacier-backup-profiler', daemon=True)
+                self.sampler_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        Profiler.active = None
+        match self.mode:
+            case 'cprofile':
+                assert self.cprofile
+                self.cprofile.disable()
+                output_filename = f'{self.output_filename_prefix}.pstats'
+                self.cprofile.dump_stats(output_filename)
+            case 'sample':
+                assert self.sampler_thread
+                self.stop_event.set()
+                self.sampler_thread.join()
+                output_filename = f'{self.output_filename_prefix}.collapsed'
+                with open(output_filename, mode='w') as file:
+                    for stack, count in self.stack_counts.most_common():
+                        file.write(f'{stack} {count}\n')
+
+        logging.info(f"Saved profile to '{output_filename}'.")
+
+    @staticmethod
+    def get_active() -> 'Profiler | None':
+        # Returns profiler of this process, if any, so that processes it starts can be profiled the same way
+        # (i.e. with a profiler of the same mode saving to their own file)
+        return Profiler.active
+
+    def _sample_loop(self) -> None:     # CAUTION: Runs in profiler thread
+        sampler_thread_id = get_ident()
+        while not self.stop_event.wait(settings.PROFILE_SAMPLE_INTERVAL_SECS):
+            thread_names = {thread.ident: thread.name for thread in enumerate_threads()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_thread_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_qualname} ({code.co_filename}:{code.co_firstlineno})')
+                    frame = frame.f_back
+
+                # NOTE: Threads of a pool (eg: 's3-glacier-backup-upload_0', 's3-glacier-backup-upload_1') are merged
+                thread_name = re.sub(r'_\d+$', '', thread_names.get(thread_id, str(thread_id)))
+                stack.append(thread_name)
+                self.stack_counts[';'.join(reversed(stack))] += 1
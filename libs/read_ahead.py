@@ -0,0 +1,137 @@
+import os
+import time
+from threading import Lock
+from itertools import islice
+from collections import deque
+from collections.abc import Iterable, Generator
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import settings
+from utils import drop_from_page_cache
+
+from .metrics import Metrics
+from .buffer_pool import BufferPool
+
+
+class ReadAheadFiles:
+    def __init__(self,
+                 filenames: Iterable[str],
+                 num_files_ahead: int,
+                 num_threads: int,
+                 mem_budget_size: int,
+                 max_file_size: int,
+                 drop_page_cache: bool=False,
+                 metrics: Metrics | None=None,
+                 buffer_pool: BufferPool | None=None):
+        self.filenames = iter(filenames)
+        self.num_files_ahead = num_files_ahead
+        self.num_threads = max(num_threads, 1)
+        self.mem_budget_size = mem_budget_size
+        self.max_file_size = max_file_size
+        self.drop_page_cache = drop_page_cache
+        self.metrics = metrics
+        self.buffer_pool = buffer_pool
+
+        # NOTE: Files are handed to read-ahead threads in batches as handing them over one
+        # at a time costs more in thread switching than is saved for small files
+        self.batch_size = max(num_files_ahead // (2 * self.num_threads), 1)
+
+        self.mutex = Lock()
+        self.reserved_mem_size = 0      # Bytes held by files read ahead but not consumed yet
+        self.thread_pool = ThreadPoolExecutor(max_workers=self.num_threads,
+                                              thread_name_prefix='s3-glacier-backup-read-ahead')
+        self.pending_batches: deque[Future] = deque()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.thread_pool.shutdown(wait=True, cancel_futures=True)
+        self._release_mem(self.reserved_mem_size)   # NOTE: Files read ahead but never consumed
+
+    def __iter__(self) -> Generator[tuple[str, bytes | None]]:
+        if self.num_files_ahead <= 0:
+            # Read-ahead is disabled so just pass filenames through
+            for filename in self.filenames:
+                yield filename, None
+            return
+
+        while True:
+            # Keep 'num_files_ahead' files being read ahead while the caller is busy with the current one
+            while len(self.pending_batches) * self.batch_size < self.num_files_ahead and self._schedule_next_batch():
+                pass
+
+            if not self.pending_batches:
+                break
+
+            # CAUTION: Files are taken out of the batch as they are consumed so that memory of each file is
+            #          freed when it's given back to the budget instead of when the whole batch is consumed
+            batch = self.pending_batches.popleft().result()
+            batch.reverse()
+            while batch:
+                filename, data = batch.pop()
+                yield filename, data
+                if data is not None:
+                    size = len(data)
+                    del data
+                    self._release_mem(size)     # NOTE: Caller is done with it
+
+    def _schedule_next_batch(self) -> bool:
+        filenames = list(islice(self.filenames, self.batch_size))
+        if not filenames:
+            return False
+
+        self.pending_batches.append(self.thread_pool.submit(self._read_batch, filenames))
+        return True
+
+    def _reserve_mem(self, size: int) -> bool:
+        with self.mutex:
+            if self.reserved_mem_size + size > self.mem_budget_size:
+                return False
+            if self.buffer_pool and not self.buffer_pool.try_reserve(size):
+                return False    # NOTE: Memory budget is needed elsewhere
+            self.reserved_mem_size += size
+            return True
+
+    def _release_mem(self, size: int) -> None:
+        with self.mutex:
+            self.reserved_mem_size -= size
+            if self.buffer_pool:
+                self.buffer_pool.release(size)
+
+    def _read_batch(self, filenames: list[str]) -> list[tuple[str, bytes | None]]:     # CAUTION: Runs in read-ahead thread
+        return [(filename, self._read_file(filename)) for filename in filenames]
+
+    def _read_file(self, filename: str) -> bytes | None:                                # CAUTION: Runs in read-ahead thread
+        try:
+            with open(filename, mode='rb') as file:
+                stat = os.fstat(file.fileno())
+                size = stat.st_size
+                if settings.PACK_SPARSE_FILES and stat.st_blocks * 512 < size:
+                    return None     # NOTE: Possibly sparse file whose holes shouldn't be read
+
+                # Only read whole files that fit in the remaining memory budget, otherwise just
+                # hint the kernel to start reading the file in so that its disk seeks still overlap
+                if size > self.max_file_size or not self._reserve_mem(size):
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(file.fileno(), 0, settings.READ_AHEAD_WILLNEED_SIZE_BYTES, os.POSIX_FADV_WILLNEED)
+                    return None
+
+                # NOTE: 'bytes' (unlike 'bytearray') is shared rather than copied by 'io.BytesIO' when packed
+                start_time = time.perf_counter()
+                data = file.read(size)
+                if self.metrics:
+                    self.metrics.observe('read', time.perf_counter() - start_time, len(data))
+                if len(data) != size or file.read(1):
+                    # File changed after we stat'ed it, let 'tarfile' read it instead
+                    self._release_mem(size)
+                    return None
+
+                if self.drop_page_cache:
+                    drop_from_page_cache(file.fileno())     # NOTE: Contents are now in our memory
+
+            return data
+
+        except OSError:
+            return None     # NOTE: Let the caller deal with the file when it tries to add it
@@ -0,0 +1,44 @@
+import logging
+from http import HTTPStatus
+from functools import cache
+
+import boto3
+import boto3.session
+import botocore.exceptions
+
+import settings
+
+
+@cache
+def get_s3_client():
+    # Returns a single S3 client shared by all commands and worker threads ('boto3' clients, unlike sessions,
+    # are thread-safe) so that connections in its pool are reused. It is only created on first use so that
+    # commands not using S3 (and '--help') don't load S3 configuration and credentials.
+    session = boto3.Session()   # NOTE: Load S3 credentials and configuration from '~/.aws'
+    if not session.available_profiles:
+        logging.warning("Please check for proper S3 configuration and credentials in '~/.aws'!")
+
+    session_config = boto3.session.Config(retries={'max_attempts': settings.MAX_RETRY_ATTEMPTS, 'mode': 'standard'},
+                                          max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS)
+    return session.client('s3', config=session_config)
+
+@cache
+def s3_bucket_exists(bucket: str) -> bool:
+    try:
+        get_s3_client().head_bucket(Bucket=bucket)
+
+    except botocore.exceptions.ClientError as ex:
+        if ex.response['Error']['Code'] in (str(HTTPStatus.NOT_FOUND.value), 'NoSuchBucket'):
+            return False
+        raise ex
+
+    return True
+
+def list_objects_in_s3(bucket: str) -> dict[str, tuple[int, str]]:
+    # Returns size and storage class of every object in bucket, 1000 objects per request
+    objects: dict[str, tuple[int, str]] = {}
+    for page in get_s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket):
+        for s3_object in page.get('Contents', []):
+            objects[s3_object['Key']] = (s3_object['Size'], s3_object.get('StorageClass', 'STANDARD'))
+
+    return objects
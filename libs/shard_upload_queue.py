@@ -0,0 +1,44 @@
+import os
+import time
+
+from .state_db import StateDB
+
+import settings
+
+
+class ShardUploadQueue:
+    # Used by a shard of a sharded backup in place of 'WorkerPool'. TAR files packed by the shard are put on a queue shared
+    # by all shards for the upload workers of the main backup process to upload. Those record upload states in the shard's
+    # state DB so waiting for uploads is done by polling it.
+    def __init__(self, upload_queue, db_filename: str, num_workers: int, state_db: StateDB):
+        self.upload_queue = upload_queue
+        self.db_filename = db_filename
+        self.num_workers = num_workers
+        self.state_db = state_db
+        self.queued_tar_files: set[str] = set()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: TAR files still on queue are uploaded by main backup process after shard is done
+        pass
+
+    def put_on_tasks_queue(self, tar_filename: str) -> None:
+        self.queued_tar_files.add(os.path.basename(tar_filename))
+        self.upload_queue.put((self.db_filename, tar_filename))
+
+    def get_num_tasks_running(self) -> int:
+        # NOTE: Number of TAR files queued by this shard that haven't been uploaded yet
+        self.queued_tar_files -= self.state_db.get_already_uploaded_tar_files()
+        return len(self.queued_tar_files)
+
+    def wait_on_any_task(self) -> None:
+        num_queued_tar_files = self.get_num_tasks_running()
+        while num_queued_tar_files and self.get_num_tasks_running() >= num_queued_tar_files:
+            time.sleep(settings.SHARD_UPLOAD_POLL_INTERVAL_SECS)
+
+    def wait_on_all_tasks(self) -> None:
+        while self.get_num_tasks_running():
+            time.sleep(settings.SHARD_UPLOAD_POLL_INTERVAL_SECS)
@@ -1,13 +1,25 @@
-import os.path
+import io
+import os
+import time
+import logging
 import tarfile
 from collections.abc import Callable
 
 from .common import UploadTaskStatus
 from .state_db import StateDB
-from .fileobjs import EncryptSplitFileObj
+from .metrics import Metrics
+from .buffer_pool import BufferPool
+from .staging_dirs import StagingDirs
+from .fileobjs import EncryptSplitFileObj, CompressFileObj, DropPageCacheReadFileObj, SparseReadFileObj
 
 import settings
-from utils import generate_random_name, remove_file_ignore_errors
+from utils import generate_random_name,\
+                  remove_file_ignore_errors,\
+                  drop_from_page_cache,\
+                  get_data_extents,\
+                  prettyFilesize,\
+                  get_upload_part_size,\
+                  PartChecksums
 
 
 class SplitTarFiles:
@@ -17,22 +29,37 @@ class SplitTarFiles:
                  output_file_idx: int,
                  encrypt_key: bytes | None,
                  compression: str,
-                 buffer_mem_size: int,
-                 upload_callback: Callable[[str], None]):
+                 buffer_pool: BufferPool,
+                 upload_callback: Callable[[str], None],
+                 drop_page_cache: bool=False,
+                 checkpoint: tuple[str, str, int, int, int] | None=None,
+                 metrics: Metrics | None=None,
+                 upload_part_size: int=settings.UPLOAD_PART_SIZE_BYTES,
+                 staging_dirs: StagingDirs | None=None):
         self.state_db = state_db
         self.output_filename_template = output_filename_template
         self.output_file_idx = output_file_idx
         self.encrypt_key = encrypt_key
         self.compression = compression
-        self.buffer_mem_size = buffer_mem_size
+        self.buffer_pool = buffer_pool
         self.upload_callback = upload_callback
+        self.drop_page_cache = drop_page_cache
+        self.metrics = metrics
+        self.upload_part_size = upload_part_size
+        self.staging_dirs = staging_dirs
 
         self.output_filename: str | None= None
         self.temp_filename: str | None=None
         self.fileobj: EncryptSplitFileObj | None= None
+        self.compress_fileobj: CompressFileObj | None=None
         self.tarfile: tarfile.TarFile | None= None
+        self.part_checksums: PartChecksums | None=None     # Checksums of parts TAR file will be uploaded in
+        self.checkpointed_size = 0      # Size of current TAR file at its last checkpoint
 
-        self.create_new_tarfile_part()
+        if checkpoint:
+            self._continue_tarfile_part(checkpoint)
+        else:
+            self.create_new_tarfile_part()
 
 
     def __enter__(self):
@@ -45,17 +72,57 @@ class SplitTarFiles:
     def create_new_tarfile_part(self) -> None:
         self.close(completed_write=True)
 
-        output_dir = os.path.dirname(self.output_filename_template)
+        output_dir = self._get_staging_dir()
         output_file = f"{self.output_file_idx:03}_{os.path.basename(self.output_filename_template)}"
+        if self.staging_dirs:
+            self.staging_dirs.add_tar_file(output_file, output_dir)
         self.output_filename = os.path.join(output_dir, output_file)
         self.temp_filename = os.path.join(output_dir, generate_random_name())
-        self.fileobj = EncryptSplitFileObj(self.temp_filename, self.encrypt_key)
-        self.tarfile = tarfile.open(mode=f'w:{self.compression if self.compression else ""}',   # type: ignore
-                                    fileobj=self.fileobj,                                       # type: ignore
-                                    bufsize=self.buffer_mem_size,
-                                    format=settings.TARFILE_FORMAT)
+        self.part_checksums = PartChecksums(self.upload_part_size)
+        self.fileobj = EncryptSplitFileObj(self.temp_filename, self.output_filename, self.encrypt_key, self.drop_page_cache,
+                                          metrics=self.metrics, buffer_pool=self.buffer_pool, part_checksums=self.part_checksums)
+        self._open_tarfile()
         self.output_file_idx += 1
 
+    def _continue_tarfile_part(self, checkpoint: tuple[str, str, int, int, int]) -> None:
+        # Continue writing TAR file from its last checkpoint left by an interrupted backup
+        tar_file, temp_file, size, tar_offset, _ = checkpoint
+        output_dir = self._get_staging_dir(temp_file)
+        if self.staging_dirs:
+            self.staging_dirs.add_tar_file(tar_file, output_dir)
+        self.output_filename = os.path.join(output_dir, tar_file)
+        self.temp_filename = os.path.join(output_dir, temp_file)
+
+        # Checksums of parts completed by last checkpoint were recorded so only the rest before checkpoint is read again
+        # NOTE: Checkpoints recorded by older versions don't have checksums so whole TAR file is read again
+        part_size, part_digests = self.state_db.get_part_checksums(tar_file) or (self.upload_part_size, b'')
+        self.part_checksums = PartChecksums(part_size, part_digests)
+        self.part_checksums.update_from_file(self.temp_filename, size)
+
+        self.fileobj = EncryptSplitFileObj(self.temp_filename, self.output_filename, self.encrypt_key, self.drop_page_cache,
+                                          resume_offset=size, metrics=self.metrics, buffer_pool=self.buffer_pool, part_checksums=self.part_checksums)
+        self._open_tarfile(tar_offset)
+        self.checkpointed_size = size
+
+    def _get_staging_dir(self, temp_file: str | None=None) -> str:
+        # Returns folder to pack a new TAR file in or, if 'temp_file' is given, the one its incomplete file is in
+        if not self.staging_dirs:
+            return os.path.dirname(self.output_filename_template)
+        if temp_file:
+            temp_filename = self.staging_dirs.find(temp_file)
+            assert temp_filename
+            return os.path.dirname(temp_filename)
+        return self.staging_dirs.pick_dir()
+
+    def _open_tarfile(self, tar_offset: int=0) -> None:
+        # NOTE: Compression is done by 'CompressFileObj' instead of 'tarfile' so that
+        # compressed frame can be ended at checkpoints to be able to continue from them
+        self.compress_fileobj = CompressFileObj(self.fileobj, self.compression, tar_offset, self.metrics, self.buffer_pool) if self.compression else None
+        self.tarfile = tarfile.open(mode='w',
+                                    fileobj=self.compress_fileobj or self.fileobj,              # type: ignore
+                                    format=settings.TARFILE_FORMAT)
+        self.checkpointed_size = 0
+
     def tell(self) -> int:
         assert self.fileobj
         return self.fileobj.tell()
@@ -64,10 +131,98 @@ class SplitTarFiles:
         assert self.output_filename
         return os.path.basename(self.output_filename)
 
-    def add(self, filename) -> None:
+    def add(self, filename: str, data: bytes | None=None) -> None:
+        assert self.tarfile
+        tar_offset, start_time = self.tarfile.offset, time.perf_counter()
+        self._add(filename, data)
+        if self.metrics:
+            # NOTE: Packing includes reading files that weren't read ahead as well as compressing, encrypting and writing them
+            self.metrics.observe('pack', time.perf_counter() - start_time, self.tarfile.offset - tar_offset)
+
+        assert self.fileobj
+        if settings.CHECKPOINT_INTERVAL_BYTES > 0 and\
+            self.fileobj.tell() - self.checkpointed_size >= settings.CHECKPOINT_INTERVAL_BYTES:
+            self._checkpoint()
+
+    def _checkpoint(self) -> None:
+        # Record where the TAR file ends after the last added file so that an interrupted backup
+        # can continue from here instead of packing this TAR file again from the start
+        assert self.tarfile and self.fileobj and self.temp_filename
+        if self.compress_fileobj:
+            self.compress_fileobj.end_frame()
+        self.fileobj.sync()     # CAUTION: Data must be on disk before checkpoint is recorded
+
+        self.checkpointed_size = self.fileobj.tell()
+        assert self.part_checksums
+        self.state_db.record_part_checksums(self.get_tarfile_name(),
+                                            self.part_checksums.part_size,
+                                            self.part_checksums.get_part_digests(completed_only=True))
+        self.state_db.record_checkpoint(self.get_tarfile_name(),
+                                        os.path.basename(self.temp_filename),
+                                        self.checkpointed_size,
+                                        self.tarfile.offset)
+        self.state_db.flush()   # NOTE: Wait for checkpoint to be committed as state DB writes are otherwise asynchronous
+        logging.info(f"Checkpointed '{self.get_tarfile_name()}' at {prettyFilesize(self.checkpointed_size)}.")
+
+    def _add(self, filename: str, data: bytes | None=None) -> None:
         assert self.tarfile
+        if settings.PACK_SPARSE_FILES and data is None and self._add_if_sparse(filename):
+            return
+
+        if data is not None:
+            # File contents were already read ahead so pack them from memory instead of reading the file again
+            tarinfo = self.tarfile.gettarinfo(filename)
+            if tarinfo.isreg() and tarinfo.size == len(data):
+                self.tarfile.addfile(tarinfo, fileobj=io.BytesIO(data))
+                return
+
+        if self.drop_page_cache:
+            # Read the file ourselves so that pages read can be dropped from page cache as we go
+            tarinfo = self.tarfile.gettarinfo(filename)
+            if tarinfo.isreg():
+                with open(filename, mode='rb') as file:
+                    self.tarfile.addfile(tarinfo, fileobj=DropPageCacheReadFileObj(file))
+                    drop_from_page_cache(file.fileno())     # NOTE: 'tarfile' doesn't read past the end to let it drop the last pages
+                return
+
         self.tarfile.add(filename)
 
+    def _add_if_sparse(self, filename: str) -> bool:
+        assert self.tarfile
+        with open(filename, mode='rb') as file:
+            stat = os.fstat(file.fileno())
+            if stat.st_blocks * 512 >= stat.st_size:
+                return False    # NOTE: File has all its blocks allocated so it can't have any holes
+
+            data_extents = get_data_extents(file.fileno(), stat.st_size)
+            sparse_fileobj = SparseReadFileObj(file, stat.st_size, data_extents)
+            if sparse_fileobj.size >= stat.st_size or sparse_fileobj.size >= settings.MAX_SPARSE_MEMBER_DATA_SIZE_BYTES:
+                return False
+
+            # Pack as GNU sparse format 1.0 member (supported by GNU tar, bsdtar and Python's 'tarfile' on extraction)
+            # which stores sparse map followed by only the data extents under a placeholder name
+            tarinfo = self.tarfile.gettarinfo(filename)
+            if not tarinfo.isreg():
+                return False
+
+            sparse_name = os.path.join(os.path.dirname(tarinfo.name), 'GNUSparseFile.0', os.path.basename(tarinfo.name))
+            tarinfo.pax_headers = {
+                'path': sparse_name,                    # CAUTION: Must come before 'GNU.sparse.name' so that the latter wins on extraction
+                'GNU.sparse.major': '1',
+                'GNU.sparse.minor': '0',
+                'GNU.sparse.name': tarinfo.name,
+                'GNU.sparse.realsize': str(stat.st_size),
+            }
+            tarinfo.name = sparse_name
+            tarinfo.size = sparse_fileobj.size
+
+            logging.info(f"Packing only {prettyFilesize(sparse_fileobj.size)} of {prettyFilesize(stat.st_size)} of sparse file '{filename}'.")
+            self.tarfile.addfile(tarinfo, fileobj=sparse_fileobj)
+            if self.drop_page_cache:
+                drop_from_page_cache(file.fileno())
+
+        return True
+
     def close(self, completed_write: bool) -> None:
         if self.tarfile:
             assert self.fileobj is not None and self.temp_filename
@@ -75,16 +230,35 @@ class SplitTarFiles:
             self.tarfile.close()
             self.tarfile = None
 
+            if self.compress_fileobj:
+                self.compress_fileobj.close()
+                self.compress_fileobj = None
+
             self.fileobj.close()
             self.fileobj = None
 
+            assert self.output_filename
+            output_file = os.path.basename(self.output_filename)
             if completed_write:
-                assert self.output_filename
                 os.rename(self.temp_filename, self.output_filename)
-                output_file = os.path.basename(self.output_filename)
+                size = os.path.getsize(self.output_filename)
+                self.state_db.record_tar_file_size(output_file, size)
+                assert self.part_checksums
+                upload_part_size = get_upload_part_size(size)
+                if upload_part_size > self.part_checksums.part_size:
+                    # NOTE: TAR file is too large to be uploaded in parts its checksums were worked out for (eg: it has a
+                    # file larger than split size) so they are worked out again for parts it can be uploaded in
+                    logging.info(f"Working out checksums of '{output_file}' again for parts of {prettyFilesize(upload_part_size)}...")
+                    self.part_checksums = PartChecksums(upload_part_size)
+                    self.part_checksums.update_from_file(self.output_filename, size)
+                self.state_db.record_part_checksums(output_file, self.part_checksums.part_size, self.part_checksums.get_part_digests())
                 self.state_db.record_changed_work_state(UploadTaskStatus.PACKAGED, tar_file=output_file)
+                self.state_db.delete_checkpoint(output_file)
                 self.upload_callback(self.output_filename)
+            elif self.checkpointed_size > 0:
+                logging.info(f"Keeping incomplete '{output_file}' so that backup can be resumed from its last checkpoint.")
             else:
                 remove_file_ignore_errors(self.temp_filename)
 
             self.output_filename = self.temp_filename = None
+            self.part_checksums = None
@@ -0,0 +1,56 @@
+import os
+import shutil
+import logging
+
+from .state_db import StateDB
+
+from utils import prettyFilesize
+
+
+class StagingDirs:
+    # Picks which of several folders (eg: on different disks) the next TAR file is packed in. Folders on disks with fewest
+    # TAR files waiting for or being uploaded (i.e. read by uploads) are picked first so that packing writes to a disk other
+    # than those uploads read from, and then those with most free space. Folders without enough free space for another
+    # TAR file are only picked if all are short of it.
+    def __init__(self, dirs: list[str], state_db: StateDB, min_free_size: int):
+        self.dirs = list(dict.fromkeys(dirs))   # NOTE: Remove duplicates but keep order
+        self.state_db = state_db
+        self.min_free_size = min_free_size
+        self.staged_tar_files: dict[str, str] = {}   # tar_file -> folder it was packed in
+
+        for dir in self.dirs:
+            os.makedirs(dir, exist_ok=True)
+        self.dir_devices = {dir: os.stat(dir).st_dev for dir in self.dirs}
+
+
+    def pick_dir(self) -> str:
+        if len(self.dirs) == 1:
+            return self.dirs[0]
+
+        # Forget TAR files that have been uploaded (or autocleaned) since they are no longer read by uploads
+        uploaded_tar_files = self.state_db.get_already_uploaded_tar_files()
+        self.staged_tar_files = {tar_file: dir for tar_file, dir in self.staged_tar_files.items()
+                                 if tar_file not in uploaded_tar_files and os.path.isfile(os.path.join(dir, tar_file))}
+        num_staged_tar_files_on_devices = {device: 0 for device in self.dir_devices.values()}
+        for dir in self.staged_tar_files.values():
+            num_staged_tar_files_on_devices[self.dir_devices[dir]] += 1
+
+        free_sizes = {dir: shutil.disk_usage(dir).free for dir in self.dirs}
+        picked_dir = min(self.dirs, key=lambda x: (free_sizes[x] < self.min_free_size,
+                                                   num_staged_tar_files_on_devices[self.dir_devices[x]],
+                                                   -free_sizes[x]))
+        if free_sizes[picked_dir] < self.min_free_size:
+            logging.warning(f"Staging folder '{picked_dir}' only has {prettyFilesize(free_sizes[picked_dir])} free space "\
+                            f"but TAR files can be {prettyFilesize(self.min_free_size)} or more!")
+        return picked_dir
+
+    def add_tar_file(self, tar_file: str, dir: str) -> None:
+        self.staged_tar_files[tar_file] = dir
+
+    def find(self, file: str) -> str | None:
+        # Returns full path of file (eg: packaged TAR file or incomplete one of a checkpoint) in any staging folder
+        for dir in self.dirs:
+            filename = os.path.join(dir, file)
+            if os.path.isfile(filename):
+                return filename
+        return None
@@ -1,27 +1,76 @@
 import os
 import json
+import time
+import queue
 import sqlite3
-sqlite3.threadsafety = 3    # CAUTION: Make sure serialized (i.e. 3) is enabled as we write to db from multiple threads
-from threading import Lock
+from threading import Lock, Condition, Thread
 from typing import Union, Any
+from itertools import batched
+from collections.abc import Generator
 from datetime import datetime, timezone
 
 import settings
 from utils import *
 from consts import MAX_LINUX_PATH_LENGTH, MAX_LINUX_FILENAME_LENGTH
 
-from .common import UploadTaskStatus
+from .common import UploadTaskStatus, RetrieveTaskStatus, VerifyTaskStatus
+
+
+class StateDBWriteError(ValueError):
+    # Raised by every call to state DB (including 'flush()' and 'close()') once a write queued for writer thread failed,
+    # whichever thread makes the call, as records of state DB can no longer be relied upon
+    pass
 
 
 class StateDB:
     WORKS_TABLE_NAME = 'works'
+    WORKS_FTS_TABLE_NAME = 'works_fts'
     RUNS_TABLE_NAME = 'runs'
     SECRETS_TABLE_NAME = 'secrets'
+    TAR_FILES_TABLE_NAME = 'tar_files'
+    RETRIEVALS_TABLE_NAME = 'retrievals'
+    CHECKPOINTS_TABLE_NAME = 'checkpoints'
+    CHECKSUMS_TABLE_NAME = 'checksums'
+    VERIFICATIONS_TABLE_NAME = 'verifications'
+    MERGED_TAR_FILES_TABLE_NAME = 'merged_tar_files'
+    WALKED_SHARDS_TABLE_NAME = 'walked_shards'
+
+    # NOTE: After 'correct_db_init_state()', files are only left 'scheduled' if they were packed before last checkpoint
+    _PROCESSED_STATUSES = f"'{UploadTaskStatus.UPLOADED}', '{UploadTaskStatus.SCHEDULED}'"
 
 
     def __init__(self, db_filename, cmd_args=None):
-        self.state_db = sqlite3.connect(db_filename, check_same_thread=False, autocommit=False)
-        self.mutex = Lock()
+        # NOTE: All writes are done by a single writer thread with its own connection so that threads recording
+        # state never wait on each other or on commits. Reads use a separate connection which, in WAL
+        # journal mode, doesn't block or get blocked by the writer.
+        self.db_filename = db_filename
+        self.write_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.writes_committed = Condition()
+        self.num_writes_queued = 0
+        self.num_writes_committed = 0
+        self.write_error: Exception | None = None
+        self.writer_stopped = False
+
+        self.read_mutex = Lock()
+        self.read_lock_wait_latency = LatencyStats("State DB read lock wait")
+        self.write_queue_latency = LatencyStats("State DB write queue wait")
+        self.commit_latency = LatencyStats("State DB commit")
+        self.num_coalesced_writes = 0
+        self.latency_stats_log_level = logging.INFO if cmd_args else logging.DEBUG     # NOTE: Only of interest for backups
+
+        write_connection_ready = Condition()
+        with write_connection_ready:
+            self.writer_thread = Thread(target=self._write_loop,
+                                        args=(write_connection_ready,),
+                                        name='s3-glacier-backup-state-db-writer',
+                                        daemon=True)
+            self.writer_thread.start()
+            write_connection_ready.wait()   # CAUTION: WAL journal mode must be set by writer before reader connects
+        self._raise_if_write_error()
+
+        self.state_db = sqlite3.connect(db_filename, timeout=settings.STATE_DB_BUSY_TIMEOUT_SECS, check_same_thread=False, autocommit=True)
+        self.state_db.create_function('last_nth_dirname', 2, get_last_nth_dirname, deterministic=True)     # NOTE: Used to collate folders
+        self.state_db.create_function('top_level_dirname', 2, get_top_level_dirname, deterministic=True)
 
         self._create_tables()
         if cmd_args: self._record_run(cmd_args)
@@ -31,19 +80,150 @@ class StateDB:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.state_db.close()
+        self.close()
+
+    def close(self) -> None:
+        if self.state_db:
+            # CAUTION: Reader is closed first so that writer is the last connection to close,
+            #          which is when SQLite removes '-wal' and '-shm' files of the DB
+            with self.read_mutex:
+                self.state_db.close()
+                self.state_db = None
+            self.write_queue.put(None)      # NOTE: Tells writer thread to stop after writing everything queued before
+            self.writer_thread.join()
+
+            for latency_stats in self.get_latency_stats().values():
+                latency_stats.log(self.latency_stats_log_level)
+            if self.num_coalesced_writes:
+                logging.log(self.latency_stats_log_level, f"{self.num_coalesced_writes} redundant state DB write(s) were coalesced.")
+        self._raise_if_write_error()
+
+    def _write_loop(self, write_connection_ready: Condition) -> None:     # CAUTION: Runs in state DB writer thread
+        try:
+            write_connection = sqlite3.connect(self.db_filename, timeout=settings.STATE_DB_BUSY_TIMEOUT_SECS, autocommit=True)
+            write_connection.execute("PRAGMA journal_mode=WAL;")
+            write_connection.autocommit = False
 
-    def _execute(self, sql_cmds_to_execute : str | list[str]) -> None:
-        with self.mutex:
-            if isinstance(sql_cmds_to_execute, str):
-                self.state_db.execute(sql_cmds_to_execute)
-            else:
-                for sql_cmd in sql_cmds_to_execute:
-                    self.state_db.execute(sql_cmd)
-            self.state_db.commit()
+        except sqlite3.Error as ex:
+            self.write_error = ex
+            return
 
-    def _fetch(self, sql_cmds_to_execute : str | list[str]) -> list[list[Any]]:
-        with self.mutex:
+        finally:
+            with write_connection_ready:
+                write_connection_ready.notify()
+
+        try:
+            while True:
+                # Write everything queued so far in a single transaction (i.e. group commit)
+                writes = [self.write_queue.get()]
+                while True:
+                    try:
+                        writes.append(self.write_queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = None in writes
+                writes = [write for write in writes if write is not None]
+
+                start_time = time.perf_counter()
+                for queued_time, _ in writes:
+                    self.write_queue_latency.add(start_time - queued_time)
+
+                for sql_cmds_to_execute in self._coalesce_writes(writes):
+                    # NOTE: Each write is in its own savepoint so that a failed write doesn't undo others committed with it
+                    write_connection.execute("SAVEPOINT write;")
+                    try:
+                        for sql_cmd in sql_cmds_to_execute:
+                            write_connection.execute(sql_cmd)
+                    except sqlite3.Error as ex:
+                        # NOTE: Logged right away as it's only raised by the next call to write or read state DB
+                        logging.error(f"Failed to write to state DB with '{repr(ex)}'!")
+                        write_connection.execute("ROLLBACK TO write;")
+                        self.write_error = ex
+                    write_connection.execute("RELEASE write;")
+
+                commit_start_time = time.perf_counter()
+                write_connection.commit()
+                self.commit_latency.add(time.perf_counter() - commit_start_time)
+
+                with self.writes_committed:
+                    self.num_writes_committed += len(writes)
+                    self.writes_committed.notify_all()
+
+                if stop:
+                    # NOTE: Everything in WAL file is moved into DB file so that it's complete on its own
+                    #       even if WAL file is left behind (eg: another process still has DB open)
+                    write_connection.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                    break
+
+        except sqlite3.Error as ex:
+            self.write_error = ex
+
+        finally:
+            write_connection.close()
+            with self.writes_committed:
+                self.writer_stopped = True      # CAUTION: Don't leave anyone waiting for writes that will never be done
+                self.writes_committed.notify_all()
+
+    def _coalesce_writes(self, writes: list[tuple[float, list[tuple[str | None, str]]]]) -> list[list[str]]:     # CAUTION: Runs in state DB writer thread
+        # A write with a coalesce key (eg: status update of a TAR file) completely overwrites what an earlier write
+        # with the same key wrote, so the earlier one is dropped when both are committed together
+        last_sql_cmd_idxs = {coalesce_key: (i, j) for i, (_, sql_cmds) in enumerate(writes)
+                                                  for j, (coalesce_key, _) in enumerate(sql_cmds) if coalesce_key is not None}
+        writes_to_execute = []
+        for i, (_, sql_cmds) in enumerate(writes):
+            sql_cmds_to_execute = [sql_cmd for j, (coalesce_key, sql_cmd) in enumerate(sql_cmds)
+                                   if coalesce_key is None or last_sql_cmd_idxs[coalesce_key] == (i, j)]
+            self.num_coalesced_writes += len(sql_cmds) - len(sql_cmds_to_execute)
+            if sql_cmds_to_execute:
+                writes_to_execute.append(sql_cmds_to_execute)
+
+        return writes_to_execute
+
+    def _raise_if_write_error(self) -> None:
+        # CAUTION: Error isn't cleared so that, unlike with synchronous writes, it can't be caught by a thread that didn't
+        #          make the failed write (eg: an upload worker) and then be lost to the thread that did (eg: packer)
+        if self.write_error is not None:
+            raise StateDBWriteError("Corrupted DB!") from self.write_error
+
+    def _execute(self, sql_cmds_to_execute : str | list[str], coalesce_keys: list[str | None] | None=None) -> None:
+        # NOTE: Writes are queued for writer thread and this returns without waiting for them to be committed.
+        # Use 'flush()' where they must be committed. All SQL commands of a call are committed in a single transaction.
+        self._raise_if_write_error()
+        if self.writer_stopped:
+            raise StateDBWriteError("Corrupted DB!")
+        if isinstance(sql_cmds_to_execute, str):
+            sql_cmds_to_execute = [sql_cmds_to_execute]
+        if coalesce_keys is None:
+            coalesce_keys = [None] * len(sql_cmds_to_execute)
+        assert len(coalesce_keys) == len(sql_cmds_to_execute)
+
+        with self.writes_committed:
+            self.num_writes_queued += 1
+            self.write_queue.put((time.perf_counter(), list(zip(coalesce_keys, sql_cmds_to_execute))))
+
+    def flush(self) -> None:
+        # Waits until all writes queued so far have been committed
+        with self.writes_committed:
+            num_writes_queued = self.num_writes_queued
+            self.writes_committed.wait_for(lambda: self.num_writes_committed >= num_writes_queued or self.writer_stopped)
+        self._raise_if_write_error()
+
+    def get_latency_stats(self) -> dict[str, LatencyStats]:
+        return {'db_read_lock_wait': self.read_lock_wait_latency,
+                'db_write_queue_wait': self.write_queue_latency,
+                'db_commit': self.commit_latency}
+
+    def _fetch(self, sql_cmds_to_execute : str | list[str], wait_for_writes: bool=True) -> list[list[Any]]:
+        # NOTE: By default, reads wait for earlier writes to be committed so that they see them
+        if wait_for_writes:
+            self.flush()
+        else:
+            self._raise_if_write_error()
+
+        start_time = time.perf_counter()
+        with self.read_mutex:
+            self.read_lock_wait_latency.add(time.perf_counter() - start_time)
             if isinstance(sql_cmds_to_execute, str):
                 cursor = self.state_db.execute(sql_cmds_to_execute)
             else:
@@ -52,6 +232,18 @@ class StateDB:
                     cursor.execute(sql_cmd)
             return cursor.fetchall()
 
+    def _iter_fetch(self, sql_cmd_to_execute: str) -> Generator[tuple[Any, ...]]:
+        # Same as '_fetch()' but yields rows in batches instead of loading them all in memory
+        self.flush()
+        with self.read_mutex:
+            cursor = self.state_db.execute(sql_cmd_to_execute)
+        while True:
+            with self.read_mutex:
+                rows = cursor.fetchmany(settings.STATE_DB_FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+
     def _create_tables(self) -> None:
         self._execute([f"CREATE TABLE IF NOT EXISTS {StateDB.WORKS_TABLE_NAME} "\
                        "(id INTEGER PRIMARY KEY AUTOINCREMENT,"\
@@ -62,30 +254,104 @@ class StateDB:
                        f"size INTEGER,"\
                        f"status VARCHAR({maxStrEnumValue(UploadTaskStatus)}));",
 
+                       f"CREATE INDEX IF NOT EXISTS {StateDB.WORKS_TABLE_NAME}_filename_index "\
+                       f"ON {StateDB.WORKS_TABLE_NAME} (filename, status);",
+
                        f"CREATE TABLE IF NOT EXISTS {StateDB.RUNS_TABLE_NAME} "\
                        "(id INTEGER PRIMARY KEY AUTOINCREMENT,"\
                        "datetime DATETIME,"\
                        f"cmd_args_json NVARCHAR({MAX_LINUX_PATH_LENGTH*10}));",
 
                        f"CREATE TABLE IF NOT EXISTS {StateDB.SECRETS_TABLE_NAME} "\
-                       f"(encryption_key VARCHAR({settings.ENCRYPT_KEY_LENGTH}));"])
+                       f"(encryption_key VARCHAR({settings.ENCRYPT_KEY_LENGTH}));",
+
+                       f"CREATE TABLE IF NOT EXISTS {StateDB.TAR_FILES_TABLE_NAME} "\
+                       f"(tar_file NVARCHAR({MAX_LINUX_FILENAME_LENGTH}) PRIMARY KEY,"\
+                       "size INTEGER);",
+
+                       f"CREATE TABLE IF NOT EXISTS {StateDB.RETRIEVALS_TABLE_NAME} "\
+                       f"(tar_file NVARCHAR({MAX_LINUX_FILENAME_LENGTH}) PRIMARY KEY,"\
+                       "datetime DATETIME,"\
+                       f"status VARCHAR({maxStrEnumValue(RetrieveTaskStatus)}));",
+
+                       f"CREATE TABLE IF NOT EXISTS {StateDB.CHECKPOINTS_TABLE_NAME} "\
+                       f"(tar_file NVARCHAR({MAX_LINUX_FILENAME_LENGTH}) PRIMARY KEY,"\
+                       "datetime DATETIME,"\
+                       f"temp_file NVARCHAR({MAX_LINUX_FILENAME_LENGTH}),"\
+                       "size INTEGER,"\
+                       "tar_offset INTEGER,"\
+                       "last_work_id INTEGER);",
+
+                       f"CREATE TABLE IF NOT EXISTS {StateDB.CHECKSUMS_TABLE_NAME} "\
+                       f"(tar_file NVARCHAR({MAX_LINUX_FILENAME_LENGTH}) PRIMARY KEY,"\
+                       "part_size INTEGER,"\
+                       "part_digests BLOB);",
+
+                       f"CREATE TABLE IF NOT EXISTS {StateDB.VERIFICATIONS_TABLE_NAME} "\
+                       f"(tar_file NVARCHAR({MAX_LINUX_FILENAME_LENGTH}) PRIMARY KEY,"\
+                       "datetime DATETIME,"\
+                       f"status VARCHAR({maxStrEnumValue(VerifyTaskStatus)}));",
+
+                       # NOTE: Status TAR files merged from other state DBs (eg: of shards) had in them when last merged
+                       f"CREATE TABLE IF NOT EXISTS {StateDB.MERGED_TAR_FILES_TABLE_NAME} "\
+                       f"(tar_file NVARCHAR({MAX_LINUX_FILENAME_LENGTH}) PRIMARY KEY,"\
+                       "datetime DATETIME,"\
+                       f"status VARCHAR({maxStrEnumValue(UploadTaskStatus)}));",
+
+                       # NOTE: Shards of a sharded backup whose shard process walked and packed all their files
+                       f"CREATE TABLE IF NOT EXISTS {StateDB.WALKED_SHARDS_TABLE_NAME} "\
+                       f"(shard_db_file NVARCHAR({MAX_LINUX_FILENAME_LENGTH}) PRIMARY KEY,"\
+                       "datetime DATETIME);"])
+        self._create_fts_index()
+
+    def _create_fts_index(self) -> None:
+        # NOTE: Full text search index of trigrams of filenames in works table lets 'find' look up substrings and
+        # globs without scanning every record. It is kept up to date by triggers as works are inserted.
+        if self._fetch(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{StateDB.WORKS_FTS_TABLE_NAME}';"):
+            return
+
+        self._execute([f"CREATE VIRTUAL TABLE {StateDB.WORKS_FTS_TABLE_NAME} USING fts5"\
+                       f"(filename, content='{StateDB.WORKS_TABLE_NAME}', content_rowid='id', tokenize='trigram', detail='none');",
+
+                       f"CREATE TRIGGER {StateDB.WORKS_FTS_TABLE_NAME}_insert AFTER INSERT ON {StateDB.WORKS_TABLE_NAME} BEGIN "\
+                       f"INSERT INTO {StateDB.WORKS_FTS_TABLE_NAME} (rowid, filename) VALUES (new.id, new.filename); END;",
+
+                       f"CREATE TRIGGER {StateDB.WORKS_FTS_TABLE_NAME}_delete AFTER DELETE ON {StateDB.WORKS_TABLE_NAME} BEGIN "\
+                       f"INSERT INTO {StateDB.WORKS_FTS_TABLE_NAME} ({StateDB.WORKS_FTS_TABLE_NAME}, rowid, filename) "\
+                       "VALUES ('delete', old.id, old.filename); END;",
+
+                       f"CREATE TRIGGER {StateDB.WORKS_FTS_TABLE_NAME}_update AFTER UPDATE OF filename ON {StateDB.WORKS_TABLE_NAME} BEGIN "\
+                       f"INSERT INTO {StateDB.WORKS_FTS_TABLE_NAME} ({StateDB.WORKS_FTS_TABLE_NAME}, rowid, filename) "\
+                       "VALUES ('delete', old.id, old.filename); "\
+                       f"INSERT INTO {StateDB.WORKS_FTS_TABLE_NAME} (rowid, filename) VALUES (new.id, new.filename); END;",
+
+                       # NOTE: Index existing works of state DBs from older versions
+                       f"INSERT INTO {StateDB.WORKS_FTS_TABLE_NAME} ({StateDB.WORKS_FTS_TABLE_NAME}) VALUES ('rebuild');"])
 
     def _record_run(self, cmd_args_dict) -> None:
         self._execute(f"INSERT INTO {StateDB.RUNS_TABLE_NAME} "\
                       "(datetime, cmd_args_json) VALUES "\
                       f"('{datetime.now(timezone.utc)}', '{json.dumps(cmd_args_dict)}');")
 
-    def _process_work_records(self, work_records) -> list[list[Union[int, str]]]:
-        output_work_records = []
-        for id, datetime_utc, tar_file, filename, modified_time, size, status in work_records:
-            output_work_records.append([id,
-                                        prettyDateTimeString(toLocalDateTimeFromUTCString(datetime_utc)),
-                                        tar_file,
-                                        filename,
-                                        prettyDateTimeString(datetime.fromtimestamp(modified_time).astimezone()),
-                                        prettyFilesize(size),
-                                        UploadTaskStatus(status)])
-        return output_work_records
+    def process_work_record(self, work_record) -> list[Union[int, str]]:
+        # Formats a work record to be shown to user
+        id, datetime_utc, tar_file, filename, modified_time, size, status = work_record
+        return [id,
+                prettyDateTimeString(toLocalDateTimeFromUTCString(datetime_utc)),
+                tar_file,
+                filename,
+                prettyDateTimeString(datetime.fromtimestamp(modified_time).astimezone()),
+                prettyFilesize(size),
+                UploadTaskStatus(status)]
+
+    def process_collated_work_record(self, work_record) -> list[Union[int, str, bool]]:
+        # Formats a collated work record to be shown to user
+        first_id, datetime_utc, tar_files, folder, uploaded = work_record
+        return [first_id,
+                prettyDateTimeString(toLocalDateTimeFromUTCString(datetime_utc)),
+                tar_files,
+                folder,
+                uploaded]
 
     def _set_encryption_key(self, encryption_key: str) -> None:
         try:
@@ -99,9 +365,13 @@ class StateDB:
 
     def correct_db_init_state(self) -> None:
         try:
+            # NOTE: Files already packed in TAR file up to its last checkpoint are left as they are
             self._execute(f"UPDATE {StateDB.WORKS_TABLE_NAME} "\
                           f"SET datetime='{datetime.now(timezone.utc)}', status='{UploadTaskStatus.FAILED}' "\
-                          f"WHERE status NOT IN ('{UploadTaskStatus.PACKAGED}', '{UploadTaskStatus.UPLOADED}', '{UploadTaskStatus.FAILED}');")
+                          f"WHERE status NOT IN ('{UploadTaskStatus.PACKAGED}', '{UploadTaskStatus.UPLOADED}', '{UploadTaskStatus.FAILED}') "\
+                          f"AND NOT EXISTS (SELECT 1 FROM {StateDB.CHECKPOINTS_TABLE_NAME} "\
+                          f"WHERE {StateDB.CHECKPOINTS_TABLE_NAME}.tar_file={StateDB.WORKS_TABLE_NAME}.tar_file "\
+                          f"AND {StateDB.WORKS_TABLE_NAME}.id<={StateDB.CHECKPOINTS_TABLE_NAME}.last_work_id);")
 
         except sqlite3.OperationalError as ex:
             raise ValueError("Corrupted DB!") from ex
@@ -132,55 +402,133 @@ class StateDB:
         except sqlite3.OperationalError as ex:
             raise ValueError("Corrupted DB!") from ex
 
-    def get_work_records_with_headers(self, collate: int) -> tuple[list[str], list[list[Union[str, int, bool]]]]:
+    def record_encryption_key(self, encryption_key: bytes) -> None:
+        # Records a key generated by another state DB (eg: of a sharded backup for its shards) unless one is already recorded
         try:
-            cmd_to_execute = f"SELECT * FROM {StateDB.WORKS_TABLE_NAME} ORDER BY id ASC, filename ASC;"
-            work_records = self._fetch(cmd_to_execute)
-            work_records = self._process_work_records(work_records)
-            if collate:
-                # Rename some headers to be appropriate for collated list
-                record_headers = ['first_id', 'datetime', 'tar_file(s)', 'folder', 'uploaded']
+            if not self._fetch(f"SELECT 1 FROM {StateDB.SECRETS_TABLE_NAME} LIMIT 1;"):
+                self._set_encryption_key(encryption_key.decode('utf-8'))
 
-                collated_work_records = {}
-                for id, datetime_utc, tar_file, filename, modified_time, size, status in work_records:
-                    assert isinstance(filename, str)
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
 
-                    dirname = get_last_nth_dirname(filename, collate)
-                    if dirname not in collated_work_records:
-                        collated_work_records[dirname] = [
-                            id,
-                            datetime_utc,
-                            {tar_file},
-                            dirname,
-                            (status == UploadTaskStatus.UPLOADED)
-                        ]
-                    else:
-                        if status != UploadTaskStatus.UPLOADED or not collated_work_records[dirname][4]:
-                            collated_work_records[dirname][4] = False
-                        collated_work_records[dirname][2].add(tar_file)
+    def get_work_record_headers(self) -> list[str]:
+        try:
+            # NOTE: 'PRAGMA_TABLE_INFO' contains information about tables in a DB
+            return list(map(lambda x: x[0],
+                            self._fetch(f"SELECT name FROM PRAGMA_TABLE_INFO('{StateDB.WORKS_TABLE_NAME}');")))
 
-                for value in collated_work_records.values():
-                    value[2] = list(value[2])
-                    value[2].sort()     # Sorting tar_file column in ascending order
-                    value[2] = ", ".join(value[2])
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
 
-                work_records = list(collated_work_records.values())
-            else:
-                # NOTE: 'PRAGMA_TABLE_INFO' contains information about tables in a DB
-                record_headers = list(map(lambda x: x[0],
-                                          self._fetch(f"SELECT name FROM PRAGMA_TABLE_INFO('{StateDB.WORKS_TABLE_NAME}');")))
+    def get_work_records_with_headers(self,
+                                      collate: int,
+                                      status: UploadTaskStatus | None=None,
+                                      limit: int | None=None,
+                                      offset: int=0) -> tuple[list[str], Generator[tuple[Any, ...]]]:
+        # NOTE: Records are streamed from state DB and folders are collated by SQLite
+        # so that memory used doesn't grow with number of records
+        where_clause = f"WHERE status='{status}' " if status else ""
+        limit_clause = f"LIMIT {int(limit) if limit is not None else -1} OFFSET {int(offset)}"
+        if collate:
+            # Rename some headers to be appropriate for collated list
+            record_headers = ['first_id', 'datetime', 'tar_file(s)', 'folder', 'uploaded']
+
+            # NOTE: 'datetime' isn't aggregated so SQLite takes it from the record with 'MIN(id)'.
+            # TAR files are first grouped in each folder so that they are listed only once. They are sorted
+            # there as 'GROUP_CONCAT' concatenates in order of rows (i.e. 'ORDER BY' in it needs SQLite 3.44).
+            cmd_to_execute = "SELECT MIN(first_id), datetime, GROUP_CONCAT(tar_file, ', '), folder, SUM(num_not_uploaded)=0 FROM "\
+                             f"(SELECT last_nth_dirname(filename, {int(collate)}) AS folder, tar_file, MIN(id) AS first_id, datetime, "\
+                             f"SUM(status!='{UploadTaskStatus.UPLOADED}') AS num_not_uploaded "\
+                             f"FROM {StateDB.WORKS_TABLE_NAME} {where_clause}GROUP BY folder, tar_file ORDER BY folder, tar_file ASC) "\
+                             f"GROUP BY folder ORDER BY MIN(first_id) ASC {limit_clause};"
+        else:
+            record_headers = self.get_work_record_headers()
+            cmd_to_execute = f"SELECT * FROM {StateDB.WORKS_TABLE_NAME} {where_clause}ORDER BY id ASC {limit_clause};"
+
+        return record_headers, self._iter_work_records(cmd_to_execute, collate > 0)
+
+    def _iter_work_records(self, cmd_to_execute: str, collated: bool) -> Generator[tuple[Any, ...]]:
+        try:
+            for work_record in self._iter_fetch(cmd_to_execute):
+                if collated:
+                    first_id, datetime_utc, tar_files, folder, uploaded = work_record
+                    work_record = (first_id, datetime_utc, tar_files, folder, bool(uploaded))
+                yield work_record
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_num_tar_files_per_top_level_folder(self, src_dirs: list[str]) -> dict[str, int]:
+        # Returns number of TAR files that files of each top-level folder (i.e. folder directly in a source directory) are in
+        try:
+            num_tar_files_per_folder = {}
+            for src_dir in src_dirs:
+                # NOTE: Files in 'src_dir' are those between '<src_dir>/' and '<src_dir>0' as '0' comes after '/'
+                escaped_src_dir = escape_sql_escape_chars(src_dir.rstrip(os.path.sep))
+                work_records = self._fetch(f"SELECT top_level_dirname(filename, '{escape_sql_escape_chars(src_dir)}') AS folder, COUNT(DISTINCT tar_file) "\
+                                           f"FROM {StateDB.WORKS_TABLE_NAME} WHERE status IN ({StateDB._PROCESSED_STATUSES}) "\
+                                           f"AND filename > '{escaped_src_dir}{os.path.sep}' AND filename < '{escaped_src_dir}0' GROUP BY folder;")
+                num_tar_files_per_folder.update(work_records)
+            return num_tar_files_per_folder
 
         except sqlite3.OperationalError as ex:
             raise ValueError("Corrupted DB!") from ex
 
-        return record_headers, work_records
+    def count_already_processed_files(self) -> int:
+        try:
+            work_records = self._fetch("SELECT COUNT(*) "\
+                                       f"FROM {StateDB.WORKS_TABLE_NAME} WHERE status IN ({StateDB._PROCESSED_STATUSES});")
+            return work_records[0][0]
 
-    def get_already_uploaded_files(self) -> set[str]:
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def iter_already_processed_files(self) -> Generator[str]:
         try:
-            work_records = self._fetch("SELECT filename "\
-                                       f"FROM {StateDB.WORKS_TABLE_NAME} WHERE status='{UploadTaskStatus.UPLOADED}';")
-            work_records = set(map(lambda x: x[0], work_records))
-            return work_records
+            for work_record in self._iter_fetch("SELECT filename "\
+                                                f"FROM {StateDB.WORKS_TABLE_NAME} WHERE status IN ({StateDB._PROCESSED_STATUSES});"):
+                yield work_record[0]
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def is_file_already_processed(self, filename: str) -> bool:
+        try:
+            # NOTE: Uses 'works_filename_index' so doesn't scan works table. Files processed by earlier
+            # runs were committed before this run started so this doesn't wait for writes of this run.
+            work_records = self._fetch(f"SELECT 1 FROM {StateDB.WORKS_TABLE_NAME} "\
+                                       f"WHERE filename='{escape_sql_escape_chars(filename)}' AND status IN ({StateDB._PROCESSED_STATUSES}) LIMIT 1;",
+                                       wait_for_writes=False)
+            return len(work_records) > 0
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def iter_failed_files(self) -> Generator[str]:
+        # Yields files that failed to be backed up and haven't been processed since (i.e. that resume backs up again)
+        try:
+            for work_record in self._iter_fetch(f"SELECT DISTINCT filename FROM {StateDB.WORKS_TABLE_NAME} AS failed_works "\
+                                                f"WHERE status='{UploadTaskStatus.FAILED}' AND NOT EXISTS "\
+                                                f"(SELECT 1 FROM {StateDB.WORKS_TABLE_NAME} WHERE filename=failed_works.filename "\
+                                                f"AND status IN ({StateDB._PROCESSED_STATUSES}));"):
+                yield work_record[0]
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_last_work_id(self) -> int:
+        try:
+            work_records = self._fetch(f"SELECT MAX(id) FROM {StateDB.WORKS_TABLE_NAME};")
+            return work_records[0][0] or 0
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def count_work_records(self, last_work_id: int) -> int:
+        # NOTE: Work IDs aren't reused so this only goes down if work records up to 'last_work_id' were deleted
+        try:
+            work_records = self._fetch(f"SELECT COUNT(*) FROM {StateDB.WORKS_TABLE_NAME} WHERE id<={int(last_work_id)};")
+            return work_records[0][0]
 
         except sqlite3.OperationalError as ex:
             raise ValueError("Corrupted DB!") from ex
@@ -205,6 +553,98 @@ class StateDB:
         except sqlite3.OperationalError as ex:
             raise ValueError("Corrupted DB!") from ex
 
+    def get_all_tar_files(self) -> set[str]:
+        try:
+            work_records = self._fetch(f"SELECT DISTINCT tar_file FROM {StateDB.WORKS_TABLE_NAME} "\
+                                       f"UNION SELECT tar_file FROM {StateDB.TAR_FILES_TABLE_NAME};")
+            return set(map(lambda x: x[0], work_records))
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_tar_file_sizes(self) -> dict[str, int]:
+        try:
+            # NOTE: State DBs from older versions don't record TAR file sizes
+            tar_file_records = self._fetch(f"SELECT tar_file, size FROM {StateDB.TAR_FILES_TABLE_NAME};")
+            return dict(tar_file_records)
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_tar_file_contents_sizes(self) -> dict[str, int]:
+        try:
+            work_records = self._fetch(f"SELECT tar_file, SUM(size) FROM {StateDB.WORKS_TABLE_NAME} GROUP BY tar_file;")
+            return dict(work_records)
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_uploaded_file_records(self,
+                                  filename_globs: list[str] | None=None,
+                                  modified_after: int | None=None,
+                                  modified_before: int | None=None) -> list[tuple[str, str, int]]:
+        # Returns filename, TAR file and size of uploaded files matching any of the Unix style globs
+        # and modified within the timestamp range. Filtering is done by SQLite instead of in Python.
+        conditions = [f"status='{UploadTaskStatus.UPLOADED}'"]
+        if filename_globs:
+            conditions.append("(" + " OR ".join(f"filename GLOB '{escape_sql_escape_chars(filename_glob)}'"
+                                                for filename_glob in filename_globs) + ")")
+        if modified_after is not None:
+            conditions.append(f"modified_time >= {int(modified_after)}")
+        if modified_before is not None:
+            conditions.append(f"modified_time < {int(modified_before)}")
+
+        try:
+            return self._fetch("SELECT filename, tar_file, size "\
+                               f"FROM {StateDB.WORKS_TABLE_NAME} WHERE {" AND ".join(conditions)} ORDER BY filename ASC;")
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def iter_found_work_records(self,
+                                query: str,
+                                is_glob: bool,
+                                min_size: int | None=None,
+                                max_size: int | None=None,
+                                modified_after: int | None=None,
+                                modified_before: int | None=None,
+                                limit: int | None=None) -> Generator[tuple[Any, ...]]:
+        # Yields work records whose filename contains 'query' (case insensitive) or, if 'is_glob',
+        # matches Unix style glob 'query' (case sensitive) using full text search index
+        escaped_query = escape_sql_escape_chars(query)
+        if is_glob:
+            conditions = [f"{StateDB.WORKS_FTS_TABLE_NAME}.filename GLOB '{escaped_query}'"]
+        else:
+            # CAUTION: Index isn't used for LIKE with ESCAPE so '%' and '_' in query are matched
+            # as wildcards by index and then exactly by 'instr()'
+            conditions = [f"{StateDB.WORKS_FTS_TABLE_NAME}.filename LIKE '%{escaped_query}%'",
+                          f"instr(lower({StateDB.WORKS_TABLE_NAME}.filename), lower('{escaped_query}')) > 0"]
+        if min_size is not None:
+            conditions.append(f"size >= {int(min_size)}")
+        if max_size is not None:
+            conditions.append(f"size <= {int(max_size)}")
+        if modified_after is not None:
+            conditions.append(f"modified_time >= {int(modified_after)}")
+        if modified_before is not None:
+            conditions.append(f"modified_time < {int(modified_before)}")
+
+        try:
+            yield from self._iter_fetch(f"SELECT {StateDB.WORKS_TABLE_NAME}.* FROM {StateDB.WORKS_TABLE_NAME} "\
+                                        f"JOIN {StateDB.WORKS_FTS_TABLE_NAME} ON {StateDB.WORKS_FTS_TABLE_NAME}.rowid={StateDB.WORKS_TABLE_NAME}.id "\
+                                        f"WHERE {" AND ".join(conditions)} ORDER BY {StateDB.WORKS_TABLE_NAME}.id ASC"\
+                                        f"{f" LIMIT {int(limit)}" if limit is not None else ""};")
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_retrieval_states(self) -> dict[str, RetrieveTaskStatus]:
+        try:
+            retrieval_records = self._fetch(f"SELECT tar_file, status FROM {StateDB.RETRIEVALS_TABLE_NAME};")
+            return {tar_file: RetrieveTaskStatus(status) for tar_file, status in retrieval_records}
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
     def count_already_packaged_tar_files(self) -> int:
         try:
             work_records = self._fetch("SELECT COUNT(DISTINCT tar_file) "\
@@ -228,13 +668,274 @@ class StateDB:
                     assert tar_file
                     self._execute(f"UPDATE {StateDB.WORKS_TABLE_NAME} "\
                                   f"SET datetime='{datetime.now(timezone.utc)}', status='{task_status}' "\
-                                  f"WHERE tar_file='{tar_file}';")
+                                  f"WHERE tar_file='{tar_file}';",
+                                  coalesce_keys=[f"{StateDB.WORKS_TABLE_NAME}.status:{tar_file}"])
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def record_changed_work_states(self, task_status: UploadTaskStatus, tar_files: list[str]) -> None:
+        # Same as 'record_changed_work_state()' for many TAR files at once but committed in a single transaction
+        assert task_status != UploadTaskStatus.SCHEDULED
+        try:
+            self._execute([f"UPDATE {StateDB.WORKS_TABLE_NAME} "\
+                           f"SET datetime='{datetime.now(timezone.utc)}', status='{task_status}' "\
+                           f"WHERE tar_file='{tar_file}';" for tar_file in tar_files],
+                          coalesce_keys=[f"{StateDB.WORKS_TABLE_NAME}.status:{tar_file}" for tar_file in tar_files])
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def record_changed_retrieval_states(self, task_status: RetrieveTaskStatus, tar_files: list[str]) -> None:
+        # NOTE: All state changes are committed in a single transaction
+        if not tar_files:
+            return
+
+        try:
+            self._execute([f"INSERT OR REPLACE INTO {StateDB.RETRIEVALS_TABLE_NAME} "\
+                           "(tar_file, datetime, status) VALUES "\
+                           f"('{tar_file}', '{datetime.now(timezone.utc)}', '{task_status}');" for tar_file in tar_files],
+                          coalesce_keys=[f"{StateDB.RETRIEVALS_TABLE_NAME}:{tar_file}" for tar_file in tar_files])
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def record_tar_file_size(self, tar_file: str, size: int) -> None:
+        try:
+            self._execute(f"INSERT OR REPLACE INTO {StateDB.TAR_FILES_TABLE_NAME} "\
+                          "(tar_file, size) VALUES "\
+                          f"('{tar_file}', {size});",
+                          coalesce_keys=[f"{StateDB.TAR_FILES_TABLE_NAME}:{tar_file}"])
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def record_part_checksums(self, tar_file: str, part_size: int, part_digests: bytes) -> None:
+        # NOTE: Digests of parts of TAR file being packed are recorded at checkpoints and then when it's complete
+        try:
+            self._execute(f"INSERT OR REPLACE INTO {StateDB.CHECKSUMS_TABLE_NAME} "\
+                          "(tar_file, part_size, part_digests) VALUES "\
+                          f"('{tar_file}', {part_size}, X'{part_digests.hex()}');",
+                          coalesce_keys=[f"{StateDB.CHECKSUMS_TABLE_NAME}:{tar_file}"])
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_all_part_checksums(self) -> dict[str, tuple[int, bytes]]:
+        # Returns part size and (concatenated) SHA-256 digests of parts of each TAR file
+        # NOTE: State DBs from older versions don't record checksums
+        try:
+            checksum_records = self._fetch(f"SELECT tar_file, part_size, part_digests FROM {StateDB.CHECKSUMS_TABLE_NAME};")
+            return {tar_file: (part_size, part_digests) for tar_file, part_size, part_digests in checksum_records}
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_part_checksums(self, tar_file: str) -> tuple[int, bytes] | None:
+        try:
+            checksum_records = self._fetch("SELECT part_size, part_digests "\
+                                           f"FROM {StateDB.CHECKSUMS_TABLE_NAME} WHERE tar_file='{tar_file}';")
+            return tuple(checksum_records[0]) if checksum_records else None
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def record_changed_verification_states(self, task_status: VerifyTaskStatus, tar_files: list[str]) -> None:
+        # NOTE: All state changes are committed in a single transaction
+        if not tar_files:
+            return
+
+        try:
+            self._execute([f"INSERT OR REPLACE INTO {StateDB.VERIFICATIONS_TABLE_NAME} "\
+                           "(tar_file, datetime, status) VALUES "\
+                           f"('{tar_file}', '{datetime.now(timezone.utc)}', '{task_status}');" for tar_file in tar_files],
+                          coalesce_keys=[f"{StateDB.VERIFICATIONS_TABLE_NAME}:{tar_file}" for tar_file in tar_files])
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_checkpoint(self) -> tuple[str, str, int, int, int] | None:
+        # Returns TAR file, its temporary file, size, TAR offset and ID of last work record in it at last checkpoint
+        try:
+            checkpoint_records = self._fetch("SELECT tar_file, temp_file, size, tar_offset, last_work_id "\
+                                             f"FROM {StateDB.CHECKPOINTS_TABLE_NAME} LIMIT 1;")
+            return tuple(checkpoint_records[0]) if checkpoint_records else None
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def record_checkpoint(self, tar_file: str, temp_file: str, size: int, tar_offset: int) -> None:
+        # NOTE: Last work record is the file that was last added to TAR file as files are recorded just before being added
+        try:
+            self._execute(f"INSERT OR REPLACE INTO {StateDB.CHECKPOINTS_TABLE_NAME} "\
+                          "(tar_file, datetime, temp_file, size, tar_offset, last_work_id) "\
+                          f"SELECT '{tar_file}', '{datetime.now(timezone.utc)}', '{temp_file}', {size}, {tar_offset}, MAX(id) "\
+                          f"FROM {StateDB.WORKS_TABLE_NAME};",
+                          coalesce_keys=[f"{StateDB.CHECKPOINTS_TABLE_NAME}:{tar_file}"])
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def rollback_to_checkpoint(self, tar_file: str, last_work_id: int) -> None:
+        # Delete records of files added to TAR file after its last checkpoint so that they are packed again
+        try:
+            self._execute(f"DELETE FROM {StateDB.WORKS_TABLE_NAME} WHERE tar_file='{tar_file}' AND id>{last_work_id};")
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def delete_checkpoint(self, tar_file: str) -> None:
+        try:
+            self._execute(f"DELETE FROM {StateDB.CHECKPOINTS_TABLE_NAME} WHERE tar_file='{tar_file}';")
 
         except sqlite3.OperationalError as ex:
             raise ValueError("Corrupted DB!") from ex
 
     def delete_all_work_records(self) -> None:
-        self._execute(f"DELETE FROM {StateDB.WORKS_TABLE_NAME};")
+        self._execute([f"DELETE FROM {StateDB.WORKS_TABLE_NAME};",
+                       f"DELETE FROM {StateDB.TAR_FILES_TABLE_NAME};",
+                       f"DELETE FROM {StateDB.RETRIEVALS_TABLE_NAME};",
+                       f"DELETE FROM {StateDB.CHECKPOINTS_TABLE_NAME};",
+                       f"DELETE FROM {StateDB.CHECKSUMS_TABLE_NAME};",
+                       f"DELETE FROM {StateDB.VERIFICATIONS_TABLE_NAME};"])
+
+    def record_merged_state_dbs(self, state_dbs: list['StateDB']) -> None:
+        # Merges works, TAR files, checksums and verifications of given state DBs (eg: of shards of a sharded backup)
+        # into this one. Only TAR files that have been packed are merged. TAR files merged before are only updated if
+        # their status changed in the given state DB (eg: they were uploaded) and is still what was merged in this one,
+        # so that changes made in this one since (eg: marked failed by 'verify' or deleted) aren't undone.
+        # NOTE: Records are copied in batches, each in a transaction of its own, so that memory used doesn't grow with
+        # number of records. If interrupted, merging again continues from what was copied.
+        try:
+            merged_tar_file_states = dict(self._fetch(f"SELECT tar_file, status FROM {StateDB.MERGED_TAR_FILES_TABLE_NAME};"))
+            tar_files = {tar_file for tar_file, in self._fetch(f"SELECT DISTINCT tar_file FROM {StateDB.WORKS_TABLE_NAME};")}
+            for state_db in state_dbs:
+                # NOTE: Files of a TAR file all have the same status once it's packed
+                tar_file_states = dict(state_db._fetch(f"SELECT tar_file, MIN(status) FROM {StateDB.WORKS_TABLE_NAME} GROUP BY tar_file "\
+                                                       f"HAVING COUNT(DISTINCT status)=1 AND MIN(status)!='{UploadTaskStatus.SCHEDULED}';"))
+
+                # CAUTION: TAR files merged by older versions (which replaced all records) aren't copied again
+                new_tar_files = {tar_file for tar_file in tar_file_states if tar_file not in merged_tar_file_states and tar_file not in tar_files}
+                records = state_db._iter_fetch(f"SELECT datetime, tar_file, filename, modified_time, size, status FROM {StateDB.WORKS_TABLE_NAME} ORDER BY id ASC;")
+                for batch_records in batched((record for record in records if record[1] in new_tar_files), settings.STATE_DB_FETCH_BATCH_SIZE):
+                    self._execute(f"INSERT INTO {StateDB.WORKS_TABLE_NAME} (datetime, tar_file, filename, modified_time, size, status) VALUES "\
+                                  + ", ".join(f"({', '.join(map(StateDB._to_sql_literal, record))})" for record in batch_records) + ";")
+                tar_files |= new_tar_files
+
+                changed_tar_file_states = {tar_file: status for tar_file, status in tar_file_states.items()
+                                           if tar_file in merged_tar_file_states and merged_tar_file_states[tar_file] != status}
+                if changed_tar_file_states:
+                    self._execute([f"UPDATE {StateDB.WORKS_TABLE_NAME} SET datetime='{datetime.now(timezone.utc)}', status='{status}' "\
+                                   f"WHERE tar_file='{tar_file}' AND status='{merged_tar_file_states[tar_file]}';"
+                                   for tar_file, status in changed_tar_file_states.items()])
+
+                # NOTE: Sizes and checksums don't change once TAR files are packed but verifications done in this state DB are kept
+                for table_name, column_names, insert_cmd in [(StateDB.TAR_FILES_TABLE_NAME, "tar_file, size", "INSERT OR REPLACE"),
+                                                             (StateDB.CHECKSUMS_TABLE_NAME, "tar_file, part_size, part_digests", "INSERT OR REPLACE"),
+                                                             (StateDB.VERIFICATIONS_TABLE_NAME, "tar_file, datetime, status", "INSERT OR IGNORE")]:
+                    records = state_db._iter_fetch(f"SELECT {column_names} FROM {table_name} ORDER BY tar_file ASC;")
+                    for batch_records in batched((record for record in records if record[0] in tar_file_states and record[0] in tar_files),
+                                                 settings.STATE_DB_FETCH_BATCH_SIZE):
+                        self._execute(f"{insert_cmd} INTO {table_name} ({column_names}) VALUES "\
+                                      + ", ".join(f"({', '.join(map(StateDB._to_sql_literal, record))})" for record in batch_records) + ";")
+
+                # CAUTION: Recorded last so that TAR files are merged again if interrupted before
+                for batch_tar_file_states in batched(tar_file_states.items(), settings.STATE_DB_FETCH_BATCH_SIZE):
+                    self._execute(f"INSERT OR REPLACE INTO {StateDB.MERGED_TAR_FILES_TABLE_NAME} (tar_file, datetime, status) VALUES "\
+                                  + ", ".join(f"('{tar_file}', '{datetime.now(timezone.utc)}', '{status}')" for tar_file, status in batch_tar_file_states) + ";")
+                merged_tar_file_states.update(tar_file_states)
+            self.flush()
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def record_changes_in_merged_state_dbs(self, state_dbs: list['StateDB']) -> None:
+        # Records changes made in this state DB to TAR files merged from given state DBs (i.e. marked failed by 'verify'
+        # or 'sync', or deleted) in them too so that resuming them backs up files of those TAR files again
+        try:
+            merged_tar_files = {tar_file for tar_file, in self._fetch(f"SELECT tar_file FROM {StateDB.MERGED_TAR_FILES_TABLE_NAME};")}
+            tar_file_states = dict(self._fetch(f"SELECT tar_file, MIN(status) FROM {StateDB.WORKS_TABLE_NAME} GROUP BY tar_file;"))
+            for state_db in state_dbs:
+                state_db_tar_file_states = dict(state_db._fetch(f"SELECT tar_file, MIN(status) FROM {StateDB.WORKS_TABLE_NAME} GROUP BY tar_file;"))
+                deleted_tar_files = [tar_file for tar_file in state_db_tar_file_states if tar_file in merged_tar_files and tar_file not in tar_file_states]
+                failed_tar_files = [tar_file for tar_file, status in state_db_tar_file_states.items()
+                                    if tar_file in merged_tar_files and tar_file_states.get(tar_file) == UploadTaskStatus.FAILED and status != UploadTaskStatus.FAILED]
+                if failed_tar_files:
+                    state_db.record_changed_work_states(UploadTaskStatus.FAILED, failed_tar_files)
+                if deleted_tar_files:
+                    # NOTE: Shard is walked again to find files of deleted TAR files
+                    state_db.delete_work_records(deleted_tar_files)
+                if deleted_tar_files or failed_tar_files:
+                    logging.info(f"Recorded {len(failed_tar_files)} TAR file(s) marked '{UploadTaskStatus.FAILED}' and {len(deleted_tar_files)} deleted "\
+                                 f"in '{state_db.db_filename}'.")
+                    state_db.flush()
+                if deleted_tar_files:
+                    # CAUTION: Deleted TAR files are no longer recorded as merged only once they are deleted in shard state DB as that's
+                    #          how they are found to be deleted. As shard can pack a TAR file with the same name again (i.e. numbered
+                    #          after the last one it has records of), it would otherwise be left out of later merges.
+                    self._execute([f"DELETE FROM {StateDB.WALKED_SHARDS_TABLE_NAME} "\
+                                   f"WHERE shard_db_file='{escape_sql_escape_chars(os.path.basename(state_db.db_filename))}';"] +\
+                                  [f"DELETE FROM {StateDB.MERGED_TAR_FILES_TABLE_NAME} WHERE tar_file='{tar_file}';" for tar_file in deleted_tar_files])
+                    self.flush()
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def record_walked_shard(self, shard_db_filename: str) -> None:
+        try:
+            self._execute(f"INSERT OR REPLACE INTO {StateDB.WALKED_SHARDS_TABLE_NAME} "\
+                          "(shard_db_file, datetime) VALUES "\
+                          f"('{escape_sql_escape_chars(os.path.basename(shard_db_filename))}', '{datetime.now(timezone.utc)}');")
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def get_walked_shards(self) -> set[str]:
+        # NOTE: Shard state DBs are recorded by filename only so that they can be moved along with this state DB
+        try:
+            walked_shard_records = self._fetch(f"SELECT shard_db_file FROM {StateDB.WALKED_SHARDS_TABLE_NAME};")
+            return set(map(lambda x: x[0], walked_shard_records))
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    def has_unfinished_works(self) -> bool:
+        # Returns if any file recorded isn't uploaded yet (i.e. is being packed, waiting to be uploaded or failed)
+        # NOTE: Records of files that failed are kept after they are backed up again in another TAR file
+        try:
+            work_records = self._fetch(f"SELECT 1 FROM {StateDB.WORKS_TABLE_NAME} AS works WHERE status!='{UploadTaskStatus.UPLOADED}' "\
+                                       f"AND NOT EXISTS (SELECT 1 FROM {StateDB.WORKS_TABLE_NAME} AS uploaded_works "\
+                                       f"WHERE uploaded_works.filename=works.filename AND uploaded_works.status='{UploadTaskStatus.UPLOADED}') "\
+                                       f"UNION ALL SELECT 1 FROM {StateDB.CHECKPOINTS_TABLE_NAME} LIMIT 1;")
+            return len(work_records) > 0
+
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Corrupted DB!") from ex
+
+    @staticmethod
+    def _to_sql_literal(value: Any) -> str:
+        match value:
+            case None:
+                return "NULL"
+            case bytes():
+                return f"X'{value.hex()}'"
+            case str():
+                return f"'{escape_sql_escape_chars(value)}'"
+            case _:
+                return str(value)
 
     def delete_work_record(self, tar_file: str) -> None:
-        self._execute(f"DELETE FROM {StateDB.WORKS_TABLE_NAME} WHERE tar_file='{tar_file}';")
+        self.delete_work_records([tar_file])
+
+    def delete_work_records(self, tar_files: list[str]) -> None:
+        # NOTE: All records are deleted in a single transaction
+        sql_cmds_to_execute = []
+        for tar_file in tar_files:
+            sql_cmds_to_execute += [f"DELETE FROM {StateDB.WORKS_TABLE_NAME} WHERE tar_file='{tar_file}';",
+                                    f"DELETE FROM {StateDB.TAR_FILES_TABLE_NAME} WHERE tar_file='{tar_file}';",
+                                    f"DELETE FROM {StateDB.RETRIEVALS_TABLE_NAME} WHERE tar_file='{tar_file}';",
+                                    f"DELETE FROM {StateDB.CHECKPOINTS_TABLE_NAME} WHERE tar_file='{tar_file}';",
+                                    f"DELETE FROM {StateDB.CHECKSUMS_TABLE_NAME} WHERE tar_file='{tar_file}';",
+                                    f"DELETE FROM {StateDB.VERIFICATIONS_TABLE_NAME} WHERE tar_file='{tar_file}';"]
+        if sql_cmds_to_execute:
+            self._execute(sql_cmds_to_execute)
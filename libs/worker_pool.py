@@ -1,5 +1,6 @@
+import os
 import sys
-import os.path
+import time
 import logging
 from time import sleep
 from copy import deepcopy
@@ -11,8 +12,6 @@ from concurrent.futures import ThreadPoolExecutor,\
                                 ALL_COMPLETED
 
 import sqlite3
-import boto3
-import boto3.session
 import boto3.s3.transfer
 from rich.progress import Progress,\
                           TaskID,\
@@ -23,36 +22,55 @@ from rich.progress import Progress,\
                           TimeRemainingColumn,\
                           TimeElapsedColumn
 
-from .state_db import StateDB
+from .state_db import StateDB, StateDBWriteError
+from .metrics import Metrics
+from .buffer_pool import BufferPool
 from .fileobjs import DecryptFileObj
-from .common import TaskType, UploadTaskStatus
+from .common import TaskType, UploadTaskStatus, RetrieveTaskStatus
+from .s3 import get_s3_client
+from .async_transfers import AsyncTransfers
 
 import settings
 from utils import remove_file_ignore_errors,\
+                  drop_from_page_cache,\
                   mins_to_secs,\
                   KB_to_bytes,\
+                  get_upload_part_size,\
                   logrithmic_scale_value
 
 
 class WorkerPool:
+    TASK_TYPE_VERBS = {
+        TaskType.UPLOAD: ('Uploading', 'Uploaded'),
+        TaskType.DECRYPT: ('Decrypting', 'Decrypted'),
+        TaskType.DOWNLOAD: ('Downloading', 'Downloaded'),
+    }
+
     def __init__(self,
                  num_workers: int,
                  task_type: TaskType,
                  autoclean: bool,
                  state_db: StateDB,
                  s3_bucket_name: str | None=None,
-                 test_run: bool=False):
+                 test_run: bool=False,
+                 drop_page_cache: bool=False,
+                 metrics: Metrics | None=None,
+                 buffer_pool: BufferPool | None=None,
+                 transfer_engine: str=settings.DEFAULT_TRANSFER_ENGINE):
         self.num_workers = num_workers
         self.task_type = task_type
         self.autoclean = autoclean
         self.state_db = state_db
         self.s3_bucket_name = s3_bucket_name
         self.test_run = test_run
+        self.drop_page_cache = drop_page_cache
+        self.metrics = metrics
+        self.buffer_pool = buffer_pool or BufferPool(sys.maxsize)   # NOTE: No memory budget
 
         self.thread_pool = ThreadPoolExecutor(max_workers=num_workers,
                                               thread_name_prefix=f's3-glacier-backup-{self.task_type}')
         self.task_futures: list[Future] = []
-        if task_type == TaskType.UPLOAD:
+        if task_type in [TaskType.UPLOAD, TaskType.DOWNLOAD]:
             self.progresses = Progress(TextColumn("[progress.description]{task.description}"),
                                        BarColumn(),
                                        DownloadColumn(),
@@ -61,6 +79,13 @@ class WorkerPool:
                                        TimeElapsedColumn(), transient=False, refresh_per_second=1)
             self.progresses.start()
             self.progress_tasks_dict: dict[str, TaskID] = {}
+            self.page_cache_fds_dict: dict[str, list[int]] = {}     # tar_file -> [fd, bytes uploaded, bytes dropped]
+
+        # NOTE: With 'asyncio' transfer engine, workers only wait for their transfer while its parts are sent on an event loop
+        # so that many parts can be in flight without a thread for each. Its bandwidth limit is shared by all uploads and downloads.
+        self.async_transfers: AsyncTransfers | None = None
+        if transfer_engine == 'asyncio' and task_type in [TaskType.UPLOAD, TaskType.DOWNLOAD]:
+            self.async_transfers = AsyncTransfers(settings.TOTAL_MAX_BANDWIDTH_BYTES_PER_SEC if settings.TOTAL_MAX_BANDWIDTH_BYTES_PER_SEC > 0 else None)
 
 
     def __enter__(self):
@@ -72,21 +97,29 @@ class WorkerPool:
                                   cancel_futures=exc_type is KeyboardInterrupt)
         del self.thread_pool
 
-        if self.task_type == TaskType.UPLOAD:
+        if self.async_transfers:
+            self.async_transfers.close()
+        if self.task_type in [TaskType.UPLOAD, TaskType.DOWNLOAD]:
             self.progresses.stop()
 
-    def _upload_progress_callback(self, tar_file: str, bytes_processed: int):
+    def _progress_callback(self, tar_file: str, bytes_processed: int):
         progress_task = self.progress_tasks_dict[tar_file]
         self.progresses.update(progress_task, advance=bytes_processed)
 
-    def _work(self, tar_file: str, tar_filename: str) -> None:      # CAUTION: Runs in worker thread
-        assert self.task_type in [TaskType.UPLOAD, TaskType.DECRYPT]
+        if tar_file in self.page_cache_fds_dict:
+            # Drop already uploaded parts of TAR file from page cache
+            page_cache_fd = self.page_cache_fds_dict[tar_file]
+            page_cache_fd[1] += bytes_processed
+            if page_cache_fd[1] - page_cache_fd[2] >= settings.DROP_PAGE_CACHE_WINDOW_SIZE_BYTES:
+                drop_from_page_cache(page_cache_fd[0], page_cache_fd[2], page_cache_fd[1] - page_cache_fd[2])
+                page_cache_fd[2] = page_cache_fd[1]
+
+    def _work(self, tar_file: str, tar_filename: str, state_db: StateDB) -> None:      # CAUTION: Runs in worker thread
+        assert self.task_type in [TaskType.UPLOAD, TaskType.DECRYPT, TaskType.DOWNLOAD]
 
         match self.task_type:
             case TaskType.UPLOAD:
-                session = boto3.Session()   # NOTE: Load S3 credentials and configuration from '~/.aws'
-                session_config = boto3.session.Config(retries={'max_attempts': settings.MAX_RETRY_ATTEMPTS, 'mode': 'standard'})
-                s3_client = session.client('s3', config=session_config)
+                s3_client = get_s3_client()
                 S3_EXTRA_ARGS_DICT = {
                     'ChecksumAlgorithm': 'sha256'
                 }
@@ -96,49 +129,119 @@ class WorkerPool:
 
                 MAX_BANDWIDTH_PER_WORKER_BYTES_PER_SEC = max(settings.TOTAL_MAX_BANDWIDTH_BYTES_PER_SEC // self.num_workers, KB_to_bytes(1))\
                                                                 if settings.TOTAL_MAX_BANDWIDTH_BYTES_PER_SEC > 0 else None
-                transfer_config = boto3.s3.transfer.TransferConfig(max_concurrency=settings.MAX_CONCURRENT_SINGLE_FILE_UPLOADS,
+                # CAUTION: TAR file must be uploaded in parts of the size its checksums were worked out for while packing
+                # so that S3 ends up with the checksum 'verify' expects. Only TAR files packed by older versions have none.
+                part_checksums = state_db.get_part_checksums(tar_file)
+                upload_part_size = part_checksums[0] if part_checksums else get_upload_part_size(os.path.getsize(tar_filename))
+                transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=upload_part_size,
+                                                                   multipart_chunksize=upload_part_size,
+                                                                   max_concurrency=settings.MAX_CONCURRENT_SINGLE_FILE_UPLOADS,
                                                                    use_threads=False,
                                                                    max_bandwidth=MAX_BANDWIDTH_PER_WORKER_BYTES_PER_SEC)
 
                 self.progress_tasks_dict[tar_file] = self.progresses.add_task(description=f"Uploading '{tar_file}'",
                                                                               total=os.path.getsize(tar_filename))
-                s3_client.upload_file(tar_filename,
-                                      self.s3_bucket_name,
-                                      tar_file,
-                                      Config=transfer_config,
-                                      Callback=partial(self._upload_progress_callback, tar_file),
-                                      ExtraArgs=S3_EXTRA_ARGS_DICT)
+                if self.drop_page_cache:
+                    self.page_cache_fds_dict[tar_file] = [os.open(tar_filename, os.O_RDONLY), 0, 0]
+                try:
+                    # NOTE: Without threads, 'boto3' uploads a part at a time, which it can hold in memory (eg: to work out its
+                    # checksum), so a whole part is reserved. 'asyncio' transfer engine streams parts a chunk at a time instead.
+                    with self.buffer_pool.reserved(self.buffer_pool.buffer_size if self.async_transfers else upload_part_size):
+                        if self.async_transfers:
+                            # NOTE: Each part in flight streams a chunk at a time so parts in flight fit in the memory reserved
+                            self.async_transfers.upload_file(tar_filename,
+                                                             self.s3_bucket_name,
+                                                             tar_file,
+                                                             upload_part_size,
+                                                             part_checksums[1] if part_checksums else None,
+                                                             S3_EXTRA_ARGS_DICT.get('StorageClass'),
+                                                             partial(self._progress_callback, tar_file),
+                                                             max(self.buffer_pool.buffer_size // settings.ASYNC_IO_CHUNK_SIZE_BYTES, 1))
+                        else:
+                            s3_client.upload_file(tar_filename,
+                                                  self.s3_bucket_name,
+                                                  tar_file,
+                                                  Config=transfer_config,
+                                                  Callback=partial(self._progress_callback, tar_file),
+                                                  ExtraArgs=S3_EXTRA_ARGS_DICT)
+                finally:
+                    if tar_file in self.page_cache_fds_dict:
+                        page_cache_fd = self.page_cache_fds_dict.pop(tar_file)[0]
+                        drop_from_page_cache(page_cache_fd)
+                        os.close(page_cache_fd)
+
+            case TaskType.DOWNLOAD:
+                s3_client = get_s3_client()
+
+                # NOTE: Large files are downloaded using several ranged GETs in parallel. Data is downloaded to
+                # a temporary file which is renamed once complete so 'decrypt' never sees partial files.
+                transfer_config = boto3.s3.transfer.TransferConfig(multipart_chunksize=settings.DOWNLOAD_CHUNK_SIZE_BYTES,
+                                                                   max_concurrency=settings.MAX_CONCURRENT_SINGLE_FILE_DOWNLOADS,
+                                                                   use_threads=True)
+
+                tar_file_size = s3_client.head_object(Bucket=self.s3_bucket_name, Key=tar_file)['ContentLength']
+                if tar_file in self.progress_tasks_dict:
+                    self.progresses.reset(self.progress_tasks_dict[tar_file], total=tar_file_size)     # NOTE: Retrying failed download
+                else:
+                    self.progress_tasks_dict[tar_file] = self.progresses.add_task(description=f"Downloading '{tar_file}'",
+                                                                                  total=tar_file_size)
+                if self.async_transfers:
+                    with self.buffer_pool.reserved(self.buffer_pool.buffer_size):
+                        self.async_transfers.download_file(self.s3_bucket_name,
+                                                           tar_file,
+                                                           tar_filename,
+                                                           tar_file_size,
+                                                           partial(self._progress_callback, tar_file),
+                                                           max(self.buffer_pool.buffer_size // settings.ASYNC_IO_CHUNK_SIZE_BYTES, 1))
+                else:
+                    # NOTE: Downloaded data waits in memory in a queue of 'io_chunksize' chunks to be written to file
+                    with self.buffer_pool.reserved(transfer_config.io_chunksize * (transfer_config.max_io_queue + transfer_config.max_concurrency)):
+                        s3_client.download_file(self.s3_bucket_name,
+                                                tar_file,
+                                                tar_filename,
+                                                Config=transfer_config,
+                                                Callback=partial(self._progress_callback, tar_file))
+                return      # CAUTION: Don't autoclean downloaded file
 
             case TaskType.DECRYPT:
-                decryption_key = self.state_db.get_encryption_key()
-                with DecryptFileObj(tar_filename, decryption_key) as decryptor:
+                decryption_key = state_db.get_encryption_key()
+                with DecryptFileObj(tar_filename, decryption_key) as decryptor,\
+                     self.buffer_pool.buffer() as buffer:
                     output_filename = tar_filename.removesuffix(settings.ENCRYPTED_FILE_EXTENSION)
-                    decryptor.decrypt(output_filename, settings.BUFFER_MEM_SIZE_BYTES)
+                    decryptor.decrypt(output_filename, buffer)
 
         if self.autoclean:
             remove_file_ignore_errors(tar_filename)
 
 
-    def _work_wrapper(self, tar_filename: str) -> None:         # CAUTION: Runs in worker thread
+    def _work_wrapper(self, tar_filename: str, state_db: StateDB) -> None:         # CAUTION: Runs in worker thread
         tar_file = os.path.basename(tar_filename)
 
         for i in range(sys.maxsize):     # Basically infinite loop
             try:
                 if self.task_type == TaskType.UPLOAD:
-                    self.state_db.record_changed_work_state(UploadTaskStatus.STARTED, tar_file=tar_file)
-                logging.info(f"{'Uploading' if self.task_type == TaskType.UPLOAD else 'Decrypting'} '{tar_filename}'...")
+                    state_db.record_changed_work_state(UploadTaskStatus.STARTED, tar_file=tar_file)
+                logging.info(f"{WorkerPool.TASK_TYPE_VERBS[self.task_type][0]} '{tar_filename}'...")
 
-                self._work(tar_file, tar_filename)
+                if self.metrics and self.task_type == TaskType.UPLOAD:
+                    tar_file_size, start_time = os.path.getsize(tar_filename), time.perf_counter()   # NOTE: File might be autocleaned by '_work()'
+                    self._work(tar_file, tar_filename, state_db)
+                    self.metrics.record_part_upload(tar_file, tar_file_size, time.perf_counter() - start_time, num_retries=i)
+                else:
+                    self._work(tar_file, tar_filename, state_db)
                 break       # Uploaded succeeded
 
-            except sqlite3.OperationalError as ex:
+            except (sqlite3.OperationalError, StateDBWriteError) as ex:
+                # NOTE: A write to state DB that failed in writer thread, whichever thread made it, stops the program
                 logging.error("Database error occurred while trying to record state change for "\
                               f"'{tar_file}' with error '{repr(ex)}'! Program will terminate immediately.")
                 sys.exit(-1)
 
             except Exception as ex:
                 if self.task_type == TaskType.UPLOAD:
-                    self.state_db.record_changed_work_state(UploadTaskStatus.FAILED, tar_file=tar_file)
+                    state_db.record_changed_work_state(UploadTaskStatus.FAILED, tar_file=tar_file)
+                if self.metrics:
+                    self.metrics.increment(f'{self.task_type}_retries')
                 logging.error(f"Failed to {self.task_type} '{tar_filename}' with '{repr(ex)}'.")
 
                 # Wait for logarithmically longer minutes hoping the network issue will be resolved
@@ -152,13 +255,17 @@ class WorkerPool:
                 sys.exit(-1)
 
         # Record and report task completion
-        if self.task_type == TaskType.UPLOAD:
-            self.state_db.record_changed_work_state(UploadTaskStatus.UPLOADED, tar_file=tar_file)
-        logging.info(f"{'Uploaded' if self.task_type == TaskType.UPLOAD else 'Decrypted'} '{tar_filename}'.")
+        match self.task_type:
+            case TaskType.UPLOAD:
+                state_db.record_changed_work_state(UploadTaskStatus.UPLOADED, tar_file=tar_file)
+            case TaskType.DOWNLOAD:
+                state_db.record_changed_retrieval_states(RetrieveTaskStatus.DOWNLOADED, [tar_file])
+        logging.info(f"{WorkerPool.TASK_TYPE_VERBS[self.task_type][1]} '{tar_filename}'.")
 
 
-    def put_on_tasks_queue(self, tar_filename: str) -> None:
-        self.task_futures.append(self.thread_pool.submit(self._work_wrapper, deepcopy(tar_filename)))
+    def put_on_tasks_queue(self, tar_filename: str, state_db: StateDB | None=None) -> None:
+        # NOTE: State of TAR file is recorded in 'state_db', if given (eg: of the shard that packed it), instead of pool's
+        self.task_futures.append(self.thread_pool.submit(self._work_wrapper, deepcopy(tar_filename), state_db or self.state_db))
 
     def get_num_tasks_running(self) -> int:
         return sum([1 for task_future in self.task_futures if task_future.running()])
@@ -3,15 +3,21 @@ import argparse
 import logging
 import logging.config
 
-import commands
 import settings
 from utils import *
-from consts import TAR_COMPRESSION_TYPES
+from consts import TAR_COMPRESSION_TYPES, S3_RESTORE_TIERS, OUTPUT_FORMATS, PROFILE_MODES, TRANSFER_ENGINES
+from libs import UploadTaskStatus, Profiler
+from commands import get_command_func
 
 
-def main(command, **kwargs):
-    command_func = getattr(commands, command)
-    command_func(**kwargs)
+def main(command, profile, **kwargs):
+    command_func = get_command_func(command)
+    if profile:
+        profile_filename_prefix = os.path.join(settings.LOG_DIR, datetime.now().strftime(settings.PROFILE_FILENAME_TEMPLATE).format(command=command))
+        with Profiler(profile, profile_filename_prefix):
+            command_func(**kwargs)
+    else:
+        command_func(**kwargs)
 
 
 if __name__ == '__main__':
@@ -19,25 +25,32 @@ if __name__ == '__main__':
     os.makedirs(settings.LOG_DIR, exist_ok=True)
     logging.config.dictConfig(settings.LOGGING_CONFIG_DICT)
 
-    if not isAWSConfigAndCredentialsOK():
-        logging.warning("Please check for proper S3 configuration and credentials in '~/.aws'!")
-
     # Allow this program to be interrupted with Ctrl+C and SIGTERM (default signal used by docker to stop a container)
     signal.signal(signal.SIGTERM, signal.getsignal(signal.SIGINT))
 
     # Add command line arguments
     parser = argparse.ArgumentParser(prog=os.path.basename(__file__),
                                      description="Program that automates compression, encryption, spliting and uploading files to backup to AWS S3 Glacier Deep Archive.")
+    parser.add_argument('--profile', help=f"Profile the command and save it under '{settings.LOG_DIR}' folder. 'sample' mode samples all threads with little overhead and saves collapsed stacks for flame graphs. 'cprofile' records every call in 'pstats' format but is slow.", type=str.lower, choices=PROFILE_MODES, default=None)
     subparser = parser.add_subparsers(help="backup or restore", required=True, dest='command')
 
     backup_parser = subparser.add_parser('backup', help="Backup files to AWS S3 Glacier Deep Archive.")
     backup_parser.add_argument('--src-dirs', help="One or more source directories to backup.", type=abspath, action=ValidateFoldersExist, nargs='+', required=True)
     backup_parser.add_argument('--split-size', help=f"Split size in Gigabytes (Megabytes if '--test-run' specified). Default is {settings.DEFAULT_SPLIT_SIZE_GIGABYTES} GB.", type=int, default=settings.DEFAULT_SPLIT_SIZE_GIGABYTES)
-    backup_parser.add_argument('--bucket', help="S3 bucket to upload to.", type=str, action=ValidateBucketExists, required=True)
+    backup_parser.add_argument('--bucket', help="S3 bucket to upload to.", type=str, required=True)
     backup_parser.add_argument('--num-upload-workers', help=f"Number of upload workers. Default is {settings.DEFAULT_NUM_UPLOAD_WORKERS}.", type=int, default=settings.DEFAULT_NUM_UPLOAD_WORKERS)
     backup_parser.add_argument('--compression', help=f"Type of compression ({", ".join(TAR_COMPRESSION_TYPES)}) to use on TAR file. Don't specify for no compression.", type=str.lower, choices=TAR_COMPRESSION_TYPES, default='')
     backup_parser.add_argument('--encrypt', help=f"Specify to encrypt the TAR file using ChaCha20. Key will be saved in state database. Nonce is TAR filename, repeated to {settings.ENCRYPT_NONCE_LENGTH} characters. Default is encryption enabled.", action=argparse.BooleanOptionalAction, default=True)
     backup_parser.add_argument('--autoclean', help="Removes all generated TAR files after they are uploaded.", action=argparse.BooleanOptionalAction, default=True)
+    backup_parser.add_argument('--drop-page-cache', help="Drop source files and generated TAR files from OS page cache as they are read or written so that backup doesn't evict other programs' cached data.", action=argparse.BooleanOptionalAction, default=False)
+    backup_parser.add_argument('--metrics-textfile', help=f"Write Prometheus metrics of each backup stage to this file (eg: for node exporter's textfile collector) every {settings.METRICS_EXPORT_INTERVAL_SECS} secs.", type=abspath, action=ValidateFilename, default=None)
+    backup_parser.add_argument('--metrics-port', help=f"Serve Prometheus metrics of each backup stage on 'http://{settings.METRICS_HTTP_HOST}:<port>/metrics'.", type=int, default=None)
+    backup_parser.add_argument('--memory-budget', help=f"Memory in Megabytes that buffers of all stages (i.e. read-ahead, compression, encryption and uploads) together may use. Default is {settings.DEFAULT_MEMORY_BUDGET_MEGABYTES} MB.", type=int, action=ValidateGreaterThan0, default=settings.DEFAULT_MEMORY_BUDGET_MEGABYTES)
+    backup_parser.add_argument('--staging-dirs', help="One or more folders (eg: on different disks) to pack TAR files in, instead of the output folder. Each new TAR file is packed in the one with fewest TAR files waiting to be uploaded on its disk and then most free space.", type=abspath, nargs='+', default=None)
+    backup_parser.add_argument('--locality-order', help="Order files so that each folder is packed in as few TAR files as possible (i.e. fewer TAR files need to be restored to get a folder back) instead of in the order they are found. Source folders are walked one more time for this.", action=argparse.BooleanOptionalAction, default=False)
+    backup_parser.add_argument('--num-shard-processes', help=f"Back up source folders in this many processes, each packing its own shards (i.e. source folders or, if larger than {settings.SHARD_SPLIT_SIZE_GIGABYTES} GB, groups of their subfolders) with its own shard state DB. TAR files of all shards are uploaded by upload workers of the main process. Default is 0 (i.e. not sharded).", type=int, action=ValidateGreaterOrEqualTo0, default=0)
+    backup_parser.add_argument('--transfer-engine', help=f"Engine ({", ".join(TRANSFER_ENGINES)}) to upload TAR files with. 'thread' uploads parts of each TAR file one after another in its upload worker's thread. 'asyncio' keeps up to {settings.ASYNC_MAX_REQUESTS_IN_FLIGHT} parts of all TAR files in flight at once on an event loop (eg: for links with high bandwidth and latency). Default is '{settings.DEFAULT_TRANSFER_ENGINE}'.", type=str.lower, choices=TRANSFER_ENGINES, default=settings.DEFAULT_TRANSFER_ENGINE)
+    backup_parser.add_argument('--plan-only', help="Only estimate number and sizes of TAR files, compression ratio of each compression type and duration of each stage of backup instead of backing up. Only a small sample of files is read.", action='store_true')
     backup_parser.add_argument('--test-run', help="Enable for testing using local Minio S3 test server where Deep Archive attribute isn't supported.", action='store_true')
     backup_parser.add_argument('output_filename_template', help="A template filename with path to save backup to.", type=abspath, action=ValidateFilename)
 
@@ -46,22 +59,72 @@ if __name__ == '__main__':
 
     show_parser = subparser.add_parser('show', help="List state data from state DB.")
     show_parser.add_argument('--collate', help="Specify collate level for folders view.", type=int, action=ValidateGreaterOrEqualTo0, default=0)
+    show_parser.add_argument('--status', help=f"Only show files with this status ({", ".join(UploadTaskStatus)}).", type=str.lower, choices=list(UploadTaskStatus), default=None)
+    show_parser.add_argument('--limit', help="Show at most this many records.", type=int, action=ValidateGreaterOrEqualTo0, default=None)
+    show_parser.add_argument('--offset', help="Skip this many records before showing them.", type=int, action=ValidateGreaterOrEqualTo0, default=0)
+    show_parser.add_argument('--format', help=f"Output format ({", ".join(OUTPUT_FORMATS)}). 'jsonl' and 'csv' are streamed so use them for large state DBs. Default is '{OUTPUT_FORMATS[0]}'.", type=str.lower, choices=OUTPUT_FORMATS, default=OUTPUT_FORMATS[0], dest='output_format')
     show_parser.add_argument('db_filename', help="Filename of the state DB generated during backup.", type=abspath, action=ValidateFilesExists)
 
+    find_parser = subparser.add_parser('find', help="Find which TAR files backed up files are in.")
+    find_parser.add_argument('--glob', help="Match 'query' as a case sensitive Unix style glob (eg: '/home/*/photos/*.jpg') against full path instead of a case insensitive substring.", action='store_true')
+    find_parser.add_argument('--min-size', help="Only find files of at least this many bytes.", type=int, action=ValidateGreaterOrEqualTo0, default=None)
+    find_parser.add_argument('--max-size', help="Only find files of at most this many bytes.", type=int, action=ValidateGreaterOrEqualTo0, default=None)
+    find_parser.add_argument('--modified-after', help="Only find files last modified at or after this local date and time (eg: 2025-01-31 or '2025-01-31 13:00').", type=datetime.fromisoformat, default=None)
+    find_parser.add_argument('--modified-before', help="Only find files last modified before this local date and time.", type=datetime.fromisoformat, default=None)
+    find_parser.add_argument('--limit', help="Show at most this many files.", type=int, action=ValidateGreaterOrEqualTo0, default=None)
+    find_parser.add_argument('--format', help=f"Output format ({", ".join(OUTPUT_FORMATS)}). 'jsonl' and 'csv' are streamed as found. Default is '{OUTPUT_FORMATS[0]}'.", type=str.lower, choices=OUTPUT_FORMATS, default=OUTPUT_FORMATS[0], dest='output_format')
+    find_parser.add_argument('query', help="Part of path of files to find.", type=str)
+    find_parser.add_argument('db_filename', help="Filename of the state DB generated during backup.", type=abspath, action=ValidateFilesExists)
+
+    plan_parser = subparser.add_parser('plan', help="Work out the cheapest TAR files to retrieve to restore some files and save it as a plan for 'retrieve'.")
+    plan_parser.add_argument('--paths', help="One or more paths (Unix style globs like '/home/me/photos/2020*') of files to restore. Default is all files.", type=abspath, nargs='+', default=None)
+    plan_parser.add_argument('--modified-after', help="Only restore files last modified at or after this local date and time (eg: 2025-01-31 or '2025-01-31 13:00').", type=datetime.fromisoformat, default=None)
+    plan_parser.add_argument('--modified-before', help="Only restore files last modified before this local date and time.", type=datetime.fromisoformat, default=None)
+    plan_parser.add_argument('--tier', help=f"Restore tier ({", ".join(S3_RESTORE_TIERS)}) to plan for. Default is '{settings.DEFAULT_RESTORE_TIER}'.", type=str.capitalize, choices=S3_RESTORE_TIERS, default=settings.DEFAULT_RESTORE_TIER)
+    plan_parser.add_argument('db_filename', help="Filename of the state DB generated during backup.", type=abspath, action=ValidateFilesExists)
+    plan_parser.add_argument('plan_filename', help="Filename to save the retrieval plan (JSON) to.", type=abspath, action=ValidateFilename)
+
+    retrieve_parser = subparser.add_parser('retrieve', help="Restore backed up TAR files from AWS S3 Glacier Deep Archive and download them.")
+    retrieve_parser.add_argument('--bucket', help="S3 bucket to retrieve from.", type=str, required=True)
+    retrieve_parser.add_argument('--tier', help=f"Restore tier ({", ".join(S3_RESTORE_TIERS)}) to use. Default is the one in '--plan' or else '{settings.DEFAULT_RESTORE_TIER}'.", type=str.capitalize, choices=S3_RESTORE_TIERS, default=None)
+    retrieve_parser.add_argument('--restore-days', help=f"Number of days to keep restored copies available for download. Default is {settings.DEFAULT_RESTORE_DAYS}.", type=int, default=settings.DEFAULT_RESTORE_DAYS)
+    retrieve_parser.add_argument('--num-download-workers', help=f"Number of download workers. Default is {settings.DEFAULT_NUM_DOWNLOAD_WORKERS}.", type=int, default=settings.DEFAULT_NUM_DOWNLOAD_WORKERS)
+    retrieve_options_parser = retrieve_parser.add_mutually_exclusive_group()
+    retrieve_options_parser.add_argument('--files', help="Retrieve only specific backup TAR files. Default is all uploaded TAR files.", type=str, nargs='+', default=None)
+    retrieve_options_parser.add_argument('--plan', help="Retrieve only TAR files in a plan saved by 'plan' command.", type=abspath, action=ValidateFilesExists, default=None)
+    retrieve_parser.add_argument('--memory-budget', help=f"Memory in Megabytes that buffers of all download workers together may use. Default is {settings.DEFAULT_MEMORY_BUDGET_MEGABYTES} MB.", type=int, action=ValidateGreaterThan0, default=settings.DEFAULT_MEMORY_BUDGET_MEGABYTES)
+    retrieve_parser.add_argument('--transfer-engine', help=f"Engine ({", ".join(TRANSFER_ENGINES)}) to download TAR files with. 'asyncio' keeps up to {settings.ASYNC_MAX_REQUESTS_IN_FLIGHT} ranged GETs of all TAR files in flight at once on an event loop instead of a thread for each. Default is '{settings.DEFAULT_TRANSFER_ENGINE}'.", type=str.lower, choices=TRANSFER_ENGINES, default=settings.DEFAULT_TRANSFER_ENGINE)
+    retrieve_parser.add_argument('db_filename', help="Filename of the state DB generated during backup.", type=abspath, action=ValidateFilesExists)
+    retrieve_parser.add_argument('tar_files_folder', help="Location to download TAR files to.", type=abspath, action=ValidateFoldersExist)
+
     decrypt_parser = subparser.add_parser('decrypt', help="Decrypt all downloaded TARs from specified folder.")
     decrypt_parser.add_argument('--autoclean', help="Removes all encrypted TAR files after they have been decrypted.", action=argparse.BooleanOptionalAction, default=True)
+    decrypt_parser.add_argument('--memory-budget', help=f"Memory in Megabytes that buffers of all decrypt workers together may use. Default is {settings.DEFAULT_MEMORY_BUDGET_MEGABYTES} MB.", type=int, action=ValidateGreaterThan0, default=settings.DEFAULT_MEMORY_BUDGET_MEGABYTES)
     decrypt_parser.add_argument('db_filename', help="Filename of the state DB generated during backup. Needed for encryption key.", type=abspath, action=ValidateFilesExists)
     decrypt_parser.add_argument('tar_files_folder', help="Location containing downloaded TAR files.", type=abspath, action=ValidateFoldersExist)
 
     sync_parser = subparser.add_parser('sync', help="Sync contents of state database with remote S3.")
-    sync_parser.add_argument('--bucket', help="S3 bucket to sync to.", type=str, action=ValidateBucketExists, required=True)
+    sync_parser.add_argument('--bucket', help="S3 bucket to sync to.", type=str, required=True)
+    sync_parser.add_argument('--inventory-manifest', help="Use 'manifest.json' of a downloaded CSV S3 Inventory report instead of listing the bucket.", type=abspath, action=ValidateFilesExists, default=None)
     sync_parser.add_argument('db_filename', help="Filename of the state DB generated during backup.", type=abspath, action=ValidateFilesExists)
 
+    verify_parser = subparser.add_parser('verify', help="Verify that uploaded TAR files in S3 match what was packaged using their sizes and checksums without downloading them.")
+    verify_parser.add_argument('--bucket', help="S3 bucket to verify in.", type=str, required=True)
+    verify_parser.add_argument('--files', help="Verify only specific backup TAR files. Default is all uploaded TAR files.", type=str, nargs='+', default=None)
+    verify_parser.add_argument('db_filename', help="Filename of the state DB generated during backup.", type=abspath, action=ValidateFilesExists)
+
     delete_parser = subparser.add_parser('delete', help="Delete files recorded as 'uploaded' in the state DB from remote S3. (WARNING: Action cannot be undone!)")
-    delete_parser.add_argument('--bucket', help="S3 bucket to delete from.", type=str, action=ValidateBucketExists, required=True)
+    delete_parser.add_argument('--bucket', help="S3 bucket to delete from.", type=str, required=True)
     delete_options_parser = delete_parser.add_mutually_exclusive_group(required=True)
     delete_options_parser.add_argument('--all', help="Deletes all backed up TAR files and the state DB file.", action='store_true')
     delete_options_parser.add_argument('--files', help="Delete a specific backup TAR file from AWS S3 Glacier.", type=str, nargs='+')
+    delete_parser.add_argument('--dry-run', help="Only print which files would be deleted without deleting them.", action='store_true')
     delete_parser.add_argument('db_filename', help="Filename of the state DB generated during backup.", type=abspath, action=ValidateFilesExists)
 
+    merge_parser = subparser.add_parser('merge', help="Merge shard state DBs of a sharded backup into its state DB. Done by backup when all shards are done.")
+    merge_parser.add_argument('db_filename', help="Filename of the state DB generated during sharded backup.", type=abspath, action=ValidateFilesExists)
+
+    watch_parser = subparser.add_parser('watch', help="Keep watching source folders of a backup (eg: as a service) and journal folders in which files change so that 'resume' only walks those instead of all source folders. Linux only.")
+    watch_parser.add_argument('db_filename', help="Filename of the state DB generated during backup.", type=abspath, action=ValidateFilesExists)
+
     main(**vars(parser.parse_args()))
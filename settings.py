@@ -2,7 +2,7 @@ import os.path
 import logging
 import tarfile
 
-from utils import MB_to_bytes
+from units import MB_to_bytes, KB_to_bytes, GB_to_bytes
 
 
 IGNORE_DIRS = {
@@ -47,16 +47,61 @@ ENCRYPT_KEY_LENGTH = 32
 ENCRYPT_NONCE_LENGTH = 12
 ENCRYPTED_FILE_EXTENSION = '.chacha20'
 TARFILE_FORMAT = tarfile.PAX_FORMAT
-BUFFER_MEM_SIZE_BYTES = MB_to_bytes(512)                # Process this size block at a time when creating a TAR file
+PACK_SPARSE_FILES = True                                # Only data (i.e. not holes) of sparse files is read and packed
+MAX_SPARSE_MEMBER_DATA_SIZE_BYTES = GB_to_bytes(8)      # CAUTION: Python's 'tarfile' can't extract sparse members whose data needs a PAX 'size' header
+BUFFER_SIZE_BYTES = MB_to_bytes(8)                      # Size of reused buffers (eg: to encrypt TAR files and to decrypt downloaded ones in)
+DEFAULT_MEMORY_BUDGET_MEGABYTES = 1024                  # NOTE: Buffers of all stages (i.e. read-ahead, compression, encryption, uploads, downloads and decryption) are kept within this
+READ_AHEAD_NUM_FILES = 0                                # NOTE: Disabled as 'testing/benchmark_read_ahead.py' found it slower on local disks. Try 256 for high-latency storage (eg: network file systems).
+READ_AHEAD_NUM_THREADS = 4
+READ_AHEAD_MEM_SIZE_BYTES = MB_to_bytes(256)            # Total memory used by files read ahead but not yet packed
+READ_AHEAD_MAX_FILE_SIZE_BYTES = MB_to_bytes(16)        # Larger files are only hinted to the kernel (i.e. 'WILLNEED') instead of read
+READ_AHEAD_WILLNEED_SIZE_BYTES = MB_to_bytes(64)
+DROP_PAGE_CACHE_WINDOW_SIZE_BYTES = MB_to_bytes(64)     # With '--drop-page-cache', read/written data is dropped from page cache every this many bytes
+CHECKPOINT_INTERVAL_BYTES = MB_to_bytes(1024)           # TAR file being packed is checkpointed after every this many bytes so that resume continues from there. Set to 0 to disable.
 
 DEFAULT_NUM_UPLOAD_WORKERS = 2
 DEFAULT_SPLIT_SIZE_GIGABYTES = 100                      # NOTE: This value is interpreted as Megabytes in '--test-run'
 MAX_CONCURRENT_SINGLE_FILE_UPLOADS = 2
+SHARD_SPLIT_SIZE_GIGABYTES = 1000                       # With '--num-shard-processes', source folders larger than this are split into several shards by subfolder
+SHARD_UPLOAD_POLL_INTERVAL_SECS = 1                     # Shards check upload states recorded by main backup process every this many secs when waiting for uploads
+LOCALITY_MIN_SPLIT_FRACTION = 0.9                       # With '--locality-order', a TAR file is ended once it reaches this fraction of split size if next file starts a new top-level folder
+UPLOAD_PART_SIZE_BYTES = MB_to_bytes(16)                # TAR files are uploaded in parts of this size (or larger for large '--split-size'). Checksums of parts are worked out while packing for 'verify'.
 TOTAL_MAX_BANDWIDTH_BYTES_PER_SEC = MB_to_bytes(3.5)    # NOTE: Set to 0 for no limit.
 NUM_WORKS_PRODUCE_AHEAD = 2
+MAX_KEYS_PER_DELETE_REQUEST = 1000                      # NOTE: 1000 is the most S3 'DeleteObjects' allows
+NUM_S3_REQUEST_WORKERS = 8                              # Number of threads used to send small S3 requests (eg: delete, restore) in parallel
+S3_MAX_POOL_CONNECTIONS = 32                            # Connections kept open by the S3 client shared by all threads (eg: download workers' ranged GETs)
 MAX_RETRY_ATTEMPTS = 20
 RETRY_WAIT_TIME_RANGE_MINS = (5, 60)
+DEFAULT_NUM_DOWNLOAD_WORKERS = 2
+MAX_CONCURRENT_SINGLE_FILE_DOWNLOADS = 8                # Number of ranged GETs used in parallel to download a single file
+DOWNLOAD_CHUNK_SIZE_BYTES = MB_to_bytes(64)
+DEFAULT_TRANSFER_ENGINE = 'thread'                      # Engine that uploads and downloads TAR files. 'asyncio' keeps many parts in flight at once without a thread for each.
+ASYNC_MAX_REQUESTS_IN_FLIGHT = 64                       # With 'asyncio' transfer engine, most part uploads and ranged downloads in flight at once over all transfers
+ASYNC_IO_CHUNK_SIZE_BYTES = KB_to_bytes(256)            # Parts are streamed in chunks of this size so each transfer has up to 'BUFFER_SIZE_BYTES' / this many parts in flight
+ASYNC_NUM_IO_THREADS = 2                                # Threads reading and writing files and sending other S3 requests (eg: to start multipart uploads) for 'asyncio' transfer engine
+ASYNC_SOCKET_TIMEOUT_SECS = 60
+ASYNC_MAX_RETRY_WAIT_SECS = 20                          # Failed requests are retried after a random wait of up to 2^attempt secs but no more than this
+DEFAULT_RESTORE_TIER = 'Bulk'                           # NOTE: Bulk restores from Deep Archive take up to 48 hours but cost the least
+DEFAULT_RESTORE_DAYS = 7                                # Number of days restored copies are kept available for download
+RESTORE_CHECK_WAIT_TIME_RANGE_MINS = (15, 120)
+RESTORE_PRICES_USD = {'Standard': (0.02, 0.10),         # Per GB retrieved and per 1000 restore requests for each restore tier
+                      'Bulk': (0.0025, 0.025)}          # NOTE: These are Glacier Deep Archive prices in 'us-east-1', update for your region
+DOWNLOAD_PRICE_USD_PER_GB = 0.09                        # Data transfer out of AWS to internet
+ESTIMATED_DOWNLOAD_BYTES_PER_SEC = MB_to_bytes(10)      # Only used to estimate download times of retrieval plans
 STATE_DB_FILENAME_TEMPLATE = '%Y%m%d-%H%M%S_backup_statedb.sqlite3'
+RESUME_FILTER_FALSE_POSITIVE_RATE = 0.01                # Lower rate uses more memory (~1.2 bytes per uploaded file at 1%) but looks up state DB less on resume
+STATE_DB_FETCH_BATCH_SIZE = 1000                        # Number of records fetched at a time when streaming records from state DB
+STATE_DB_BUSY_TIMEOUT_SECS = 600                        # Writes to a state DB wait this long for another process writing it (eg: shard process and main backup process)
+WATCH_COMMIT_INTERVAL_SECS = 1                          # 'watch' records folders in which files changed in change journal every this many secs
+WATCH_READ_BUFFER_SIZE_BYTES = KB_to_bytes(64)          # Size of buffer 'watch' reads file change events into. Events that don't fit wait for next read.
+METRICS_SUMMARY_FILENAME_TEMPLATE = '%Y%m%d-%H%M%S_backup_metrics.json'     # NOTE: Performance summary of each backup run is saved in 'LOG_DIR'
+METRICS_EXPORT_INTERVAL_SECS = 15                       # With '--metrics-textfile', Prometheus metrics are written every this many seconds
+METRICS_HTTP_HOST = '127.0.0.1'                         # With '--metrics-port', Prometheus metrics are served on this host
+PROFILE_FILENAME_TEMPLATE = '%Y%m%d-%H%M%S_{command}_profile'   # NOTE: Profiles saved with '--profile' are saved in 'LOG_DIR'
+PROFILE_SAMPLE_INTERVAL_SECS = 0.01                     # With '--profile sample', stacks of all threads are sampled every this many seconds
+PLAN_SAMPLE_NUM_FILES = 128                             # With '--plan-only', these many files (picked in proportion to their size) are read to estimate compression
+PLAN_SAMPLE_MAX_BYTES_PER_FILE = MB_to_bytes(0.5)       # NOTE: At most 'PLAN_SAMPLE_NUM_FILES' times this many bytes are read and compressed by each compression type
 
 LOG_DIR = 'logs'
 LOG_FILENAME = os.path.join(LOG_DIR, 'main.log')
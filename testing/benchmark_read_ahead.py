@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Benchmarks packing a source tree with and without reading files ahead.
+# Usage: python3 testing/benchmark_read_ahead.py [--work-dir DIR] [--compression gz]
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+from utils import MB_to_bytes, KB_to_bytes, list_files_recursive_iter
+from libs import StateDB, SplitTarFiles, ReadAheadFiles, BufferPool, UploadTaskStatus
+
+
+def create_tree(folder: str, num_files: int, file_size: int) -> None:
+    for i in range(num_files):
+        subfolder = os.path.join(folder, f'dir{i % 64:02}')
+        os.makedirs(subfolder, exist_ok=True)
+        with open(os.path.join(subfolder, f'file{i:06}.dat'), mode='wb') as file:
+            file.write(os.urandom(file_size))
+
+def drop_from_page_cache(folder: str) -> None:
+    # Make sure every run reads from disk rather than from memory
+    for filename in list_files_recursive_iter(folder):
+        with open(filename, mode='rb') as file:
+            os.fsync(file.fileno())
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def pack(folder: str, output_folder: str, compression: str, num_files_ahead: int) -> float:
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    drop_from_page_cache(folder)
+
+    start_time = time.perf_counter()
+    with StateDB(os.path.join(output_folder, 'statedb.sqlite3')) as state_db,\
+         SplitTarFiles(state_db,
+                       os.path.join(output_folder, 'output.tar'),
+                       0,
+                       state_db.get_encryption_key(),
+                       compression,
+                       BufferPool(MB_to_bytes(settings.DEFAULT_MEMORY_BUDGET_MEGABYTES)),
+                       lambda _: None) as split_tarfiles,\
+         ReadAheadFiles(list_files_recursive_iter(folder),
+                        num_files_ahead,
+                        settings.READ_AHEAD_NUM_THREADS,
+                        settings.READ_AHEAD_MEM_SIZE_BYTES,
+                        settings.READ_AHEAD_MAX_FILE_SIZE_BYTES) as read_ahead_files:
+        for filename, data in read_ahead_files:
+            state_db.record_changed_work_state(UploadTaskStatus.SCHEDULED,
+                                               filename=filename,
+                                               tar_file=split_tarfiles.get_tarfile_name())
+            split_tarfiles.add(filename, data)
+
+    return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark reading source files ahead of packing them.")
+    parser.add_argument('--work-dir', help="Folder to create test trees in. Should be on the disk to benchmark.", type=str, default=None)
+    parser.add_argument('--compression', help="Type of compression to use on TAR file.", type=str, default='')
+    parser.add_argument('--num-files-ahead', help="Number of files to read ahead (compared with not reading ahead).", type=int,
+                        default=settings.READ_AHEAD_NUM_FILES or 256)
+    args = parser.parse_args()
+
+    TREES = {
+        'many-small-files': (20000, KB_to_bytes(16)),
+        'few-large-files': (8, MB_to_bytes(128)),
+    }
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for tree_name, (num_files, file_size) in TREES.items():
+            tree_folder = os.path.join(work_dir, tree_name)
+            create_tree(tree_folder, num_files, file_size)
+
+            for num_files_ahead in (0, args.num_files_ahead):
+                elapsed_secs = pack(tree_folder, os.path.join(work_dir, 'output'), args.compression, num_files_ahead)
+                print(f"{tree_name:<18} read-ahead={num_files_ahead:<3} "\
+                      f"{elapsed_secs:8.2f} secs {num_files * file_size / elapsed_secs / MB_to_bytes(1):8.1f} MB/s")
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Benchmarks how long 'main.py' takes to start for each command, both to parse arguments (i.e. '<command> --help')
+# and to import the command's implementation, in a fresh interpreter each time. Heavy modules imported are listed.
+# Usage: python3 testing/benchmark_startup.py [--num-runs 10] [--commands backup show ...]
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS = ['backup', 'resume', 'show', 'find', 'plan', 'retrieve', 'decrypt', 'sync', 'verify', 'delete', 'merge', 'watch']
+HEAVY_MODULES = ['boto3', 'rich.progress', 'Cryptodome']
+IMPORT_COMMAND_SCRIPT = """
+import sys, time, json
+start_time = time.perf_counter()
+import settings
+from commands import get_command_func
+get_command_func(sys.argv[1])
+print(json.dumps([time.perf_counter() - start_time, [module for module in sys.argv[2:] if module in sys.modules]]))
+"""
+
+
+def time_help(command: str, work_dir: str) -> float:
+    # NOTE: Run in a separate folder so that 'logs' folder isn't created in the current folder
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'main.py'), command, '--help'],
+                   cwd=work_dir,
+                   stdout=subprocess.DEVNULL,
+                   check=True)
+    return time.perf_counter() - start_time
+
+def time_import_command(command: str) -> tuple[float, list[str]]:
+    output = subprocess.run([sys.executable, '-c', IMPORT_COMMAND_SCRIPT, command, *HEAVY_MODULES],
+                            cwd=REPO_DIR,
+                            capture_output=True,
+                            text=True,
+                            check=True).stdout
+    import_secs, heavy_modules = json.loads(output)
+    return import_secs, heavy_modules
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark startup time of each command.")
+    parser.add_argument('--num-runs', help="Number of runs to take median of.", type=int, default=10)
+    parser.add_argument('--commands', help="Commands to benchmark. Default is all.", type=str, nargs='+', choices=COMMANDS, default=COMMANDS)
+    args = parser.parse_args()
+
+    print(f"{'command':<10} {'--help':>10} {'import':>10}  heavy modules imported")
+    with tempfile.TemporaryDirectory() as work_dir:
+        for command in args.commands:
+            help_secs = statistics.median(time_help(command, work_dir) for _ in range(args.num_runs))
+            import_results = [time_import_command(command) for _ in range(args.num_runs)]
+            import_secs = statistics.median(import_secs for import_secs, _ in import_results)
+            print(f"{command:<10} {help_secs * 1000:7.0f} ms {import_secs * 1000:7.0f} ms  {', '.join(import_results[0][1]) or '-'}")
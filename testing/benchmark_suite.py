@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# Benchmarks 'backup', 'resume', 'sync', 'retrieve' and 'decrypt' end-to-end on generated source trees against a local S3
+# stand-in and saves their throughput, peak memory, disk usage high-water mark and state DB size as a JSON baseline.
+# Results of a later run can be compared with the baseline to flag regressions.
+# Requires: pip install "moto[server]"
+# Usage: python3 testing/benchmark_suite.py run [--work-dir DIR] [--corpora many-tiny-files ...] [--scale 1.0]
+#                                               [--compression gz] [--bandwidth-limit-mbps 0] [--compare BASELINE] RESULTS
+#        python3 testing/benchmark_suite.py compare [--tolerance 0.1] BASELINE RESULTS
+import os
+import sys
+import json
+import glob
+import time
+import random
+import platform
+import argparse
+import tempfile
+import subprocess
+from threading import Thread, Event, Timer
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import MB_to_bytes, KB_to_bytes, prettyFilesize
+from s3_stand_in import S3StandIn
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORDS = ['backup', 'archive', 'glacier', 'deep', 'photo', 'invoice', 'report', 'the', 'of', 'and', 'a', 'to', 'in',
+         'is', 'data', 'file', 'folder', '2024', '2025', 'summary', 'total', 'amount', 'name', 'date', 'notes']
+
+SAMPLE_INTERVAL_SECS = 0.1
+
+# Metric -> whether higher value is better
+METRICS = {
+    'secs': False,
+    'bytes_per_sec': True,
+    'peak_rss_bytes': False,
+    'disk_high_water_bytes': False,
+    'db_size_bytes': False,
+}
+
+
+def create_many_tiny_files(folder: str, rng: random.Random, scale: float) -> None:
+    for i in range(int(20000 * scale)):
+        subfolder = os.path.join(folder, f'dir{i // 500:03}', f'subdir{i % 7}')
+        os.makedirs(subfolder, exist_ok=True)
+        with open(os.path.join(subfolder, f'file{i:06}.dat'), mode='wb') as file:
+            file.write(rng.randbytes(rng.randint(KB_to_bytes(1), KB_to_bytes(4))))
+
+def create_few_huge_files(folder: str, rng: random.Random, scale: float) -> None:
+    os.makedirs(folder, exist_ok=True)
+    for i in range(4):
+        with open(os.path.join(folder, f'huge{i}.bin'), mode='wb') as file:
+            for _ in range(int(64 * scale)):
+                file.write(rng.randbytes(MB_to_bytes(1)))
+
+def create_compressible_text(folder: str, rng: random.Random, scale: float) -> None:
+    for i in range(int(400 * scale)):
+        subfolder = os.path.join(folder, f'docs{i // 50:02}')
+        os.makedirs(subfolder, exist_ok=True)
+        with open(os.path.join(subfolder, f'doc{i:04}.txt'), mode='w') as file:
+            for _ in range(2000):
+                file.write(' '.join(rng.choices(WORDS, k=20)) + '\n')
+
+def create_sparse_images(folder: str, rng: random.Random, scale: float) -> None:
+    # Like VM disk images which are mostly holes with some data scattered in them
+    os.makedirs(folder, exist_ok=True)
+    for i in range(4):
+        size = int(MB_to_bytes(512) * scale)
+        with open(os.path.join(folder, f'disk{i}.img'), mode='wb') as file:
+            file.truncate(size)
+            for _ in range(16):
+                file.seek(rng.randrange(0, size - MB_to_bytes(1), KB_to_bytes(4)))
+                file.write(rng.randbytes(MB_to_bytes(1)))
+
+CORPORA = {
+    'many-tiny-files': create_many_tiny_files,
+    'few-huge-files': create_few_huge_files,
+    'compressible-text': create_compressible_text,
+    'sparse-images': create_sparse_images,
+}
+
+
+def get_disk_usage(folder: str) -> int:
+    # NOTE: Allocated rather than apparent size so that holes of sparse files aren't counted
+    disk_usage = 0
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in filenames:
+            try:
+                disk_usage += os.lstat(os.path.join(dirpath, filename)).st_blocks * 512
+            except FileNotFoundError:
+                pass    # NOTE: Temporary file was renamed or deleted while walking
+    return disk_usage
+
+def get_apparent_size(folder: str) -> int:
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, _, filenames in os.walk(folder) for filename in filenames)
+
+def get_peak_rss(pid: int) -> int:
+    # CAUTION: 'ru_maxrss' of a child process can't be used as Linux keeps the parent's from before 'exec()'.
+    # Instead high-water mark of RSS is sampled while the process runs which only misses peaks in its last moments.
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return KB_to_bytes(int(line.split()[1]))
+    except OSError:
+        pass    # NOTE: Process has exited
+    return 0
+
+def run_command(work_dir: str, env: dict[str, str], watch_folders: list[str], db_filename: str | None, timeout_secs: float, *args: str) -> dict:
+    # Runs a command of 'main.py' and measures it. Disk usage of 'watch_folders' is sampled while it runs.
+    # CAUTION: Commands retry failed transfers after several minutes so they are killed after 'timeout_secs'.
+    disk_high_water_bytes = 0
+    peak_rss_bytes = 0
+    stop_sampling = Event()
+    def sample_usage(pid: int) -> None:
+        nonlocal disk_high_water_bytes, peak_rss_bytes
+        while True:
+            disk_high_water_bytes = max(disk_high_water_bytes, sum(get_disk_usage(folder) for folder in watch_folders))
+            peak_rss_bytes = max(peak_rss_bytes, get_peak_rss(pid))
+            if stop_sampling.wait(SAMPLE_INTERVAL_SECS):
+                break
+
+    start_time = time.perf_counter()
+    with open(os.path.join(work_dir, 'output.log'), mode='a') as output_file:
+        process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'main.py'), *args],
+                                   cwd=work_dir, env=env, stdin=subprocess.DEVNULL, stdout=output_file, stderr=output_file)
+        sampler_thread = Thread(target=sample_usage, args=(process.pid,))
+        sampler_thread.start()
+        kill_timer = Timer(timeout_secs, process.kill)
+        kill_timer.start()
+        process.wait()
+        kill_timer.cancel()
+    secs = time.perf_counter() - start_time
+    stop_sampling.set()
+    sampler_thread.join()
+
+    if process.returncode != 0:
+        raise RuntimeError(f"'{' '.join(args)}' failed with exit code {process.returncode}! See '{output_file.name}'.")
+
+    if db_filename is None:
+        db_filename = glob.glob(os.path.join(work_dir, '*.sqlite3'))[0]
+    return {'secs': round(secs, 3),
+            'peak_rss_bytes': peak_rss_bytes,
+            'disk_high_water_bytes': disk_high_water_bytes,
+            'db_size_bytes': sum(os.path.getsize(filename) for filename in glob.glob(f'{glob.escape(db_filename)}*'))}
+
+def benchmark_corpus(corpus: str, work_dir: str, s3_stand_in: S3StandIn, args) -> dict:
+    src_folder = os.path.join(work_dir, 'src')
+    output_folder = os.path.join(work_dir, 'output')
+    download_folder = os.path.join(work_dir, 'download')
+    os.makedirs(download_folder)
+    CORPORA[corpus](src_folder, random.Random(args.seed), args.scale)
+    src_size = get_apparent_size(src_folder)
+    print(f"{corpus}: {prettyFilesize(src_size)} in {sum(len(filenames) for _, _, filenames in os.walk(src_folder))} file(s)")
+
+    # NOTE: Isolate commands from S3 configuration and credentials of user
+    env = dict(os.environ,
+               AWS_ENDPOINT_URL=s3_stand_in.endpoint_url,
+               AWS_ACCESS_KEY_ID='minio',
+               AWS_SECRET_ACCESS_KEY='abcdefghijkl',
+               AWS_DEFAULT_REGION='us-east-1',
+               AWS_CONFIG_FILE=os.path.join(work_dir, 'aws_config'),
+               AWS_SHARED_CREDENTIALS_FILE=os.path.join(work_dir, 'aws_credentials'))
+    bucket = f'benchmark-{corpus}'
+    timeout_secs = args.command_timeout_mins * 60
+
+    results = {}
+    compression_args = ['--compression', args.compression] if args.compression else []
+    results['backup'] = run_command(work_dir, env, [output_folder], None, timeout_secs,
+                                    'backup', '--src-dirs', src_folder, '--bucket', bucket, '--split-size', str(args.split_size_mb),
+                                    '--num-upload-workers', '2', '--test-run', *compression_args, os.path.join(output_folder, 'backup.tar'))
+    results['backup']['bytes'] = src_size
+    db_filename = glob.glob(os.path.join(work_dir, '*.sqlite3'))[0]
+    tar_files_size = sum(obj['Size'] for obj in s3_stand_in.get_client().list_objects_v2(Bucket=bucket).get('Contents', []))
+
+    # NOTE: Backup is complete so resume only looks for files that weren't backed up yet
+    results['resume'] = run_command(work_dir, env, [output_folder], db_filename, timeout_secs, 'resume', db_filename)
+    results['resume']['bytes'] = src_size
+    results['sync'] = run_command(work_dir, env, [], db_filename, timeout_secs, 'sync', '--bucket', bucket, db_filename)
+    results['sync']['bytes'] = tar_files_size
+    results['retrieve'] = run_command(work_dir, env, [download_folder], db_filename, timeout_secs,
+                                      'retrieve', '--bucket', bucket, db_filename, download_folder)
+    results['retrieve']['bytes'] = tar_files_size
+    results['decrypt'] = run_command(work_dir, env, [download_folder], db_filename, timeout_secs, 'decrypt', db_filename, download_folder)
+    results['decrypt']['bytes'] = tar_files_size
+
+    for command_results in results.values():
+        command_results['bytes_per_sec'] = round(command_results['bytes'] / command_results['secs']) if command_results['secs'] > 0 else None
+
+    # Performance summary of backup saved by 'main.py' shows time spent in each stage
+    metrics_filenames = sorted(glob.glob(os.path.join(work_dir, 'logs', '*_metrics.json')))
+    if metrics_filenames:
+        with open(metrics_filenames[0]) as file:
+            results['backup']['stages'] = {stage: stage_summary['secs'] for stage, stage_summary in json.load(file)['stages'].items()}
+
+    return results
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args) -> int:
+    results = {'meta': {'datetime': str(datetime.now(timezone.utc)),
+                        'git_commit': get_git_commit(),
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'num_cpus': os.cpu_count(),
+                        'args': {name: value for name, value in vars(args).items() if name != 'func'}},
+               'corpora': {}}
+
+    with S3StandIn(port=0,
+                   restore_delay_secs=0,
+                   bandwidth_limit_bytes_per_sec=int(args.bandwidth_limit_mbps * 1000 * 1000 / 8),
+                   log_requests=False) as s3_stand_in:
+        for corpus in args.corpora:
+            s3_stand_in.get_client().create_bucket(Bucket=f'benchmark-{corpus}')
+            with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+                corpus_results = benchmark_corpus(corpus, work_dir, s3_stand_in, args)
+                results['corpora'][corpus] = corpus_results
+                for command, command_results in corpus_results.items():
+                    print(f"  {command:<9} {command_results['secs']:8.2f} secs {(command_results['bytes_per_sec'] or 0) / MB_to_bytes(1):8.1f} MB/s "\
+                          f"peak RSS {prettyFilesize(command_results['peak_rss_bytes']):>9} disk {prettyFilesize(command_results['disk_high_water_bytes']):>9} "\
+                          f"DB {prettyFilesize(command_results['db_size_bytes']):>9}")
+
+    with open(args.results_filename, mode='w') as file:
+        json.dump(results, file, indent=4)
+    print(f"Saved results to '{args.results_filename}'.")
+
+    if args.compare:
+        with open(args.compare) as file:
+            return compare_results(json.load(file), results, args.tolerance)
+    return 0
+
+def compare_results(baseline: dict, results: dict, tolerance: float) -> int:
+    # Returns number of metrics that got worse than baseline by more than 'tolerance' (eg: 0.1 for 10%)
+    num_regressions = 0
+    for corpus, corpus_results in results['corpora'].items():
+        for command, command_results in corpus_results.items():
+            baseline_command_results = baseline['corpora'].get(corpus, {}).get(command)
+            if baseline_command_results is None:
+                continue
+
+            for metric, higher_is_better in METRICS.items():
+                baseline_value, value = baseline_command_results.get(metric), command_results.get(metric)
+                if not baseline_value or value is None:
+                    continue
+
+                change = (value - baseline_value) / baseline_value
+                regressed = (-change if higher_is_better else change) > tolerance
+                num_regressions += regressed
+                print(f"{'REGRESSION' if regressed else 'ok':<10} {corpus:<18} {command:<9} {metric:<22} "\
+                      f"{baseline_value:>14} -> {value:>14} ({change:+.1%})")
+
+    print(f"{num_regressions} regression(s) beyond {tolerance:.0%} tolerance.")
+    return num_regressions
+
+def compare(args) -> int:
+    with open(args.baseline_filename) as baseline_file, open(args.results_filename) as results_file:
+        return compare_results(json.load(baseline_file), json.load(results_file), args.tolerance)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end benchmark suite of backup, resume, sync, retrieve and decrypt.")
+    subparser = parser.add_subparsers(required=True, dest='command')
+
+    run_parser = subparser.add_parser('run', help="Run benchmarks and save results.")
+    run_parser.add_argument('--work-dir', help="Folder to create test trees in. Should be on the disk to benchmark.", type=str, default=None)
+    run_parser.add_argument('--corpora', help="Source trees to benchmark with.", choices=list(CORPORA), nargs='+', default=list(CORPORA))
+    run_parser.add_argument('--scale', help="Scale number or size of files in source trees by this factor.", type=float, default=1.0)
+    run_parser.add_argument('--seed', help="Seed for generating source trees so that they are the same on every run.", type=int, default=0)
+    run_parser.add_argument('--compression', help="Type of compression to use on TAR files.", type=str, default='')
+    run_parser.add_argument('--split-size-mb', help="Split size of TAR files in Megabytes.", type=int, default=64)
+    run_parser.add_argument('--bandwidth-limit-mbps', help="Limit S3 stand-in's total bandwidth to this many Megabits/sec. Default is no limit.", type=float, default=0)
+    run_parser.add_argument('--command-timeout-mins', help="Fail if a command takes longer than this many minutes.", type=float, default=60)
+    run_parser.add_argument('--compare', help="Compare results with this baseline and exit with number of regressions.", type=str, default=None)
+    run_parser.add_argument('--tolerance', help="Flag metrics that got worse than baseline by more than this fraction.", type=float, default=0.1)
+    run_parser.add_argument('results_filename', help="Filename to save results (JSON) to.", type=str)
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparser.add_parser('compare', help="Compare saved results with a baseline.")
+    compare_parser.add_argument('--tolerance', help="Flag metrics that got worse than baseline by more than this fraction.", type=float, default=0.1)
+    compare_parser.add_argument('baseline_filename', help="Baseline results (JSON).", type=str)
+    compare_parser.add_argument('results_filename', help="Results (JSON) to compare with baseline.", type=str)
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    sys.exit(min(args.func(args), 1))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Benchmarks uploading and downloading TAR files with 'thread' and 'asyncio' transfer engines against the S3 stand-in
+# with latency added to each request (i.e. like a link with a high round trip time). Checksums S3 has for uploaded
+# files are checked against those worked out for them and downloaded files against uploaded ones.
+# Requires: pip install "moto[server]"
+# Usage: python3 testing/benchmark_transfer_engines.py [--work-dir DIR] [--latency-ms 50] [--num-files 4] [--file-size-mb 64]
+import os
+import sys
+import time
+import filecmp
+import argparse
+import tempfile
+import threading
+from threading import Thread, Event
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+from utils import MB_to_bytes, PartChecksums, get_s3_checksum
+from libs import TaskType, WorkerPool, BufferPool, StateDB, get_s3_client
+from consts import TRANSFER_ENGINES
+from s3_stand_in import S3StandIn
+
+
+SAMPLE_INTERVAL_SECS = 0.05
+
+
+def create_files(folder: str, num_files: int, file_size: int, part_size: int, state_db: StateDB) -> list[str]:
+    filenames = []
+    for i in range(num_files):
+        filename = os.path.join(folder, f'{i:03}_benchmark.tar')
+        with open(filename, mode='wb') as file:
+            for _ in range(file_size // MB_to_bytes(1)):
+                file.write(os.urandom(MB_to_bytes(1)))
+
+        # NOTE: Upload workers upload in parts of the size checksums were worked out for like for packed TAR files
+        part_checksums = PartChecksums(part_size)
+        part_checksums.update_from_file(filename, file_size)
+        state_db.record_part_checksums(os.path.basename(filename), part_size, part_checksums.get_part_digests())
+        filenames.append(filename)
+    return filenames
+
+def count_client_threads() -> int:
+    # NOTE: S3 stand-in runs in this process and serves each connection in a thread of its own, which isn't counted
+    return sum(1 for thread in threading.enumerate() if not thread.name.endswith('(process_request_thread)'))
+
+def transfer(task_type: TaskType, engine: str, filenames: list[str], bucket: str, num_workers: int, state_db: StateDB) -> tuple[float, int]:
+    # Returns secs taken and peak number of threads
+    peak_num_threads = [count_client_threads()]
+    stop_sampling = Event()
+
+    def sample_num_threads() -> None:
+        while not stop_sampling.wait(SAMPLE_INTERVAL_SECS):
+            peak_num_threads[0] = max(peak_num_threads[0], count_client_threads())
+
+    sampler = Thread(target=sample_num_threads, daemon=True)
+    sampler.start()
+    start_time = time.perf_counter()
+    with BufferPool(MB_to_bytes(settings.DEFAULT_MEMORY_BUDGET_MEGABYTES)) as buffer_pool,\
+         WorkerPool(num_workers,
+                    task_type,
+                    False,
+                    state_db,
+                    s3_bucket_name=bucket,
+                    test_run=True,
+                    buffer_pool=buffer_pool,
+                    transfer_engine=engine) as worker_pool:
+        for filename in filenames:
+            worker_pool.put_on_tasks_queue(filename)
+        worker_pool.wait_on_all_tasks()
+    secs = time.perf_counter() - start_time
+    stop_sampling.set()
+    sampler.join()
+    return secs, peak_num_threads[0] - 1    # NOTE: Not counting sampler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark 'thread' and 'asyncio' transfer engines against S3 stand-in with latency.")
+    parser.add_argument('--work-dir', help="Folder to create test files in.", type=str, default=None)
+    parser.add_argument('--engines', help="Transfer engines to benchmark.", choices=TRANSFER_ENGINES, nargs='+', default=list(TRANSFER_ENGINES))
+    parser.add_argument('--num-files', help="Number of files to upload and download.", type=int, default=4)
+    parser.add_argument('--file-size-mb', help="Size of each file in Megabytes.", type=int, default=64)
+    parser.add_argument('--part-size-mb', help="Size of parts files are uploaded in in Megabytes.", type=int, default=8)
+    parser.add_argument('--num-workers', help="Number of upload and download workers.", type=int, default=2)
+    parser.add_argument('--latency-ms', help="Delay each response of S3 stand-in by this many milliseconds.", type=float, default=50)
+    parser.add_argument('--bandwidth-limit-mbps', help="Limit S3 stand-in's total bandwidth to this many Megabits/sec. Default is no limit.", type=float, default=0)
+    args = parser.parse_args()
+
+    settings.TOTAL_MAX_BANDWIDTH_BYTES_PER_SEC = 0      # NOTE: Bandwidth is only limited by S3 stand-in
+    settings.DOWNLOAD_CHUNK_SIZE_BYTES = MB_to_bytes(args.part_size_mb)
+    with S3StandIn(port=0,
+                   restore_delay_secs=0,
+                   bandwidth_limit_bytes_per_sec=int(args.bandwidth_limit_mbps * 1000 * 1000 / 8),
+                   log_requests=False,
+                   latency_secs=args.latency_ms / 1000) as s3_stand_in,\
+         tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        # NOTE: Shared S3 client of upload and download workers is created with these on first use
+        os.environ.update(AWS_ENDPOINT_URL=s3_stand_in.endpoint_url, AWS_ACCESS_KEY_ID='minio', AWS_SECRET_ACCESS_KEY='abcdefghijkl', AWS_DEFAULT_REGION='us-east-1')
+        s3_client = get_s3_client()
+
+        with StateDB(os.path.join(work_dir, 'statedb.sqlite3')) as state_db:
+            print(f"Creating {args.num_files} file(s) of {args.file_size_mb} MB...")
+            filenames = create_files(work_dir, args.num_files, MB_to_bytes(args.file_size_mb), MB_to_bytes(args.part_size_mb), state_db)
+            total_size = args.num_files * MB_to_bytes(args.file_size_mb)
+            part_checksums = state_db.get_all_part_checksums()
+
+            results = []
+            for engine in args.engines:
+                bucket = f'benchmark-{engine}'
+                s3_client.create_bucket(Bucket=bucket)
+                upload_secs, upload_num_threads = transfer(TaskType.UPLOAD, engine, filenames, bucket, args.num_workers, state_db)
+                for filename in filenames:
+                    tar_file = os.path.basename(filename)
+                    # NOTE: 'moto' doesn't follow checksum of files uploaded in parts with number of parts (eg: '...=-4')
+                    s3_checksum = s3_client.head_object(Bucket=bucket, Key=tar_file, ChecksumMode='ENABLED').get('ChecksumSHA256')
+                    assert s3_checksum.partition('-')[0] == get_s3_checksum(os.path.getsize(filename), *part_checksums[tar_file]).partition('-')[0],\
+                        f"'{tar_file}' uploaded with '{engine}' engine has checksum '{s3_checksum}' in S3!"
+
+                download_dir = os.path.join(work_dir, engine)
+                os.makedirs(download_dir)
+                download_secs, download_num_threads = transfer(TaskType.DOWNLOAD, engine, [os.path.join(download_dir, os.path.basename(filename)) for filename in filenames],
+                                                               bucket, args.num_workers, state_db)
+                for filename in filenames:
+                    assert filecmp.cmp(filename, os.path.join(download_dir, os.path.basename(filename)), shallow=False),\
+                        f"'{filename}' downloaded with '{engine}' engine doesn't match uploaded one!"
+                results.append((engine, upload_secs, upload_num_threads, download_secs, download_num_threads))
+
+    print(f"\n{args.num_files} file(s) of {args.file_size_mb} MB in {args.part_size_mb} MB parts with {args.num_workers} worker(s) "\
+          f"and {args.latency_ms:g} ms latency:")
+    print(f"{'engine':<8} {'upload':>12} {'threads':>8} {'download':>12} {'threads':>8}")
+    for engine, upload_secs, upload_num_threads, download_secs, download_num_threads in results:
+        print(f"{engine:<8} {total_size / upload_secs / MB_to_bytes(1):7.1f} MB/s {upload_num_threads:>8} "\
+              f"{total_size / download_secs / MB_to_bytes(1):7.1f} MB/s {download_num_threads:>8}")
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# Runs a local S3 server (using 'moto') where restores from Glacier Deep Archive take a while like in AWS.
+# Requires: pip install "moto[server]"
+# Usage: python3 testing/s3_stand_in.py [--port 9000] [--restore-delay-secs 60] [--bandwidth-limit-mbps 0] [--latency-ms 0] [--bucket mybucket]
+# Then set 'endpoint_url' in '~/.aws/config' to 'http://127.0.0.1:9000' (see 'testing/example.aws/config').
+import time
+import argparse
+from threading import Lock, Thread
+from datetime import datetime
+
+import boto3
+from moto.s3.models import FakeKey
+from moto.server import DomainDispatcherApplication, create_backend_app
+from moto.moto_api import state_manager
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+
+def simulate_restore_delay(restore_delay_secs: int) -> None:
+    # CAUTION: 'moto' times restores from when the object was created rather than from when its
+    # restore was requested, so restart the clock (using its internals) when a restore is requested
+    state_manager.set_transition(model_name='s3::keyrestore',
+                                 transition={'progression': 'time', 'seconds': restore_delay_secs})
+    restore = FakeKey.restore
+
+    def restore_with_delay(self, days: int) -> None:
+        restore(self, days)
+        self.status = 'IN_PROGRESS'
+        self._time_progressed = datetime.now()
+
+    FakeKey.restore = restore_with_delay
+
+
+class BandwidthLimiter:
+    # Lets through at most 'bytes_per_sec' bytes per second shared by all connections like a network link would
+    def __init__(self, bytes_per_sec: int):
+        self.bytes_per_sec = bytes_per_sec
+        self.mutex = Lock()
+        self.available_time = 0.0     # When the link is free to send more data
+
+    def consume(self, num_bytes: int) -> None:
+        with self.mutex:
+            now = time.monotonic()
+            self.available_time = max(self.available_time, now) + num_bytes / self.bytes_per_sec
+            wait_secs = self.available_time - now
+        time.sleep(wait_secs)
+
+
+class BandwidthLimitedInput:
+    def __init__(self, input, bandwidth_limiter: BandwidthLimiter):
+        self.input = input
+        self.bandwidth_limiter = bandwidth_limiter
+
+    def read(self, *args):
+        data = self.input.read(*args)
+        self.bandwidth_limiter.consume(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self.input.readline(*args)
+        self.bandwidth_limiter.consume(len(data))
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __getattr__(self, name):
+        return getattr(self.input, name)
+
+
+class BandwidthLimitedApp:
+    # WSGI middleware that limits bandwidth of both uploads (i.e. request bodies) and downloads (i.e. response bodies)
+    def __init__(self, app, bytes_per_sec: int):
+        self.app = app
+        self.bandwidth_limiter = BandwidthLimiter(bytes_per_sec)
+
+    def __call__(self, environ, start_response):
+        environ['wsgi.input'] = BandwidthLimitedInput(environ['wsgi.input'], self.bandwidth_limiter)
+        app_iter = self.app(environ, start_response)
+        try:
+            for data in app_iter:
+                self.bandwidth_limiter.consume(len(data))
+                yield data
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+class LatencyApp:
+    # WSGI middleware that delays each response like a link with this round trip time would
+    def __init__(self, app, latency_secs: float):
+        self.app = app
+        self.latency_secs = latency_secs
+
+    def __call__(self, environ, start_response):
+        time.sleep(self.latency_secs)
+        return self.app(environ, start_response)
+
+
+class S3StandIn:
+    # Local S3 server running in a background thread of this process
+    def __init__(self,
+                 host: str='127.0.0.1',
+                 port: int=9000,
+                 restore_delay_secs: int=60,
+                 bandwidth_limit_bytes_per_sec: int=0,
+                 log_requests: bool=True,
+                 latency_secs: float=0):
+        simulate_restore_delay(restore_delay_secs)
+
+        app = DomainDispatcherApplication(create_backend_app)
+        if bandwidth_limit_bytes_per_sec > 0:
+            app = BandwidthLimitedApp(app, bandwidth_limit_bytes_per_sec)
+        if latency_secs > 0:
+            app = LatencyApp(app, latency_secs)
+
+        class RequestHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs) -> None:
+                if log_requests:
+                    super().log_request(*args, **kwargs)
+
+        self.server = make_server(host, port, app, threaded=True, request_handler=RequestHandler)
+        self.endpoint_url = f'http://{host}:{self.server.server_port}'     # NOTE: Port 0 picks any free port
+        self.thread = Thread(target=self.server.serve_forever, name='s3-stand-in', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def get_client(self):
+        return boto3.client('s3',
+                            endpoint_url=self.endpoint_url,
+                            region_name='us-east-1',
+                            aws_access_key_id='minio',
+                            aws_secret_access_key='abcdefghijkl')
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local S3 stand-in server that simulates Glacier restore delay.")
+    parser.add_argument('--host', help="Host to listen on.", type=str, default='127.0.0.1')
+    parser.add_argument('--port', help="Port to listen on.", type=int, default=9000)
+    parser.add_argument('--restore-delay-secs', help="Seconds a restore takes to complete.", type=int, default=60)
+    parser.add_argument('--bandwidth-limit-mbps', help="Limit total upload and download bandwidth to this many Megabits/sec. Default is no limit.", type=float, default=0)
+    parser.add_argument('--latency-ms', help="Delay each response by this many milliseconds. Default is no delay.", type=float, default=0)
+    parser.add_argument('--bucket', help="Bucket to create.", type=str, default='mybucket')
+    args = parser.parse_args()
+
+    # Restored copies only become available after the delay
+    with S3StandIn(args.host, args.port, args.restore_delay_secs, int(args.bandwidth_limit_mbps * 1000 * 1000 / 8),
+                   latency_secs=args.latency_ms / 1000) as s3_stand_in:
+        try:
+            s3_stand_in.get_client().create_bucket(Bucket=args.bucket)
+            print(f"S3 stand-in listening on {s3_stand_in.endpoint_url} with bucket '{args.bucket}' "\
+                  f"and restore delay of {args.restore_delay_secs} secs. Press Ctrl+C to stop.")
+            while True:
+                time.sleep(1)
+
+        except KeyboardInterrupt:
+            pass
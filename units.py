@@ -0,0 +1,9 @@
+# CAUTION: Imported by 'settings.py' so this module must not import 'settings' or 'utils' (which imports 'settings')
+def KB_to_bytes(value: float) -> int:
+    return int(value * 1024)
+
+def MB_to_bytes(value: float) -> int:
+    return KB_to_bytes(value) * 1024
+
+def GB_to_bytes(value: float) -> int:
+    return MB_to_bytes(value) * 1024
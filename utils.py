@@ -1,22 +1,28 @@
 import os
+import csv
+import gzip
+import json
+import base64
+import hashlib
 import math
+import errno
 import uuid
 import string
 import secrets
+import logging
 import argparse
-from glob import iglob
+from glob import iglob, escape
 from dateutil import tz
-from http import HTTPStatus
 from functools import reduce
 from datetime import datetime
 from contextlib import suppress
+from urllib.parse import unquote_plus
 from collections.abc import Generator
 
-import boto3
-import botocore.exceptions
 from pathvalidate import is_valid_filepath
 
-from consts import MAX_LINUX_PATH_LENGTH
+from consts import MAX_LINUX_PATH_LENGTH, S3_MAX_UPLOAD_PARTS
+from units import KB_to_bytes, MB_to_bytes, GB_to_bytes
 import settings
 
 
@@ -41,6 +47,12 @@ def get_last_nth_dirname(filename: str, n: int) -> str:
 
     return filename
 
+def get_top_level_dirname(filename: str, root_dir: str) -> str:
+    # Given, for example, "/root/dir1/dir2/file.txt" and root_dir="/root",
+    # return "/root/dir1" (or root_dir itself for files directly in it)
+    depth = len(os.path.relpath(filename, root_dir).split(os.path.sep))
+    return get_last_nth_dirname(filename, depth - 1) if depth > 1 else root_dir
+
 def logrithmic_scale_value(i: int, a: int, b: int) -> int:
     assert i >= 0
     max_i = 100
@@ -52,17 +64,92 @@ def remove_file_ignore_errors(filename: str) -> None:
     with suppress(OSError):
         os.remove(filename)
 
+def drop_from_page_cache(fd: int, offset: int=0, length: int=0) -> None:
+    # NOTE: A length of 0 means till the end of file. Dirty pages are only queued for writeback and
+    # will be dropped by a later call once written out.
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+def get_page_cache_usage_bytes() -> int | None:
+    # Page cache charged to this process's cgroup, falling back to system wide page cache
+    MEMORY_STAT_FILES_AND_KEYS = [
+        ('/sys/fs/cgroup/memory.stat', 'file'),         # cgroup v2
+        ('/sys/fs/cgroup/memory/memory.stat', 'cache'), # cgroup v1
+    ]
+    with suppress(OSError):
+        with open('/proc/self/cgroup') as file:
+            for line in file:
+                _, controllers, cgroup_path = line.strip().split(':', maxsplit=2)
+                if controllers == '':
+                    MEMORY_STAT_FILES_AND_KEYS.insert(0, (os.path.join('/sys/fs/cgroup', cgroup_path.lstrip('/'), 'memory.stat'), 'file'))
+                elif 'memory' in controllers.split(','):
+                    MEMORY_STAT_FILES_AND_KEYS.insert(0, (os.path.join('/sys/fs/cgroup/memory', cgroup_path.lstrip('/'), 'memory.stat'), 'cache'))
+
+    for memory_stat_filename, key in MEMORY_STAT_FILES_AND_KEYS + [('/proc/meminfo', 'Cached:')]:
+        with suppress(OSError, ValueError, IndexError):
+            with open(memory_stat_filename) as file:
+                for line in file:
+                    values = line.split()
+                    if values[0] == key:
+                        # NOTE: '/proc/meminfo' reports in KB while cgroup stats are in bytes
+                        return KB_to_bytes(int(values[1])) if key == 'Cached:' else int(values[1])
+
+    return None
+
+def get_data_extents(fd: int, size: int) -> list[tuple[int, int]]:
+    # Returns (offset, size) of regions of a file that are not holes
+    data_extents: list[tuple[int, int]] = []
+    offset = 0
+    while offset < size:
+        try:
+            data_offset = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                break       # NOTE: There is no more data till the end of file
+            raise ex
+
+        hole_offset = min(os.lseek(fd, data_offset, os.SEEK_HOLE), size)
+        data_extents.append((data_offset, hole_offset - data_offset))
+        offset = hole_offset
+
+    return data_extents
+
 def generate_random_name() -> str:
     return uuid.uuid4().hex
 
 def list_files_recursive_iter(folder: str, file_extension: str='') -> Generator[str]:
-    for file_or_dir in iglob(os.path.join(folder, f'**{file_extension}'),
+    for file_or_dir in iglob(os.path.join(escape(folder), f'**{file_extension}'),
                              recursive=True,
                              include_hidden=True):  # CAUTION: Don't forget to include hidden files
         if os.path.isfile(file_or_dir) and\
             not os.path.islink(file_or_dir):        # CAUTION: Don't include symbolic links
             yield abspath(file_or_dir)
 
+def list_files_iter(folder: str) -> Generator[str]:
+    # Same as 'list_files_recursive_iter()' but only lists files directly in folder
+    for file_or_dir in iglob(os.path.join(escape(folder), '*'), include_hidden=True):
+        if os.path.isfile(file_or_dir) and not os.path.islink(file_or_dir):
+            yield abspath(file_or_dir)
+
+def list_files_stat_recursive_iter(folder: str) -> Generator[tuple[str, os.stat_result]]:
+    # Faster than 'list_files_recursive_iter()' for walking large trees as file types come with directory
+    # entries so each file is only stat'ed once. Folders in 'IGNORE_DIRS' aren't walked into.
+    # NOTE: Files of a folder are listed one after another
+    dirs = [folder]
+    while dirs:
+        dir = dirs.pop()
+        try:
+            with os.scandir(dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):     # CAUTION: Don't follow symbolic links
+                        if entry.name not in settings.IGNORE_DIRS:
+                            dirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.path, entry.stat(follow_symlinks=False)
+
+        except OSError as ex:
+            logging.warning(f"Failed to list '{dir}' with '{repr(ex)}'!")
+
 def generate_password(length: int) -> str:
     characters = string.ascii_letters + string.digits + string.punctuation
     return ''.join(secrets.choice(characters) for i in range(length))
@@ -71,15 +158,6 @@ def escape_sql_escape_chars(value: str) -> str:
     # Escape single quotes in SQL value string
     return value.replace("'", "''")
 
-def KB_to_bytes(value: float) -> int:
-    return int(value * 1024)
-
-def MB_to_bytes(value: float) -> int:
-    return KB_to_bytes(value) * 1024
-
-def GB_to_bytes(value: float) -> int:
-    return MB_to_bytes(value) * 1024
-
 def mins_to_secs(value: float) -> int:
     return int(value * 60)
 
@@ -87,9 +165,6 @@ def repeat_string_until_length(value: str, length: int) -> str:
     a, b = divmod(length, len(value))
     return value * a + value[:b]
 
-def isAWSConfigAndCredentialsOK() -> bool:
-    return len(boto3.Session().available_profiles) > 0
-
 def toLocalDateTimeFromUTCString(value: str) -> datetime:
     return datetime.fromisoformat(value).replace(tzinfo=tz.UTC).astimezone()
 
@@ -109,23 +184,59 @@ def prettyFilesize(value, decimal_places=1) -> str:
     assert unit is not None
     return f"{value:.{decimal_places}f} {unit}"
 
-def checkFilesExistsInS3(bucket: str, tar_files: set[str]) -> list[bool]:
-    session = boto3.Session()
-    s3_client = session.client('s3')
+def listObjectsInS3Inventory(manifest_filename: str) -> dict[str, tuple[int, str]]:
+    # Same as 'list_objects_in_s3()' of 'libs' but read from a downloaded S3 Inventory report in CSV format.
+    # Data files listed in its 'manifest.json' are looked for next to it or in 'data' folder next to it.
+    with open(manifest_filename) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('fileFormat') != 'CSV':
+        raise ValueError(f"Only CSV S3 Inventory reports are supported but '{manifest_filename}' is '{manifest.get('fileFormat')}'!")
 
-    results: list[bool] = []
-    for tar_file in tar_files:
-        try:
-            s3_client.head_object(Bucket=bucket, Key=tar_file)
-            results.append(True)
+    columns = [column.strip() for column in manifest['fileSchema'].split(',')]
+    if 'Key' not in columns or 'Size' not in columns:
+        raise ValueError(f"S3 Inventory report '{manifest_filename}' must include 'Key' and 'Size' fields!")
+
+    objects: dict[str, tuple[int, str]] = {}
+    manifest_dir = os.path.dirname(manifest_filename)
+    for data_file in manifest['files']:
+        data_filename = os.path.join(manifest_dir, 'data', os.path.basename(data_file['key']))
+        if not os.path.isfile(data_filename):
+            data_filename = os.path.join(manifest_dir, os.path.basename(data_file['key']))
+
+        with gzip.open(data_filename, mode='rt', newline='') as csv_file:
+            for row in csv.reader(csv_file):
+                row = dict(zip(columns, row))
+                if row.get('IsLatest', 'true') != 'true' or row.get('IsDeleteMarker', 'false') == 'true':
+                    continue    # NOTE: Skip old versions and deleted objects in versioned buckets
+
+                objects[unquote_plus(row['Key'])] = (int(row['Size']), row.get('StorageClass', 'STANDARD'))
 
-        except botocore.exceptions.ClientError as ex:
-            if int(ex.response['Error']['Code']) == HTTPStatus.NOT_FOUND:
-                results.append(False)
-            else:
-                raise ex
+    return objects
 
-    return results
+def get_tar_filename_template(output_filename_template: str, compression: str, encrypt: bool) -> str:
+    if compression and not output_filename_template.lower().endswith(f'.{compression}'):
+        output_filename_template += f'.{compression}'
+
+    if encrypt:
+        output_filename_template += settings.ENCRYPTED_FILE_EXTENSION
+
+    return output_filename_template
+
+def get_shard_db_filename(db_filename: str, shard_idx: int) -> str:
+    # Given, for example, "/root/20240101-000000_backup_statedb.sqlite3" and shard_idx=1,
+    # return "/root/20240101-000000_backup_statedb_shard001.sqlite3"
+    db_filename_stem, db_filename_ext = os.path.splitext(db_filename)
+    return f"{db_filename_stem}_shard{shard_idx:03}{db_filename_ext}"
+
+def get_shard_db_filenames(db_filename: str) -> list[str]:
+    db_filename_stem, db_filename_ext = os.path.splitext(db_filename)
+    return sorted(iglob(f"{escape(db_filename_stem)}_shard[0-9][0-9][0-9]{escape(db_filename_ext)}"))
+
+def get_journal_filename(db_filename: str) -> str:
+    # Given, for example, "/root/20240101-000000_backup_statedb.sqlite3",
+    # return "/root/20240101-000000_backup_statedb_journal.sqlite3"
+    db_filename_stem, db_filename_ext = os.path.splitext(db_filename)
+    return f"{db_filename_stem}_journal{db_filename_ext}"
 
 def is_in_ignore_list(filename: str) -> bool:
     dirs_split_list = os.path.dirname(filename).split(os.path.sep)
@@ -139,6 +250,102 @@ def is_in_ignore_list(filename: str) -> bool:
 
     return False
 
+def get_upload_part_size(size: int) -> int:
+    # Returns size of parts (in whole MBs) data of 'size' bytes is uploaded in so that it fits in the most parts S3 allows
+    return max(settings.UPLOAD_PART_SIZE_BYTES, math.ceil(size / S3_MAX_UPLOAD_PARTS / MB_to_bytes(1)) * MB_to_bytes(1))
+
+
+def get_s3_checksum(size: int, part_size: int, part_digests: bytes) -> str:
+    # Returns SHA-256 checksum S3 has for data uploaded in parts of 'part_size' bytes with these (concatenated) SHA-256
+    # digests. It is the checksum of the data if it's smaller than a part (as it's uploaded in a single request),
+    # otherwise the checksum of checksums of parts followed by number of parts (i.e. 'COMPOSITE' checksum type).
+    if size < part_size:
+        return base64.b64encode(part_digests).decode()
+    num_parts = len(part_digests) // hashlib.sha256().digest_size
+    return f"{base64.b64encode(hashlib.sha256(part_digests).digest()).decode()}-{num_parts}"
+
+
+class PartChecksums:
+    # Works out SHA-256 digests of consecutive parts of 'part_size' bytes of data written so that
+    # checksum S3 has for the data once uploaded in parts of the same size is known without reading it again
+    def __init__(self, part_size: int, part_digests: bytes=b''):
+        self.part_size = part_size
+        self.part_digests = bytearray(part_digests)     # NOTE: Digests of completed parts one after another
+        self.part_hash = hashlib.sha256()
+        self.part_offset = 0
+
+    def update(self, data) -> None:
+        data = memoryview(data)
+        while data:
+            part_data = data[:self.part_size - self.part_offset]
+            self.part_hash.update(part_data)
+            self.part_offset += len(part_data)
+            data = data[len(part_data):]
+
+            if self.part_offset == self.part_size:
+                self.part_digests += self.part_hash.digest()
+                self.part_hash = hashlib.sha256()
+                self.part_offset = 0
+
+    def update_from_file(self, filename: str, size: int) -> None:
+        # Continues from data of file up to 'size' (eg: at a checkpoint) only reading what's after completed parts before it
+        assert self.part_offset == 0
+        num_parts = min(len(self.part_digests) // self.part_hash.digest_size, size // self.part_size)
+        del self.part_digests[num_parts * self.part_hash.digest_size:]
+
+        offset = num_parts * self.part_size
+        with open(filename, mode='rb') as file:
+            file.seek(offset)
+            while offset < size:
+                data = file.read(min(settings.BUFFER_SIZE_BYTES, size - offset))
+                if not data:
+                    raise EOFError(f"'{filename}' is smaller than {size} bytes!")
+                self.update(data)
+                offset += len(data)
+
+    def get_part_digests(self, completed_only: bool=False) -> bytes:
+        if completed_only or (self.part_offset == 0 and self.part_digests):
+            return bytes(self.part_digests)
+        return bytes(self.part_digests) + self.part_hash.digest()      # NOTE: Last part is smaller than the others
+
+
+class PageCacheUsage:
+    # Logs how much page cache has been used since this object was created
+    def __init__(self):
+        self.start_bytes = get_page_cache_usage_bytes()
+        self.peak_bytes = self.start_bytes
+
+    def log(self) -> None:
+        usage_bytes = get_page_cache_usage_bytes()
+        if usage_bytes is None or self.start_bytes is None or self.peak_bytes is None:
+            return
+
+        self.peak_bytes = max(self.peak_bytes, usage_bytes)
+        change_bytes = usage_bytes - self.start_bytes
+        logging.info(f"Page cache usage is {prettyFilesize(usage_bytes)} ({'+' if change_bytes >= 0 else '-'}{prettyFilesize(abs(change_bytes))} "\
+                     f"since start, sampled peak {prettyFilesize(self.peak_bytes)}).")
+
+
+class LatencyStats:
+    # Keeps count, total and maximum of latencies (in secs) of some operation to be logged at the end
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+
+    def add(self, secs: float) -> None:
+        self.count += 1
+        self.total_secs += secs
+        self.max_secs = max(self.max_secs, secs)
+
+    def log(self, level: int=logging.INFO) -> None:
+        if self.count == 0:
+            return
+
+        logging.log(level, f"{self.name} latency: {self.count} sample(s), mean {self.total_secs / self.count * 1000:.3f} ms, "\
+                     f"max {self.max_secs * 1000:.3f} ms, total {self.total_secs:.3f} secs.")
+
 
 class ValidateEncryptionKey(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None) -> None:
@@ -147,22 +354,6 @@ class ValidateEncryptionKey(argparse.Action):
 
         setattr(namespace, self.dest, values)
 
-class ValidateBucketExists(argparse.Action):
-    def __call__(self, parser, namespace, values, option_string=None) -> None:
-        session = boto3.Session()
-        s3_client = session.client('s3')
-
-        try:
-            s3_client.head_bucket(Bucket=values)
-
-        except botocore.exceptions.ClientError as ex:
-            if int(ex.response['Error']['Code']) == HTTPStatus.NOT_FOUND:
-                raise argparse.ArgumentError(self, f"The bucket with name '{values}' doesn't exist in S3 server!")
-            else:
-                raise ex
-
-        setattr(namespace, self.dest, values)
-
 class ValidateFilesExists(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None) -> None:
         isListType = isinstance(values, (list, tuple))
@@ -228,3 +419,11 @@ class ValidateGreaterOrEqualTo0(argparse.Action):
             raise argparse.ArgumentError(self, "Value must be greater than or equal to 0!")
 
         setattr(namespace, self.dest, values)
+
+class ValidateGreaterThan0(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None) -> None:
+        assert isinstance(values, int)
+        if values <= 0:
+            raise argparse.ArgumentError(self, "Value must be greater than 0!")
+
+        setattr(namespace, self.dest, values)